@@ -0,0 +1,209 @@
+# coding=utf-8
+# author=torchcc
+"""
+end-to-end benchmark: load is sent through local stand-in routers, a connector made by create_and_start_connector and
+a local target service, and throughput, latency, cpu and memory of the connector are reported.
+
+    python -m benchmark.bench_end_to_end --concurrency 32 --resp-body-size 16384 --routers 2 --duration 20
+    python -m benchmark.bench_end_to_end --rps 500 --req-body-size 1048576 --engine asyncio --json
+
+the routers, the load generator and the target run in a child process, so the cpu and rss figures are those of the
+connector process alone. with --rps the load is open-loop and latency is counted from when a request was due, so a
+connector falling behind shows up in the latency instead of silently lowering the load.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import time
+from multiprocessing.connection import Connection
+from typing import Dict, List, NoReturn
+
+from benchmark.fake_router import FakeRouter
+from benchmark.target_server import TargetServer
+from crank4py_connector import Config, create_and_start_connector
+
+_SERVICE_NAME = "bench"
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p / 100))]
+
+
+async def drive(routers: List[FakeRouter], args: argparse.Namespace, duration: float) -> Dict:
+    method = "POST" if args.req_body_size else "GET"
+    dest = f"/{_SERVICE_NAME}/load?size={args.resp_body_size}"
+    body = os.urandom(args.req_body_size) if args.req_body_size else None
+    headers = {"Host": "bench.example.com", "Accept": "*/*"}
+    if body is not None:
+        headers["Content-Length"] = str(len(body))
+    latencies: List[float] = []
+    failures = {"errors": 0, "timeouts": 0}
+    picks = itertools.count()
+    slots = itertools.count()
+    started = time.monotonic()
+    deadline = started + duration
+
+    async def worker() -> NoReturn:
+        while True:
+            if args.rps:
+                due = started + next(slots) / args.rps
+                if due >= deadline:
+                    return
+                await asyncio.sleep(due - time.monotonic())
+            else:
+                due = time.monotonic()
+                if due >= deadline:
+                    return
+            router = routers[next(picks) % len(routers)]
+            try:
+                resp = await asyncio.wait_for(router.request(method, dest, headers, body), args.timeout)
+            except asyncio.TimeoutError:
+                failures["timeouts"] += 1
+                continue
+            if resp.status != 200 or resp.close_code != 1000 or resp.body_size != args.resp_body_size:
+                failures["errors"] += 1
+                continue
+            latencies.append(time.monotonic() - due)
+
+    await asyncio.gather(*[worker() for _ in range(args.concurrency)])
+    elapsed = time.monotonic() - started
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": failures["errors"],
+        "timeouts": failures["timeouts"],
+        "elapsed_secs": elapsed,
+        "req_per_sec": len(latencies) / elapsed,
+        "mb_per_sec": len(latencies) * (args.req_body_size + args.resp_body_size) / elapsed / 1024 / 1024,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p90_ms": percentile(latencies, 90) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "max_ms": (latencies[-1] if latencies else 0) * 1000,
+    }
+
+
+def _load_side(pipe: Connection, router_count: int) -> NoReturn:
+    """the child process: target, routers and load generator"""
+
+    async def serve() -> NoReturn:
+        loop = asyncio.get_running_loop()
+        target = TargetServer().start()
+        routers = [await FakeRouter().start() for _ in range(router_count)]
+        pipe.send({"target": target.uri, "routers": [router.uri for router in routers]})
+        while True:
+            command, payload = await loop.run_in_executor(None, pipe.recv)
+            if command == "wait_registered":
+                deadline = time.monotonic() + 30
+                while sum(r.idle_count for r in routers) < payload and time.monotonic() < deadline:
+                    await asyncio.sleep(0.05)
+                pipe.send(sum(r.idle_count for r in routers))
+            elif command == "run":
+                args, duration = payload
+                pipe.send(await drive(routers, args, duration))
+            else:
+                for router in routers:
+                    await router.close()
+                target.shutdown()
+                pipe.send(None)
+                return
+
+    asyncio.run(serve())
+
+
+def _rss_mb() -> float:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except OSError:
+        # no procfs, fall back to the peak
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run(args: argparse.Namespace) -> Dict:
+    pipe, child_pipe = multiprocessing.Pipe()
+    load_side = multiprocessing.Process(target=_load_side, args=(child_pipe, args.routers), daemon=True)
+    load_side.start()
+    endpoints = pipe.recv()
+
+    config = Config(endpoints["target"], _SERVICE_NAME, endpoints["routers"], component_name="benchmark")
+    config.set_sliding_window_size(args.sliding_window)
+    config.set_engine(args.engine)
+    config.set_req_body_stream_limit(args.req_body_stream_limit)
+    if args.resp_chunk_size:
+        config.set_resp_chunk_size(args.resp_chunk_size)
+    connector = create_and_start_connector(config)
+    try:
+        pipe.send(("wait_registered", args.routers * args.sliding_window))
+        registered = pipe.recv()
+        if args.warmup:
+            pipe.send(("run", (args, args.warmup)))
+            pipe.recv()
+        rss_before = _rss_mb()
+        usage_before, wall_before = resource.getrusage(resource.RUSAGE_SELF), time.monotonic()
+        pipe.send(("run", (args, args.duration)))
+        result = pipe.recv()
+        usage_after, wall = resource.getrusage(resource.RUSAGE_SELF), time.monotonic() - wall_before
+        rss_after = _rss_mb()
+        cpu_secs = (usage_after.ru_utime - usage_before.ru_utime) + (usage_after.ru_stime - usage_before.ru_stime)
+        result.update({
+            "registered_sockets": registered,
+            "connector_cpu_secs": cpu_secs,
+            "connector_cpu_cores": cpu_secs / wall,
+            "connector_cpu_ms_per_req": cpu_secs * 1000 / result["requests"] if result["requests"] else 0.0,
+            "connector_rss_mb": rss_after,
+            "connector_rss_growth_mb": rss_after - rss_before,
+            "connector_peak_rss_mb": max(rss_after, usage_after.ru_maxrss / 1024),
+        })
+        return result
+    finally:
+        connector.shutdown()
+        pipe.send(("stop", None))
+        pipe.recv()
+        load_side.join(5)
+
+
+def main() -> NoReturn:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--duration", type=float, default=10, help="seconds of measured load")
+    parser.add_argument("--warmup", type=float, default=2, help="seconds of load before measuring")
+    parser.add_argument("--concurrency", type=int, default=16, help="requests in flight at most")
+    parser.add_argument("--rps", type=float, default=0, help="open-loop request rate, 0 sends as fast as possible")
+    parser.add_argument("--req-body-size", type=int, default=0, help="request body bytes, > 0 sends POSTs")
+    parser.add_argument("--resp-body-size", type=int, default=1024, help="response body bytes")
+    parser.add_argument("--routers", type=int, default=1, help="number of stand-in routers")
+    parser.add_argument("--sliding-window", type=int, default=2, help="Config.set_sliding_window_size")
+    parser.add_argument("--engine", default="thread", choices=["thread", "asyncio"])
+    parser.add_argument("--req-body-stream-limit", type=int, default=0, help="Config.set_req_body_stream_limit")
+    parser.add_argument("--resp-chunk-size", type=int, default=0, help="Config.set_resp_chunk_size")
+    parser.add_argument("--timeout", type=float, default=30, help="seconds before a request counts as timed out")
+    parser.add_argument("--log-level", default="WARNING", help="level of the crank4py-connector logger")
+    parser.add_argument("--json", action="store_true", help="print the result as one json object")
+    args = parser.parse_args()
+
+    logging.getLogger("crank4py-connector").setLevel(args.log_level)
+    result = run(args)
+    if args.json:
+        print(json.dumps(dict(vars(args), **result)))
+        return
+    print(f"engine={args.engine} routers={args.routers} sliding_window={args.sliding_window} "
+          f"concurrency={args.concurrency} rps={args.rps or 'max'} "
+          f"req_body={args.req_body_size}B resp_body={args.resp_body_size}B")
+    print(f"  requests      {result['requests']} ok, {result['errors']} errors, {result['timeouts']} timeouts "
+          f"in {result['elapsed_secs']:.1f}s")
+    print(f"  throughput    {result['req_per_sec']:.1f} req/s, {result['mb_per_sec']:.1f} MB/s")
+    print(f"  latency       p50 {result['p50_ms']:.2f}ms  p90 {result['p90_ms']:.2f}ms  "
+          f"p99 {result['p99_ms']:.2f}ms  max {result['max_ms']:.2f}ms")
+    print(f"  connector cpu {result['connector_cpu_cores']:.2f} cores, {result['connector_cpu_ms_per_req']:.3f}ms/req")
+    print(f"  connector rss {result['connector_rss_mb']:.1f}MB (grew {result['connector_rss_growth_mb']:.1f}MB, "
+          f"peak {result['connector_peak_rss_mb']:.1f}MB)")
+
+
+if __name__ == "__main__":
+    main()
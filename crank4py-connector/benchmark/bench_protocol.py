@@ -0,0 +1,93 @@
+# coding=utf-8
+# author=torchcc
+"""
+micro-benchmarks of the cranker protocol codec on realistic header sets.
+
+    python -m benchmark.bench_protocol [--number 20000]
+
+every case reports microseconds per message for parsing a request from the router, building the target request
+headers out of it, and serializing the response head sent back, directly and through the old parse-rebuild round trip.
+"""
+import argparse
+import base64
+import json
+import os
+import timeit
+from typing import Dict, List, NoReturn, Tuple
+
+from crank4py_connector.connector_socket import ConnectorSocket
+from crank4py_connector.intermediate_request import IntermediateRequest
+from cranker_protocol.protocol import ProtocolRequest, ProtocolResponse, ProtocolResponseBuilder
+
+
+def _token(n: int) -> str:
+    return base64.urlsafe_b64encode(os.urandom(n)).decode().rstrip("=")
+
+
+def _jwt() -> str:
+    header = base64.urlsafe_b64encode(json.dumps({"alg": "RS256", "typ": "JWT", "kid": _token(12)}).encode())
+    claims = {"sub": _token(16), "iss": "https://login.example.com", "aud": ["api", "web"], "exp": 1700000000,
+              "scope": " ".join(f"scope-{i}:read scope-{i}:write" for i in range(12)), "tenant": _token(24)}
+    body = base64.urlsafe_b64encode(json.dumps(claims).encode())
+    return b".".join([header, body, base64.urlsafe_b64encode(os.urandom(256))]).decode().replace("=", "")
+
+
+def _cookies(count: int, size: int) -> str:
+    return "; ".join(f"c{i}={_token(size)}" for i in range(count))
+
+
+def header_sets() -> Dict[str, Tuple[List[Tuple[str, str]], List[Tuple[str, str]]]]:
+    """name -> (request headers, response headers)"""
+    common_req = [("Host", "api.example.com"), ("User-Agent", "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36"),
+                  ("Accept", "application/json, text/plain, */*"), ("Accept-Encoding", "gzip, deflate, br"),
+                  ("Accept-Language", "en-US,en;q=0.9"), ("X-Forwarded-For", "203.0.113.7, 10.0.0.12"),
+                  ("X-Request-Id", _token(16)), ("traceparent", f"00-{os.urandom(16).hex()}-{os.urandom(8).hex()}-01")]
+    common_resp = [("Content-Type", "application/json; charset=utf-8"), ("Content-Length", "5120"),
+                   ("Date", "Sun, 18 Oct 2026 15:40:00 GMT"), ("Cache-Control", "no-store"), ("Vary", "Accept-Encoding")]
+    return {
+        "minimal": ([("Host", "api.example.com"), ("Accept", "*/*")], [("Content-Length", "2")]),
+        "api+jwt": (common_req + [("Authorization", "Bearer " + _jwt())], common_resp),
+        "browser+cookies": (common_req + [("Cookie", _cookies(30, 48)), ("Referer", "https://www.example.com/a/b")],
+                            common_resp + [("Set-Cookie", f"session={_token(96)}; Path=/; HttpOnly; Secure")]),
+        "huge": (common_req + [("Authorization", "Bearer " + _jwt()), ("Cookie", _cookies(120, 96))] +
+                 [(f"X-Custom-{i}", _token(32)) for i in range(80)],
+                 common_resp + [("Set-Cookie", ", ".join(f"c{i}={_token(64)}; Path=/" for i in range(20)))] +
+                 [(f"X-Custom-{i}", _token(32)) for i in range(20)]),
+    }
+
+
+def request_msg(headers: List[Tuple[str, str]]) -> str:
+    return "GET /service-a/api/v1/orders?page=2&size=50 HTTP/1.1\n" + "".join(f"{h}:{v}\n" for h, v in headers) + "_2"
+
+
+def response_builder(headers: List[Tuple[str, str]]) -> ProtocolResponseBuilder:
+    return ProtocolResponseBuilder.new_builder().with_src_url("/service-a/api/v1/orders?page=2&size=50") \
+        .with_method("GET").with_resp_status(200).with_resp_reason("OK") \
+        .with_resp_headers(ConnectorSocket._parse_headers(dict(headers)))
+
+
+def main() -> NoReturn:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--number", type=int, default=20000, help="iterations per measurement")
+    parser.add_argument("--repeat", type=int, default=5, help="the best repetition is reported")
+    args = parser.parse_args()
+
+    def best(fn) -> float:
+        return min(timeit.repeat(fn, number=args.number, repeat=args.repeat)) / args.number * 1e6
+
+    print(f"{'case':<18}{'req bytes':>10}{'parse':>9}{'to target':>11}{'resp direct':>13}{'resp round trip':>17}")
+    for name, (req_headers, resp_headers) in header_sets().items():
+        msg = request_msg(req_headers)
+        ptc_req = ProtocolRequest(msg)
+        builder = response_builder(resp_headers)
+        assert builder.to_protocol_msg() == ProtocolResponse(builder.build()).to_protocol_msg()
+        parse = best(lambda: ProtocolRequest(msg))
+        to_target = best(lambda: ConnectorSocket._put_headers_to(IntermediateRequest(), ptc_req))
+        direct = best(lambda: response_builder(resp_headers).to_protocol_msg())
+        round_trip = best(lambda: ProtocolResponse(response_builder(resp_headers).build()).to_protocol_msg())
+        print(f"{name:<18}{len(msg):>10}{parse:>9.2f}{to_target:>11.2f}{direct:>13.2f}{round_trip:>17.2f}")
+    print("times in microseconds per message")
+
+
+if __name__ == "__main__":
+    main()
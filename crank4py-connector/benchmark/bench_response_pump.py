@@ -0,0 +1,177 @@
+# coding=utf-8
+# author=torchcc
+"""
+measures how fast a target response body is moved to a router websocket, comparing the iter_content + send path
+the connector used before with ResponsePump, and ResponsePump with a read-ahead.
+
+    python -m benchmark.bench_response_pump --size-mb 200 --chunk-size 16384 65536
+    python -m benchmark.bench_response_pump --size-mb 50 --target-mbps 200 --router-mbps 200
+
+the target is a local http server and the router end is a socket that discards what it receives, so the numbers are
+the cost of reading, framing and masking in the connector itself. --target-mbps and --router-mbps slow either end
+down to that many MB/s, like a target and a router on a far away network, which is where the read-ahead pays off.
+"""
+import argparse
+import socket
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Callable, NoReturn, Optional, Tuple
+
+from requests import Response
+from websocket import ABNF, WebSocket
+
+from crank4py_connector.connector_socket import ConnectorSocket
+from crank4py_connector.response_pump import ResponsePump, ResponseReadAhead
+from crank4py_connector.scheduler import Lane
+from util import create_http_client
+
+
+def _throttle(started: float, done_bytes: int, mbps: float) -> NoReturn:
+    """sleeps until done_bytes took as long as they would at mbps MB/s"""
+    if mbps > 0:
+        ahead = done_bytes / (mbps * 1024 * 1024) - (time.perf_counter() - started)
+        if ahead > 0:
+            time.sleep(ahead)
+
+
+def start_target(body_size: int, mbps: float = 0) -> ThreadingHTTPServer:
+    block = b"\xa5" * (64 * 1024 if mbps > 0 else 1024 * 1024)
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header("Content-Length", str(body_size))
+            self.end_headers()
+            remaining = body_size
+            started = time.perf_counter()
+            while remaining:
+                n = min(remaining, len(block))
+                self.wfile.write(block[:n])
+                remaining -= n
+                _throttle(started, body_size - remaining, mbps)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class RouterSink(object):
+    """a connected websocket whose peer reads and drops everything, exposing what IntermediateRequest sends to"""
+
+    send_raw_frame = ConnectorSocket.send_raw_frame
+
+    def __init__(self, mbps: float = 0) -> None:
+        client, server = socket.socketpair()
+        self.mbps: float = mbps
+        self.sock = WebSocket(enable_multithread=True)
+        self.sock.sock = client
+        self.sock.connected = True
+        self.received = 0
+        self._reader = threading.Thread(target=self._drain, args=(server,), daemon=True)
+        self._reader.start()
+
+    def _drain(self, server: socket.socket) -> NoReturn:
+        buf = bytearray(64 * 1024 if self.mbps > 0 else 1024 * 1024)
+        started = time.perf_counter()
+        while True:
+            n = server.recv_into(buf)
+            if not n:
+                break
+            self.received += n
+            _throttle(started, self.received, self.mbps)
+        server.close()
+
+    def send(self, data, opcode=ABNF.OPCODE_TEXT) -> NoReturn:
+        self.sock.send(data, opcode)
+
+    def close(self) -> int:
+        self.sock.sock.shutdown(socket.SHUT_WR)
+        self._reader.join()
+        self.sock.sock.close()
+        return self.received
+
+
+def iter_content_pump(chunk_size: int) -> Callable[[Response, RouterSink], NoReturn]:
+    def pump(resp: Response, sink: RouterSink) -> NoReturn:
+        for chunk in resp.iter_content(chunk_size=chunk_size):
+            if not chunk:
+                break
+            sink.send(chunk, opcode=ABNF.OPCODE_BINARY)
+    return pump
+
+
+def response_pump(chunk_size: int) -> Callable[[Response, RouterSink], NoReturn]:
+    def pump(resp: Response, sink: RouterSink) -> NoReturn:
+        ResponsePump.for_chunk_size(chunk_size).pump(resp, sink)
+    return pump
+
+
+class _CPUTimedLane(Lane):
+    """a lane adding up the cpu time of its tasks, the reads of the read-ahead happen on it"""
+
+    cpu: float = 0
+
+    def _run(self, fn: Callable, *args, **kwargs):
+        started = time.thread_time()
+        try:
+            return super()._run(fn, *args, **kwargs)
+        finally:
+            self.cpu += time.thread_time() - started
+
+
+def read_ahead_pump(chunk_size: int, max_bytes: int) -> Callable[[Response, RouterSink], float]:
+    def pump(resp: Response, sink: RouterSink) -> float:
+        lane = _CPUTimedLane("read-ahead", 1, 0)
+        ResponseReadAhead(max_bytes, lane).pump(resp, sink, chunk_size)
+        # the reader ends right after the last chunk is handed over
+        lane.shutdown(wait=True)
+        return lane.cpu
+    return pump
+
+
+def run_once(url: str, pump: Callable[[Response, RouterSink], Optional[float]],
+             router_mbps: float = 0) -> Tuple[float, float, int]:
+    client = create_http_client()
+    sink = RouterSink(router_mbps)
+    wall, cpu = time.perf_counter(), time.thread_time()
+    resp = client.get(url, stream=True)
+    other_cpu = pump(resp, sink) or 0
+    cpu, wall = time.thread_time() - cpu + other_cpu, time.perf_counter() - wall
+    return wall, cpu, sink.close()
+
+
+def main() -> NoReturn:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size-mb", type=int, default=200, help="size of the response body")
+    parser.add_argument("--chunk-size", type=int, nargs="+", default=[16384, 65536])
+    parser.add_argument("--rounds", type=int, default=3, help="the best round is reported")
+    parser.add_argument("--read-ahead", type=int, default=256 * 1024, help="bytes read ahead by ResponseReadAhead")
+    parser.add_argument("--target-mbps", type=float, default=0, help="slows the target down to that many MB/s")
+    parser.add_argument("--router-mbps", type=float, default=0, help="slows the router down to that many MB/s")
+    args = parser.parse_args()
+
+    body_size = args.size_mb * 1024 * 1024
+    target = start_target(body_size, args.target_mbps)
+    url = f"http://127.0.0.1:{target.server_port}/download"
+    print(f"{'pump':<14}{'chunk':>8}{'MB/s':>10}{'cpu MB/s':>10}")
+    for chunk_size in args.chunk_size:
+        for name, pump in (("iter_content", iter_content_pump(chunk_size)), ("ResponsePump", response_pump(chunk_size)),
+                           ("ReadAhead", read_ahead_pump(chunk_size, args.read_ahead))):
+            best_wall, best_cpu = float("inf"), float("inf")
+            for _ in range(args.rounds):
+                wall, cpu, received = run_once(url, pump, args.router_mbps)
+                assert received > body_size, f"router end only got {received} bytes"
+                best_wall, best_cpu = min(best_wall, wall), min(best_cpu, cpu)
+            mb = body_size / 1024 / 1024
+            print(f"{name:<14}{chunk_size:>8}{mb / best_wall:>10.1f}{mb / best_cpu:>10.1f}")
+    target.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+# coding=utf-8
+# author=torchcc
+"""
+a stand-in cranker router for benchmarks: it accepts connector sockets on /register/, speaks cranker protocol 1.0
+over them and hands every request to the next idle socket, the way a real router does.
+"""
+import asyncio
+import base64
+import hashlib
+import struct
+from typing import Dict, List, NoReturn, Optional, Tuple
+
+from cranker_protocol.protocol import RequestBodyEndedMarker, RequestBodyPendingMarker, RequestHasNoBodyMarker
+
+_WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+_OPCODE_TEXT, _OPCODE_BINARY, _OPCODE_CLOSE, _OPCODE_PING, _OPCODE_PONG = 0x1, 0x2, 0x8, 0x9, 0xa
+
+
+class RouterResponse(object):
+
+    def __init__(self, head: str, body_size: int, body: Optional[bytes], close_code: Optional[int]) -> None:
+        self.head: str = head
+        self.body_size: int = body_size
+        self.body: Optional[bytes] = body
+        self.close_code: Optional[int] = close_code
+
+    @property
+    def status(self) -> int:
+        bits = self.head.split(" ", 2)
+        return int(bits[1]) if len(bits) > 1 else 0
+
+
+class RouterSocket(object):
+    """the router end of one connector socket"""
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self._reader = reader
+        self._writer = writer
+        self.released = asyncio.Event()
+
+    @property
+    def is_closing(self) -> bool:
+        return self._writer.is_closing()
+
+    async def recv(self) -> Tuple[int, bytes]:
+        b1, b2 = await self._reader.readexactly(2)
+        length = b2 & 0x7f
+        if length == 0x7e:
+            length = struct.unpack("!H", await self._reader.readexactly(2))[0]
+        elif length == 0x7f:
+            length = struct.unpack("!Q", await self._reader.readexactly(8))[0]
+        mask_key = await self._reader.readexactly(4) if b2 & 0x80 else None
+        payload = await self._reader.readexactly(length)
+        if mask_key and length:
+            mask = int.from_bytes(mask_key * (length // 4) + mask_key[:length % 4], "little")
+            payload = (int.from_bytes(payload, "little") ^ mask).to_bytes(length, "little")
+        return b1 & 0x0f, payload
+
+    async def send(self, opcode: int, payload: bytes) -> NoReturn:
+        length = len(payload)
+        if length < 0x7e:
+            header = struct.pack("!BB", 0x80 | opcode, length)
+        elif length < 1 << 16:
+            header = struct.pack("!BBH", 0x80 | opcode, 0x7e, length)
+        else:
+            header = struct.pack("!BBQ", 0x80 | opcode, 0x7f, length)
+        self._writer.write(header + payload)
+        await self._writer.drain()
+
+    def close(self) -> NoReturn:
+        self._writer.close()
+        self.released.set()
+
+
+class FakeRouter(object):
+    """runs on the event loop it is started from"""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0) -> None:
+        self.host: str = host
+        self.port: int = port
+        self.registered: int = 0
+        self.deregistered: int = 0
+        self._idle: Optional[asyncio.Queue] = None
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self) -> "FakeRouter":
+        self._idle = asyncio.Queue()
+        self._server = await asyncio.start_server(self._accept, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    @property
+    def uri(self) -> str:
+        return f"ws://{self.host}:{self.port}"
+
+    @property
+    def idle_count(self) -> int:
+        return self._idle.qsize()
+
+    async def _accept(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> NoReturn:
+        try:
+            request_line = (await reader.readline()).decode("latin-1")
+            headers: Dict[str, str] = {}
+            while True:
+                line = (await reader.readline()).decode("latin-1").strip()
+                if not line:
+                    break
+                name, _, value = line.partition(":")
+                headers[name.strip().lower()] = value.strip()
+            accept = base64.b64encode(hashlib.sha1((headers["sec-websocket-key"] + _WS_GUID).encode()).digest())
+            writer.write(b"HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                         b"Sec-WebSocket-Accept: " + accept + b"\r\n\r\n")
+            await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, KeyError):
+            writer.close()
+            return
+        sock = RouterSocket(reader, writer)
+        if request_line.split(" ")[1].startswith("/deregister"):
+            self.deregistered += 1
+            sock.close()
+            return
+        self.registered += 1
+        await self._idle.put(sock)
+        # keep the connection open until a request is done with it
+        await sock.released.wait()
+
+    async def request(self, method: str, dest: str, headers: Optional[Dict[str, str]] = None,
+                      body: Optional[bytes] = None, chunk_size: int = 16384, keep_body: bool = False) -> RouterResponse:
+        """proxies one request through the next idle connector socket"""
+        while True:
+            sock: RouterSocket = await self._idle.get()
+            if not sock.is_closing:
+                break
+        try:
+            header_lines = "".join(f"{name}:{value}\n" for name, value in (headers or {}).items())
+            request_head = f"{method} {dest} HTTP/1.1\n{header_lines}"
+            if body is None:
+                await sock.send(_OPCODE_TEXT, (request_head + RequestHasNoBodyMarker).encode())
+            else:
+                await sock.send(_OPCODE_TEXT, (request_head + RequestBodyPendingMarker).encode())
+                view = memoryview(body)
+                for i in range(0, len(body), chunk_size):
+                    await sock.send(_OPCODE_BINARY, bytes(view[i:i + chunk_size]))
+                await sock.send(_OPCODE_TEXT, RequestBodyEndedMarker.encode())
+            return await self._read_response(sock, keep_body)
+        finally:
+            sock.close()
+
+    @staticmethod
+    async def _read_response(sock: RouterSocket, keep_body: bool) -> RouterResponse:
+        head = ""
+        body_size = 0
+        parts: List[bytes] = []
+        while True:
+            try:
+                opcode, payload = await sock.recv()
+            except (asyncio.IncompleteReadError, ConnectionError):
+                return RouterResponse(head, body_size, b"".join(parts) if keep_body else None, None)
+            if opcode == _OPCODE_TEXT:
+                head = payload.decode("utf-8")
+            elif opcode == _OPCODE_BINARY:
+                body_size += len(payload)
+                if keep_body:
+                    parts.append(payload)
+            elif opcode == _OPCODE_PING:
+                await sock.send(_OPCODE_PONG, payload)
+            elif opcode == _OPCODE_CLOSE:
+                close_code = struct.unpack("!H", payload[:2])[0] if len(payload) >= 2 else None
+                try:
+                    await sock.send(_OPCODE_CLOSE, payload[:2])
+                except ConnectionError:
+                    pass
+                return RouterResponse(head, body_size, b"".join(parts) if keep_body else None, close_code)
+
+    async def close(self) -> NoReturn:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        while not self._idle.empty():
+            self._idle.get_nowait().close()
@@ -0,0 +1,89 @@
+# coding=utf-8
+# author=torchcc
+"""
+a target service for benchmarks:
+    GET  /<anything>?size=n   answers n bytes
+    POST /<anything>?size=n   reads the whole body, answers n bytes
+    &delay=secs               waits before answering
+    &read_delay=secs          waits that long after every megabyte of a POST body, a target slow to take in uploads
+    &etag=tag&max_age=secs    answers with an ETag and Cache-Control: max-age=secs, and 304 to If-None-Match: "tag"
+"""
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import List
+from urllib.parse import urlsplit, parse_qs
+
+_BLOCK = b"\x5a" * (1024 * 1024)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # write whole responses at once, so a small response is not held back by nagle waiting for a delayed ack
+    wbufsize = 1 << 16
+
+    def do_GET(self):
+        self._answer()
+
+    def do_POST(self):
+        read_delay = float(parse_qs(urlsplit(self.path).query).get("read_delay", ["0"])[0])
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            while length:
+                length -= len(self.rfile.read(min(length, len(_BLOCK))))
+                if read_delay:
+                    time.sleep(read_delay)
+        elif self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            while True:
+                size = int(self.rfile.readline().split(b";")[0], 16)
+                self.rfile.read(size + 2)
+                if read_delay and size:
+                    time.sleep(read_delay)
+                if size == 0:
+                    break
+        self._answer()
+
+    def _answer(self):
+        query = parse_qs(urlsplit(self.path).query)
+        size = int(query.get("size", ["2"])[0])
+        if "delay" in query:
+            time.sleep(float(query["delay"][0]))
+        etag = f'"{query["etag"][0]}"' if "etag" in query else None
+        status = 304 if etag is not None and self.headers.get("If-None-Match") == etag else 200
+        self.server.statuses.append(status)
+        self.send_response(status)
+        if etag is not None:
+            self.send_header("ETag", etag)
+            self.send_header("Cache-Control", f"max-age={query.get('max_age', ['0'])[0]}")
+        if status == 304:
+            self.end_headers()
+            self.wfile.flush()
+            return
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(size))
+        self.end_headers()
+        while size:
+            n = min(size, len(_BLOCK))
+            self.wfile.write(_BLOCK[:n])
+            size -= n
+        self.wfile.flush()
+
+    def log_message(self, *args):
+        pass
+
+
+class TargetServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0) -> None:
+        super().__init__((host, port), _Handler)
+        # of every response, in the order they were sent
+        self.statuses: List[int] = []
+
+    @property
+    def uri(self) -> str:
+        return f"http://{self.server_address[0]}:{self.server_port}"
+
+    def start(self) -> "TargetServer":
+        threading.Thread(target=self.serve_forever, name="benchmark-target", daemon=True).start()
+        return self
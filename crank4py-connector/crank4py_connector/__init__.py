@@ -2,6 +2,14 @@
 # author=torchcc
 from .version import version as __version__
 from .connector import ConnInfo, WebsocketClientFarm, create_and_start_connector
-from .intermediate_request import IntermediateRequest
+from .intermediate_request import IntermediateRequest, BodyMemoryBudget
 from .connector_socket import ConnectorSocket
-from .config import Config
+from .config import Config, Engine, AppInterface
+from .aio_connector import AioConnector
+from .metrics import ConnectorMetrics, MetricsRegistry, MetricsServer
+from .supervisor import ConnectorSupervisor
+from .app_target import WSGITargetAdapter, ASGITargetAdapter, create_app_http_client
+from .router_tls import RouterTLSContext, create_router_tls_context
+from .tracing import RequestTracer, TraceExporter, RingBufferExporter, JsonLinesExporter
+from .response_pump import ResponsePump, ResponseReadAhead
+from .multiplexed import Multiplexing
@@ -0,0 +1,311 @@
+# coding=utf-8
+# author=torchcc
+import asyncio
+import struct
+import threading
+import time
+from typing import NoReturn, Optional, Callable, Tuple, List, Union, Dict
+
+from websocket import ABNF, WebSocketException, WebSocketBadStatusException, WebSocketConnectionClosedException, \
+    STATUS_NORMAL
+from websocket._handshake import _get_handshake_headers, _validate
+from websocket._url import parse_url
+from yarl import URL
+
+from crank4py_connector.conn_info_n_ws_client_farm import ConnInfo
+from crank4py_connector.connector import Connector
+from crank4py_connector.connector_socket import ConnectorSocket
+from crank4py_connector.router_tls import RouterTLSContext
+from crank4py_connector.scheduler import Scheduler
+from util import log, get_trust_all_ssl_ctx
+
+
+class AioWebSocket(object):
+    """a minimal websocket client running on asyncio streams, frames are built and masked by websocket.ABNF"""
+
+    def __init__(self, sock_id) -> None:
+        self.sock_id = sock_id
+        self.peername = None
+        self.resp_headers: Dict[str, str] = {}
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+
+    async def connect(self, url: str, header: dict, timeout: float,
+                      router_tls: Optional[RouterTLSContext] = None) -> NoReturn:
+        hostname, port, resource, is_secure = parse_url(url)
+        ssl_ctx = (router_tls or get_trust_all_ssl_ctx()) if is_secure else None
+        self._reader, self._writer = await asyncio.wait_for(
+            asyncio.open_connection(hostname, port, ssl=ssl_ctx, server_hostname=hostname if is_secure else None),
+            timeout)
+        self.peername = self._writer.get_extra_info("peername")
+        headers, key = _get_handshake_headers(resource, hostname, port, {"header": header})
+        self._writer.write("\r\n".join(headers).encode("utf-8"))
+        await asyncio.wait_for(self._handshake(key), timeout)
+        if is_secure and router_tls is not None:
+            router_tls.on_connected(self._writer.get_extra_info("ssl_object"))
+
+    async def _handshake(self, key: str) -> NoReturn:
+        status_line = (await self._reader.readline()).decode("utf-8").strip()
+        status = int(status_line.split(" ")[1])
+        resp_headers = {}
+        while True:
+            line = (await self._reader.readline()).decode("utf-8").strip()
+            if not line:
+                break
+            name, _, value = line.partition(":")
+            resp_headers[name.lower()] = value.strip()
+        if status != 101:
+            raise WebSocketBadStatusException("Handshake status %d %s", status, status_line, resp_headers)
+        success, _ = _validate(resp_headers, key, None)
+        if not success:
+            raise WebSocketException("Invalid WebSocket Header")
+        self.resp_headers = resp_headers
+
+    def getheaders(self) -> Dict[str, str]:
+        """the headers of the upgrade response, names lowercased, like websocket.WebSocket.getheaders()"""
+        return self.resp_headers
+
+    async def recv_frame(self) -> Tuple[int, bytes]:
+        """returns (opcode, payload) of the next message, reassembling fragmented ones"""
+        fragments: List[bytes] = []
+        msg_opcode = None
+        while True:
+            try:
+                b1, b2 = await self._reader.readexactly(2)
+            except asyncio.IncompleteReadError:
+                raise WebSocketConnectionClosedException("Connection to remote host was lost.")
+            fin, opcode, length = b1 >> 7, b1 & 0x0f, b2 & 0x7f
+            if length == 0x7e:
+                length = struct.unpack("!H", await self._reader.readexactly(2))[0]
+            elif length == 0x7f:
+                length = struct.unpack("!Q", await self._reader.readexactly(8))[0]
+            mask_key = await self._reader.readexactly(4) if b2 >> 7 else None
+            payload = await self._reader.readexactly(length) if length else b""
+            if mask_key:
+                payload = ABNF.mask(mask_key, payload)
+            if opcode > ABNF.OPCODE_BINARY:
+                # control frames may be interleaved with fragments of a data message
+                return opcode, payload
+            if opcode != ABNF.OPCODE_CONT:
+                msg_opcode = opcode
+            fragments.append(payload)
+            if fin:
+                return msg_opcode, fragments[0] if len(fragments) == 1 else b"".join(fragments)
+
+    async def send(self, payload: Union[str, bytes], opcode: int = ABNF.OPCODE_TEXT) -> NoReturn:
+        await self.send_frame(ABNF.create_frame(payload, opcode).format())
+
+    async def send_frame(self, frame: bytes) -> NoReturn:
+        if self._writer is None or self._writer.is_closing():
+            raise WebSocketConnectionClosedException("socket is already closed.")
+        self._writer.write(frame)
+        await self._writer.drain()
+
+    def close(self) -> NoReturn:
+        if self._writer is not None:
+            self._writer.close()
+
+
+class AioConnectorSocket(ConnectorSocket):
+    """
+    a ConnectorSocket whose websocket lives on the connector's event loop.
+    the cranker protocol handling is inherited, only the transport is replaced. target requests are still
+    executed by IntermediateRequest, on the scheduler's target lane, and their send/close calls are
+    marshalled back onto the loop.
+    """
+    _close_timeout: float = 3
+
+    def __init__(self, src_uri: URL, target_uri: URL, conn_info: ConnInfo, ws_clien_farm, component_name: str,
+                 scheduler: Scheduler, loop: asyncio.AbstractEventLoop, **kwargs):
+        super().__init__(src_uri, target_uri, conn_info, ws_clien_farm, component_name, scheduler, **kwargs)
+        self._loop = loop
+        self.keep_running = False
+        self.last_ping_tm = 0
+        self.last_pong_tm = 0
+
+    async def run(self, connect_timeout: float, on_open: Callable, on_teardown: Callable) -> NoReturn:
+        if self.sock:
+            raise WebSocketException("socket is already opened")
+        self.keep_running = True
+        try:
+            self.sock = AioWebSocket(self.sock_id)
+            await self.sock.connect(self.url, self.header, connect_timeout, self._router_tls)
+            on_open(self)
+            self._callback(self.on_open)
+            while self.keep_running:
+                op_code, data = await self.sock.recv_frame()
+                if op_code == ABNF.OPCODE_CLOSE:
+                    return self._teardown(data)
+                elif op_code == ABNF.OPCODE_PING:
+                    await self.sock.send(data, ABNF.OPCODE_PONG)
+                elif op_code == ABNF.OPCODE_PONG:
+                    self.last_pong_tm = time.time()
+                elif op_code == ABNF.OPCODE_TEXT:
+                    self._callback(self.on_message, data.decode("utf-8"))
+                else:
+                    self._callback(self.on_message, data)
+                    await self._wait_for_body_stream()
+            self._teardown()
+        except (Exception, asyncio.CancelledError) as e:
+            if self.sock is not None:
+                # no error to report once the socket was torn down on purpose
+                self._callback(self.on_error, e)
+                self._teardown()
+        finally:
+            on_teardown(self)
+
+    async def _wait_for_body_stream(self) -> NoReturn:
+        """stop reading the router socket until the target has taken in the buffered request body"""
+        stream = self.req_to_target.body_stream if self.req_to_target is not None else None
+        if stream is not None and stream.is_full():
+            drained = self._loop.create_future()
+            stream.on_drain(lambda: self._loop.call_soon_threadsafe(
+                lambda: drained.done() or drained.set_result(None)))
+            self._reader_parked = True
+            try:
+                await drained
+            finally:
+                self._reader_resumed_tm = time.time()
+                self._reader_parked = False
+
+    def _teardown(self, close_data: Optional[bytes] = None) -> NoReturn:
+        if self.sock is None:
+            return
+        self.keep_running = False
+        self.sock.close()
+        close_frame = ABNF(1, 0, 0, 0, ABNF.OPCODE_CLOSE, 0, close_data) if close_data else None
+        self._callback(self.on_close, *self._get_close_args(close_frame))
+        self.sock = None
+
+    async def ping(self) -> NoReturn:
+        if self.sock is not None and self.keep_running:
+            self.last_ping_tm = time.time()
+            await self.sock.send(b"", ABNF.OPCODE_PING)
+
+    def send_heartbeat(self) -> NoReturn:
+        """called on the loop by the connector's Heartbeat"""
+        if self.sock is not None and self.keep_running:
+            self._loop.create_task(self.ping())
+
+    def abort(self, reason: str) -> NoReturn:
+        log.info(f"aborting websocket {self.sock_id} to {self.register_uri}: {reason}")
+        self._teardown()
+
+    def _in_loop(self) -> bool:
+        try:
+            return asyncio.get_running_loop() is self._loop
+        except RuntimeError:
+            return False
+
+    def _call_in_loop(self, coro) -> NoReturn:
+        if self._in_loop():
+            self._loop.create_task(coro)
+        else:
+            asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    def send(self, data, opcode=ABNF.OPCODE_TEXT) -> NoReturn:
+        """called from the target executor; blocks until the frame is handed to the transport"""
+        if self.sock is None:
+            raise WebSocketConnectionClosedException("Connection is already closed.")
+        self._call_in_loop(self.sock.send(data, opcode))
+
+    def send_raw_frame(self, frame: memoryview) -> NoReturn:
+        if self.sock is None:
+            raise WebSocketConnectionClosedException("Connection is already closed.")
+        # the transport may keep hold of what it could not write yet, while the pump refills its buffer
+        self._call_in_loop(self.sock.send_frame(bytes(frame)))
+
+    def close(self, status=STATUS_NORMAL, reason=b"", **kwargs) -> NoReturn:
+        async def send_close():
+            if self.sock is not None:
+                self.keep_running = False
+                try:
+                    await self.sock.send(struct.pack("!H", status) + reason, ABNF.OPCODE_CLOSE)
+                    # the router answers with its own close frame, do not wait for it forever
+                    self._loop.call_later(self._close_timeout, self._teardown)
+                except Exception as e:
+                    log.debug(f"failed to send close frame to router, sockId={self.sock_id}, err: {e}")
+                    self._teardown()
+        self._call_in_loop(send_close())
+
+    def _run_later(self, delay_secs: float, task: Callable) -> NoReturn:
+        self._loop.call_soon_threadsafe(self._loop.call_later, delay_secs, task)
+
+    def _submit_req_to_target(self) -> NoReturn:
+        # never run the target call on the loop, it would stall every other router socket
+        self._loop.run_in_executor(self.scheduler.target, self._send_req_to_target)
+
+    def on_websocket_binary(self, payload: bytes) -> NoReturn:
+        if payload:
+            self.metrics.req_bytes.inc(len(payload))
+            # never block the loop, run() parks this socket instead while the body stream is full
+            self.req_to_target.add_body_part(payload, block=False)
+
+    def _peername(self):
+        return self.sock.peername
+
+
+class AioConnector(Connector):
+    """runs every router socket of the connector on a single asyncio event loop"""
+
+    _connect_timeout: float = 10
+    # how long shutdown() waits for the routers to close the deregistration sockets before it stops the loop
+    _deregister_timeout: float = 5
+
+    def __init__(self, *args, **kwargs) -> None:
+        self._loop: asyncio.AbstractEventLoop = asyncio.new_event_loop()
+        self._loop_thread: Optional[threading.Thread] = None
+        super().__init__(*args, **kwargs)
+
+    def _call_later(self, delay_secs: float, task: Callable) -> NoReturn:
+        # the heartbeat runs on the loop, like everything else touching the sockets
+        self._loop.call_soon_threadsafe(self._loop.call_later, delay_secs, task)
+
+    def start(self) -> NoReturn:
+        if not self._loop.is_running():
+            started = threading.Event()
+            self._loop_thread = threading.Thread(target=self._run_loop, args=(started,), name="crank4py-aio-loop",
+                                                 daemon=True)
+            self._loop_thread.start()
+            started.wait()
+        super().start()
+
+    def shutdown(self) -> NoReturn:
+        super().shutdown()
+        # the deregistration sockets run on the loop, it is stopped once the routers closed them
+        self.wait_deregistered(self._deregister_timeout)
+        self._stop_loop()
+
+    def _stop_loop(self) -> NoReturn:
+        """cancels what still runs on the loop, e.g. sockets the routers did not close, then stops and closes it"""
+        if self._loop_thread is None:
+            return
+
+        async def cancel_tasks():
+            tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        try:
+            asyncio.run_coroutine_threadsafe(cancel_tasks(), self._loop).result(AioConnectorSocket._close_timeout)
+        except Exception as e:
+            log.warning(f"can not cancel the sockets left on the event loop, err: {e}")
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._loop_thread.join()
+        self._loop_thread = None
+        self._loop.close()
+
+    def _run_loop(self, started: threading.Event) -> NoReturn:
+        asyncio.set_event_loop(self._loop)
+        self._loop.call_soon(started.set)
+        self._loop.run_forever()
+
+    def _create_socket(self, register_uri: URL, conn_info: ConnInfo, headers: dict) -> ConnectorSocket:
+        return AioConnectorSocket(register_uri, self._target_uri, conn_info, self._ws_client_farm,
+                                  self._component_name, self.scheduler, self._loop, headers=headers,
+                                  **self._socket_options(register_uri))
+
+    def _run_socket(self, sock: AioConnectorSocket) -> NoReturn:
+        asyncio.run_coroutine_threadsafe(
+            sock.run(self._connect_timeout, self.heartbeat.add, self.heartbeat.discard), self._loop)
@@ -0,0 +1,428 @@
+# coding=utf-8
+# author=torchcc
+import asyncio
+import http.client
+import io
+import itertools
+import queue
+import sys
+import threading
+from concurrent.futures import Future
+from typing import Any, Callable, Iterable, Iterator, List, NoReturn, Optional, Tuple
+from urllib.parse import unquote, urlsplit
+
+from requests import PreparedRequest, Response
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+from urllib3 import HTTPResponse
+
+from util import HttpClient, create_http_client, log
+
+# what a client connected over the loopback interface would look like to the app
+_REMOTE_ADDR = "127.0.0.1"
+
+
+class _ChunksReader(io.RawIOBase):
+    """a raw stream over a sequence of byte chunks, a read returns what is left of one chunk rather than waiting for more"""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._chunk: memoryview = memoryview(b"")
+        self._eof: bool = False
+
+    def _next_chunk(self) -> Optional[bytes]:
+        """the next chunk, None once there are no more"""
+        raise NotImplementedError
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        while not self._chunk:
+            if self._eof:
+                return 0
+            chunk = self._next_chunk()
+            if chunk is None:
+                self._eof = True
+                # the body was read to the end, release the app like a finished http response releases its connection
+                self.close()
+                return 0
+            self._chunk = memoryview(chunk)
+        n = min(len(b), len(self._chunk))
+        b[:n] = self._chunk[:n]
+        self._chunk = self._chunk[n:]
+        return n
+
+
+class _IterableReader(_ChunksReader):
+
+    def __init__(self, chunks: Iterable[bytes], on_close: Optional[Callable[[], Any]] = None) -> None:
+        super().__init__()
+        self._chunks: Iterator[bytes] = iter(chunks)
+        self._on_close: Optional[Callable[[], Any]] = on_close
+
+    def _next_chunk(self) -> Optional[bytes]:
+        return next(self._chunks, None)
+
+    def close(self) -> NoReturn:
+        if not self.closed:
+            super().close()
+            on_close, self._on_close = self._on_close, None
+            if on_close is not None:
+                on_close()
+
+
+def _request_body(request: PreparedRequest) -> Iterator[bytes]:
+    body = request.body
+    if body is None:
+        return iter(())
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    if isinstance(body, (bytes, bytearray)):
+        return iter((bytes(body),))
+    if hasattr(body, "read"):
+        return iter(lambda: body.read(65536), b"")
+    # a streamed body, e.g. IntermediateRequest's BodyStream
+    return iter(body)
+
+
+def _build_response(request: PreparedRequest, adapter: BaseAdapter, status: int, reason: str,
+                    headers: List[Tuple[str, str]], body: _ChunksReader) -> Response:
+    """a requests Response reading its body off the app, like HTTPAdapter builds one reading it off a connection"""
+    raw = HTTPResponse(body=body, headers=headers, status=status, reason=reason, preload_content=False,
+                       decode_content=False, request_method=request.method, request_url=request.url)
+    resp = Response()
+    resp.status_code = status
+    resp.reason = reason
+    resp.headers = CaseInsensitiveDict(raw.headers)
+    resp.encoding = get_encoding_from_headers(resp.headers)
+    resp.raw = raw
+    resp.url = request.url
+    resp.request = request
+    resp.connection = adapter
+    return resp
+
+
+def _server_of(request: PreparedRequest) -> Tuple[str, int, str]:
+    """(host, port, scheme) the request was addressed to"""
+    url = urlsplit(request.url)
+    scheme = url.scheme or "http"
+    return url.hostname or "localhost", url.port or (443 if scheme == "https" else 80), scheme
+
+
+class WSGITargetAdapter(BaseAdapter):
+    """
+    answers requests by calling a wsgi app in the calling thread, instead of sending them to a target over http.
+    the body the app returns is read lazily, chunk by chunk, by whoever reads the response.
+    """
+
+    def __init__(self, app: Callable) -> None:
+        super().__init__()
+        self.app: Callable = app
+
+    def _environ(self, request: PreparedRequest) -> dict:
+        url = urlsplit(request.url)
+        host, port, scheme = _server_of(request)
+        environ = {
+            "REQUEST_METHOD": request.method,
+            "SCRIPT_NAME": "",
+            "PATH_INFO": unquote(url.path, encoding="latin-1") or "/",
+            "QUERY_STRING": url.query,
+            "SERVER_NAME": host,
+            "SERVER_PORT": str(port),
+            "SERVER_PROTOCOL": "HTTP/1.1",
+            "REMOTE_ADDR": _REMOTE_ADDR,
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": scheme,
+            "wsgi.input": io.BufferedReader(_IterableReader(_request_body(request))),
+            # the input ends with the body, whether its length is known or not
+            "wsgi.input_terminated": True,
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False,
+        }
+        for name, value in request.headers.items():
+            key = name.upper().replace("-", "_")
+            if key not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+                key = "HTTP_" + key
+            environ[key] = value
+        return environ
+
+    def send(self, request: PreparedRequest, stream=False, timeout=None, verify=True, cert=None,
+             proxies=None) -> Response:
+        started: List[Tuple[str, List[Tuple[str, str]]]] = []
+        written: List[bytes] = []
+
+        def start_response(status: str, headers: List[Tuple[str, str]], exc_info=None):
+            if exc_info is not None and started:
+                raise exc_info[1].with_traceback(exc_info[2])
+            started[:] = [(status, headers)]
+            return written.append
+
+        result = self.app(self._environ(request), start_response)
+        chunks = iter(result)
+        first: List[bytes] = []
+        try:
+            # an app may call start_response as late as when its first chunk is asked for
+            while not started:
+                chunk = next(chunks, None)
+                if chunk is None:
+                    break
+                first.append(chunk)
+            if not started:
+                raise RuntimeError(f"wsgi app returned without calling start_response for {request.url}")
+        except BaseException:
+            getattr(result, "close", lambda: None)()
+            raise
+        status, headers = started[0]
+        code, _, reason = status.partition(" ")
+
+        def body() -> Iterator[bytes]:
+            flushed = 0
+            for chunk in itertools.chain(first, chunks):
+                # what the app passed to write() while producing this chunk comes first
+                yield from written[flushed:]
+                flushed = len(written)
+                yield chunk
+            yield from written[flushed:]
+
+        return _build_response(request, self, int(code), reason, headers,
+                               _IterableReader(body(), getattr(result, "close", None)))
+
+    def close(self) -> NoReturn:
+        pass
+
+
+class _ASGIExchange(object):
+    """
+    one request to an asgi app running on another thread's loop.
+    the app's receive and send calls are handed to the thread reading the response, which serves them in order:
+    receive() gets the next request body chunk, and send() returns once its message was taken, so an app streaming a
+    large response is held back to the pace of the reader.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, body: Iterator[bytes]) -> None:
+        self._loop: asyncio.AbstractEventLoop = loop
+        self._body: Iterator[bytes] = body
+        self._body_ended: bool = False
+        self._events: "queue.Queue[Tuple[str, Any, Optional[asyncio.Future]]]" = queue.Queue()
+        self._task: Optional[Future] = None
+        # created on the loop, some python versions bind an event to the loop current when it is created
+        self._disconnected: Optional[asyncio.Event] = None
+        self._finished: bool = False
+
+    def start(self, app: Callable, scope: dict) -> NoReturn:
+        self._task = asyncio.run_coroutine_threadsafe(self._run(app, scope), self._loop)
+
+    async def _run(self, app: Callable, scope: dict) -> NoReturn:
+        self._disconnected = asyncio.Event()
+        try:
+            await app(scope, self._receive, self._send)
+            self._events.put(("done", None, None))
+        except BaseException as e:
+            self._events.put(("error", e, None))
+
+    async def _receive(self) -> dict:
+        if self._body_ended:
+            # nothing but the end of the exchange is left to receive
+            await self._disconnected.wait()
+            return {"type": "http.disconnect"}
+        received = self._loop.create_future()
+        self._events.put(("receive", None, received))
+        return await received
+
+    async def _send(self, message: dict) -> NoReturn:
+        if self._disconnected.is_set():
+            raise IOError("the response of the asgi app is no longer read")
+        taken = self._loop.create_future()
+        self._events.put(("send", message, taken))
+        await taken
+
+    def _resolve(self, future: asyncio.Future, value: Any) -> NoReturn:
+        self._loop.call_soon_threadsafe(lambda: future.done() or future.set_result(value))
+
+    def next_message(self) -> Optional[dict]:
+        """the next message the app sends, None once it returned. serves its receive calls meanwhile"""
+        while not self._finished:
+            kind, value, future = self._events.get()
+            if kind == "receive":
+                chunk = next(self._body, None)
+                self._body_ended = chunk is None
+                self._resolve(future, {"type": "http.request", "body": chunk or b"", "more_body": chunk is not None})
+            elif kind == "send":
+                self._resolve(future, None)
+                return value
+            else:
+                self._finished = True
+                if kind == "error":
+                    raise value
+        return None
+
+    def _disconnect(self) -> NoReturn:
+        if self._disconnected is not None:
+            self._disconnected.set()
+
+    def close(self, cancel: bool) -> NoReturn:
+        """
+        tells the app the client went away. cancel stops an app still producing the response, without it an app
+        that sent its whole response can go on, e.g. with background tasks
+        """
+        if self._task is not None and not self._task.done():
+            self._loop.call_soon_threadsafe(self._disconnect)
+            if cancel:
+                self._task.cancel()
+
+
+class _ASGIResponseBody(_ChunksReader):
+
+    def __init__(self, exchange: _ASGIExchange) -> None:
+        super().__init__()
+        self._exchange: _ASGIExchange = exchange
+        self._more_body: bool = True
+
+    def _next_chunk(self) -> Optional[bytes]:
+        while self._more_body:
+            message = self._exchange.next_message()
+            if message is None:
+                return None
+            if message["type"] == "http.response.body":
+                self._more_body = message.get("more_body", False)
+                return message.get("body", b"")
+        return None
+
+    def close(self) -> NoReturn:
+        if not self.closed:
+            super().close()
+            self._exchange.close(cancel=not self._eof)
+
+
+class ASGITargetAdapter(BaseAdapter):
+    """
+    answers requests by calling an asgi app, which runs on an event loop of its own so that it never shares one with
+    the router sockets. the app's lifespan startup runs before its first request, if the app supports it.
+    """
+    _lifespan_timeout_secs: float = 30
+
+    def __init__(self, app: Callable) -> None:
+        super().__init__()
+        self.app: Callable = app
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._lifespan_shutdown: Optional[Callable[[], Any]] = None
+
+    def _ensure_loop(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                thread = threading.Thread(target=loop.run_forever, name="crank4py-asgi-loop", daemon=True)
+                thread.start()
+                self._lifespan_shutdown = asyncio.run_coroutine_threadsafe(
+                    self._lifespan(), loop).result(self._lifespan_timeout_secs)
+                self._loop, self._loop_thread = loop, thread
+            return self._loop
+
+    async def _lifespan(self) -> Optional[Callable[[], Any]]:
+        """sends lifespan.startup to the app, returns how to send it lifespan.shutdown later"""
+        inbox: asyncio.Queue = asyncio.Queue()
+        outbox: asyncio.Queue = asyncio.Queue()
+        scope = {"type": "lifespan", "asgi": {"version": "3.0", "spec_version": "2.0"}, "state": {}}
+
+        async def run():
+            try:
+                await self.app(scope, inbox.get, outbox.put)
+            except BaseException as e:
+                # apps not supporting the lifespan protocol raise on its scope
+                await outbox.put({"type": "lifespan.unsupported", "message": str(e)})
+
+        task = asyncio.ensure_future(run())
+        await inbox.put({"type": "lifespan.startup"})
+        message = await outbox.get()
+        if message["type"] == "lifespan.startup.failed":
+            raise RuntimeError(f"asgi app failed to start: {message.get('message', '')}")
+        if message["type"] != "lifespan.startup.complete":
+            log.debug(f"asgi app does not support lifespan: {message.get('message', '')}")
+            return None
+
+        async def shutdown():
+            await inbox.put({"type": "lifespan.shutdown"})
+            await outbox.get()
+            await task
+        return shutdown
+
+    def _scope(self, request: PreparedRequest) -> dict:
+        url = urlsplit(request.url)
+        host, port, scheme = _server_of(request)
+        return {
+            "type": "http",
+            "asgi": {"version": "3.0", "spec_version": "2.3"},
+            "http_version": "1.1",
+            "method": request.method,
+            "scheme": scheme,
+            "path": unquote(url.path) or "/",
+            "raw_path": (url.path or "/").encode("latin-1"),
+            "query_string": url.query.encode("latin-1"),
+            "root_path": "",
+            "headers": [(name.lower().encode("latin-1"), value.encode("latin-1"))
+                        for name, value in request.headers.items()],
+            "client": (_REMOTE_ADDR, 0),
+            "server": (host, port),
+        }
+
+    def send(self, request: PreparedRequest, stream=False, timeout=None, verify=True, cert=None,
+             proxies=None) -> Response:
+        exchange = _ASGIExchange(self._ensure_loop(), _request_body(request))
+        exchange.start(self.app, self._scope(request))
+        try:
+            start = exchange.next_message()
+            if start is None or start["type"] != "http.response.start":
+                raise RuntimeError(f"asgi app did not start a response for {request.url}")
+        except BaseException:
+            exchange.close(cancel=True)
+            raise
+        status = start["status"]
+        headers = [(name.decode("latin-1"), value.decode("latin-1")) for name, value in start.get("headers", [])]
+        return _build_response(request, self, status, http.client.responses.get(status, ""), headers,
+                               _ASGIResponseBody(exchange))
+
+    def close(self) -> NoReturn:
+        """
+        sends the app lifespan.shutdown, then cancels the requests it is still answering, their readers get an error,
+        and stops its loop
+        """
+        with self._lock:
+            loop, self._loop = self._loop, None
+            thread, self._loop_thread = self._loop_thread, None
+            shutdown, self._lifespan_shutdown = self._lifespan_shutdown, None
+        if loop is None:
+            return
+        if shutdown is not None:
+            try:
+                asyncio.run_coroutine_threadsafe(shutdown(), loop).result(self._lifespan_timeout_secs)
+            except Exception as e:
+                log.warning(f"asgi app did not shut down cleanly, err: {e}")
+
+        async def cancel_exchanges():
+            tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        try:
+            asyncio.run_coroutine_threadsafe(cancel_exchanges(), loop).result(self._lifespan_timeout_secs)
+        except Exception as e:
+            log.warning(f"can not cancel the requests left to the asgi app, err: {e}")
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+
+
+def create_app_http_client(app: Callable, asgi: bool = False) -> HttpClient:
+    """an http client whose every request is answered by app, a wsgi app or, when asgi is True, an asgi one"""
+    client = create_http_client()
+    adapter = ASGITargetAdapter(app) if asgi else WSGITargetAdapter(app)
+    client.mount("http://", adapter)
+    client.mount("https://", adapter)
+    return client
@@ -1,22 +1,42 @@
 # coding=utf-8
 # author=torchcc
+from enum import Enum
 from uuid import uuid4
-from typing import Union, List, NoReturn
+from typing import Union, List, NoReturn, Dict, Optional, Callable
 from yarl import URL
 
+from crank4py_connector.tracing import TraceExporter
+
+
+class Engine(Enum):
+    THREAD = "thread"
+    ASYNCIO = "asyncio"
+
+
+class AppInterface(Enum):
+    WSGI = "wsgi"
+    ASGI = "asgi"
+
 
 class Config(object):
 
     def __init__(self, target_uri: Union[URL, str], target_service_name: str, router_uris: List[Union[URL, str]], component_name: str = "") -> None:
         """
-        :param target_uri: e.g.: http:localhost:10086
+        :param target_uri: e.g.: http:localhost:10086, or unix:///run/gunicorn.sock for a target listening on a unix
+                           domain socket. requests to it look like they are addressed to http://localhost
         :param target_service_name: the path name when routing. e.g.: if the service hosts http://localhost:10086/my-service/ then the service name is "my-service"
         :param router_uris:  the cranker router registration web socket URIs it is going to connect, at least one is needed.
         :param component_name:
         """
         if isinstance(target_uri, str):
             target_uri = URL(target_uri)
+        self.target_unix_socket: Optional[str] = None
+        if target_uri.scheme == "unix":
+            self.target_unix_socket = target_uri.path
+            target_uri = URL("http://localhost")
         self.target_uri = target_uri
+        self.target_app: Optional[Callable] = None
+        self.target_app_interface: AppInterface = AppInterface.WSGI
         self.target_service_name = target_service_name
         self.router_uris: List[URL] = []
         for uri in router_uris:
@@ -29,7 +49,70 @@ class Config(object):
         self.component_name: str = component_name
         self.instance_id: str = str(uuid4())
         self.sliding_window_size: int = 2
+        self.sliding_window_min_size: int = 0
+        self.sliding_window_max_size: int = 0
+        self.sliding_window_scale_down_delay_secs: float = 30
+        self.router_weighting: bool = False
+        self.router_weight_min_share: float = 0.25
+        self.router_weight_max_share: float = 2.0
+        self.router_drain_error_rate: float = 0.5
+        self.router_health_window_secs: float = 30
         self.shutdown_hook_added: bool = False
+        self.engine: Engine = Engine.THREAD
+        self.multiplexed_protocol: bool = False
+        self.mux_stream_window_bytes: int = 1024 * 1024
+        self.mux_stream_window_timeout_secs: float = 60
+        self.req_body_stream_limit: int = 0
+        self.req_body_memory_budget: int = 0
+        self.req_body_spill_threshold: int = 0
+        self.req_body_spill_dir: Optional[str] = None
+        self.resp_chunk_sizes: Dict[str, int] = {}
+        self.resp_read_ahead_bytes: int = 0
+        self.resp_read_ahead_workers: int = 0
+        self.ws_io_workers: int = 0
+        self.target_workers: int = 0
+        self.reconnect_workers: int = 2
+        self.max_queue_size: int = 1024
+        self.target_pool_maxsize: int = 0
+        self.target_pool_idle_timeout_secs: float = 30
+        self.target_tcp_keepalive_secs: int = 0
+        self.target_pool_block: bool = False
+        self.target_prewarm_connections: int = 0
+        self.router_tls_verify: bool = False
+        self.router_ca_file: Optional[str] = None
+        self.router_ca_path: Optional[str] = None
+        self.circuit_failure_threshold: int = 5
+        self.circuit_open_secs: float = 5
+        self.circuit_max_open_secs: float = 60
+        self.ping_interval_secs: float = 5
+        self.ping_timeout_secs: float = 0
+        self.response_cache_max_bytes: int = 0
+        self.response_cache_max_entry_bytes: int = 0
+        self.processes: int = 1
+        self.process_start_method: str = "fork"
+        self.log_level: Union[int, str, None] = None
+        self.access_log_sample_rate: float = 1.0
+        self.log_queue_size: int = 10000
+        self.request_tracing: bool = False
+        self.trace_slow_threshold_secs: float = 1.0
+        self.trace_sample_rate: float = 0.0
+        self.trace_ring_buffer_size: int = 1000
+        self.trace_jsonl_path: Optional[str] = None
+        self.trace_exporters: List[TraceExporter] = []
+        self.metrics_port: Optional[int] = None
+        self.metrics_host: str = "0.0.0.0"
+
+    def set_target_app(self, app: Callable, interface: Union[AppInterface, str] = AppInterface.WSGI) -> NoReturn:
+        """
+        calls an app running in this process for every request, instead of sending the requests to target_uri over
+        http. no http server has to be started for the app, and requests skip the loopback round trip to it.
+        target_uri still gives the host, port and scheme the app sees, e.g. "http://localhost".
+        :param app: a wsgi app, e.g. a flask app, or an asgi app, e.g. a starlette or fastapi app.
+                    wsgi apps run on the connector's worker threads, asgi apps on an event loop of their own
+        :param interface: AppInterface.WSGI (default) or AppInterface.ASGI
+        """
+        self.target_app = app
+        self.target_app_interface = AppInterface(interface)
 
     def set_sliding_window_size(self, sliding_window_size) -> NoReturn:
         """
@@ -37,8 +120,245 @@ class Config(object):
         """
         self.sliding_window_size = sliding_window_size
 
+    def set_sliding_window_autoscale(self, min_size: int, max_size: int, scale_down_delay_secs: float = 30) -> NoReturn:
+        """
+        lets every router's sliding window follow its request rate instead of staying at sliding_window_size.
+        :param min_size: idle sockets kept per router even when there is no traffic
+        :param max_size: upper bound of idle sockets per router during bursts
+        :param scale_down_delay_secs: how long a window has to stay without growing before it gives back a socket
+        """
+        self.sliding_window_min_size = min_size
+        self.sliding_window_max_size = max_size
+        self.sliding_window_scale_down_delay_secs = scale_down_delay_secs
+
+    def set_router_weighting(self, min_share: float = 0.25, max_share: float = 2.0, drain_error_rate: float = 0.5,
+                             window_secs: float = 30) -> NoReturn:
+        """
+        gives healthy routers more of the sliding window than slow or failing ones, by their handshake latency,
+        request completion time and failure rate, instead of the same window for every router.
+        :param min_share: the smallest share of its window a slow router keeps, e.g. 0.25 of sliding_window_size
+        :param max_share: the biggest share of its window a fast router gets
+        :param drain_error_rate: a router whose connects, sockets or requests fail more often than that gets no
+                                 sockets at all until its errors age out. 1 never drains a router
+        :param window_secs: how long a router's errors count against it
+        """
+        self.router_weighting = True
+        self.router_weight_min_share = min_share
+        self.router_weight_max_share = max_share
+        self.router_drain_error_rate = drain_error_rate
+        self.router_health_window_secs = window_secs
+
+    def set_logging(self, level: Union[int, str, None] = None, access_log_sample_rate: float = 1.0,
+                    queue_size: int = 10000) -> NoReturn:
+        """
+        the crank4py-connector logger writes from a background thread, a request never waits for the log output.
+        :param level: e.g. "INFO" or logging.WARNING, DEBUG (default) logs every step of every request
+        :param access_log_sample_rate: the share of requests whose "going to send ... to ..." line is logged,
+                                       e.g. 0.01 for one in a hundred
+        :param queue_size: log records waiting for the log thread before new ones are dropped
+        """
+        self.log_level = level
+        self.access_log_sample_rate = access_log_sample_rate
+        self.log_queue_size = queue_size
+
+    def set_request_tracing(self, slow_threshold_secs: float = 1.0, sample_rate: float = 0.0,
+                            ring_buffer_size: int = 1000, jsonl_path: Optional[str] = None,
+                            exporters: Optional[List[TraceExporter]] = None) -> NoReturn:
+        """
+        traces where the time of every request goes: socket_idle, body_upload, target_connect, target_ttfb and
+        response_stream, see the crank4py_request_phase_seconds metric. the whole breakdown of slow requests is kept.
+        :param slow_threshold_secs: requests taking that long or longer are exported, 0 exports every request
+        :param sample_rate: the share of the other requests exported too, e.g. 0.001
+        :param ring_buffer_size: exported traces kept in memory, see connector.request_traces(). 0 keeps none
+        :param jsonl_path: a file every exported trace is appended to, as a line of json
+        :param exporters: more TraceExporters to hand the exported traces to
+        """
+        self.request_tracing = True
+        self.trace_slow_threshold_secs = slow_threshold_secs
+        self.trace_sample_rate = sample_rate
+        self.trace_ring_buffer_size = ring_buffer_size
+        self.trace_jsonl_path = jsonl_path
+        self.trace_exporters = list(exporters or [])
+
     def set_shutdown_hook_added(self, shutdown_hook_added: bool) -> NoReturn:
         self.shutdown_hook_added = shutdown_hook_added
 
+    def set_engine(self, engine: Union[Engine, str]) -> NoReturn:
+        """
+        :param engine: Engine.THREAD (default) gives every router socket its own threads,
+                       Engine.ASYNCIO runs all router sockets, reconnects and pings on a single event loop
+        """
+        self.engine = Engine(engine)
+
+    def set_multiplexed_protocol(self, stream_window_bytes: int = 1024 * 1024,
+                                 stream_window_timeout_secs: float = 60) -> NoReturn:
+        """
+        offers the routers the multiplexed cranker protocol (3.0). a router accepting it sends many concurrent requests
+        over each socket, instead of one request per socket and handshake, so a sliding window of 1 or 2 sockets per
+        router is enough. routers that do not accept it are served with protocol 1.0 as before.
+        :param stream_window_bytes: response bytes of one request sent to the router and not acknowledged by it yet,
+                                    the response waits once that many are
+        :param stream_window_timeout_secs: how long a response waits for the router to acknowledge its window before
+                                           its stream is reset, 0 or less waits forever
+        """
+        self.multiplexed_protocol = True
+        self.mux_stream_window_bytes = stream_window_bytes
+        self.mux_stream_window_timeout_secs = stream_window_timeout_secs
+
+    def set_req_body_stream_limit(self, req_body_stream_limit: int) -> NoReturn:
+        """
+        :param req_body_stream_limit: 0 (default) buffers a request body fully before calling the target service.
+                                      when > 0 the target request starts as soon as the request headers arrive and
+                                      the body is streamed to it, with at most this many bytes buffered per request
+        """
+        self.req_body_stream_limit = req_body_stream_limit
+
+    def set_req_body_buffer(self, memory_budget: int, spill_threshold: int = 0,
+                            spill_dir: Optional[str] = None) -> NoReturn:
+        """
+        bounds the memory of request bodies buffered before calling the target service, see set_req_body_stream_limit.
+        bodies that do not fit go to a temp file, which is sent to the target and deleted once the request is done.
+        :param memory_budget: bytes of buffered bodies held in memory over all requests of the connector, 0 for no limit.
+                              with several processes, every worker gets its share
+        :param spill_threshold: a body bigger than that goes to a temp file even when the budget has room, 0 for none
+        :param spill_dir: the directory of the temp files, the system temp dir by default
+        """
+        self.req_body_memory_budget = memory_budget
+        self.req_body_spill_threshold = spill_threshold
+        self.req_body_spill_dir = spill_dir
+
+    def set_resp_chunk_size(self, chunk_size: int, path_prefix: str = "") -> NoReturn:
+        """
+        the largest piece of a target response sent to the router in one message, 16KB by default.
+        bigger chunks move large downloads with less overhead, smaller ones keep the router's buffers small.
+        :param chunk_size: bytes per message
+        :param path_prefix: only applies to requests whose path starts with it, e.g. "/service-a/downloads/".
+                            the longest matching prefix wins, "" applies to every request
+        """
+        self.resp_chunk_sizes[path_prefix] = chunk_size
+
+    def set_resp_read_ahead(self, max_bytes: int, workers: int = 0) -> NoReturn:
+        """
+        reads a target response ahead while its earlier chunks are still being sent to the router, so that the target
+        reads and the router writes overlap instead of taking turns. a response that fits in one chunk is sent as before.
+        :param max_bytes: bytes read ahead per response at most, at least two chunks. the reader waits when the router
+                          falls behind. 0 (default) reads and sends in turns
+        :param workers: threads reading ahead, a response coming while all of them are busy is sent in turns.
+                        0 gives every target worker one
+        """
+        self.resp_read_ahead_bytes = max_bytes
+        self.resp_read_ahead_workers = workers
+
+    def set_worker_budget(self, ws_io_workers: int = 0, target_workers: int = 0, reconnect_workers: int = 2,
+                          max_queue_size: int = 1024) -> NoReturn:
+        """
+        the workers shared by all router sockets of a connector
+        :param ws_io_workers: live sockets at most, every one runs its read loop on a thread of its own until it is
+                              closed, also while its request is in flight. 0 (default) for no cap
+        :param target_workers: threads running target requests that are fired off the read loops, which caps the requests
+                               served at once. a request holds its worker until its response is sent, so slow
+                               downloads need more of them, the requests coming while all are busy wait in the queue.
+                               0 (default) gives one to every idle socket the sliding windows of all routers can
+                               have, at least min(32, cpu + 4)
+        :param reconnect_workers: threads running delayed and replacement connects
+        :param max_queue_size: tasks allowed to wait for a busy lane before submissions are rejected, 0 for unbounded
+        """
+        self.ws_io_workers = ws_io_workers
+        self.target_workers = target_workers
+        self.reconnect_workers = reconnect_workers
+        self.max_queue_size = max_queue_size
+
+    def set_target_pool(self, pool_maxsize: int = 0, idle_timeout_secs: float = 30, tcp_keepalive_secs: int = 0,
+                        pool_block: bool = False) -> NoReturn:
+        """
+        the keep-alive connections kept open to the target service
+        :param pool_maxsize: idle connections kept per target host. 0 (default) keeps one for every target worker, see
+                             set_worker_budget, which grows with the number of routers and the sliding window
+        :param idle_timeout_secs: closes a kept connection once it was idle that long, keep it below the keep-alive
+                                  timeout of the target so that a connection is never reused while the target closes it.
+                                  0 never closes idle connections
+        :param tcp_keepalive_secs: > 0 turns on tcp keepalive probes on target connections after that many idle seconds
+        :param pool_block: wait for a kept connection instead of opening an extra one once pool_maxsize are in use
+        """
+        self.target_pool_maxsize = pool_maxsize
+        self.target_pool_idle_timeout_secs = idle_timeout_secs
+        self.target_tcp_keepalive_secs = tcp_keepalive_secs
+        self.target_pool_block = pool_block
 
+    def set_target_prewarm(self, connections: int) -> NoReturn:
+        """
+        opens connections to the target service while the connector connects to the routers, so that the first
+        requests find them open. connector.ready() and wait_until_ready() also wait for them.
+        :param connections: connections to open, at most the target pool keeps. with several processes, every worker
+                            opens that many
+        """
+        self.target_prewarm_connections = connections
 
+    def set_router_tls(self, verify: bool = True, ca_file: Optional[str] = None,
+                       ca_path: Optional[str] = None) -> NoReturn:
+        """
+        how wss routers are trusted. by default any router certificate is accepted.
+        every router gets one tls context shared by all its sockets, and reconnects resume the tls session of the
+        last socket instead of doing a full handshake, see connector.tls_stats()
+        :param verify: verifies the certificate and host name of the routers
+        :param ca_file: a pem bundle of the CAs to trust, the system CAs when neither ca_file nor ca_path are given
+        :param ca_path: a directory of hashed CA certificates to trust
+        """
+        self.router_tls_verify = verify
+        self.router_ca_file = ca_file
+        self.router_ca_path = ca_path
+
+    def set_reconnect_circuit_breaker(self, failure_threshold: int = 5, open_secs: float = 5,
+                                      max_open_secs: float = 60) -> NoReturn:
+        """
+        stops reconnecting to a router that keeps refusing connections, so a restarting router is not hammered by
+        every socket of every connector at once.
+        :param failure_threshold: failed connects in a row to a router that open its circuit. 0 never opens it
+        :param open_secs: how long the circuit stays open before a single socket probes the router
+        :param max_open_secs: upper bound of the open time, which grows every time a probe fails
+        """
+        self.circuit_failure_threshold = failure_threshold
+        self.circuit_open_secs = open_secs
+        self.circuit_max_open_secs = max_open_secs
+
+    def set_heartbeat(self, ping_interval_secs: float = 5, ping_timeout_secs: float = 0) -> NoReturn:
+        """
+        every router socket is pinged by one connector wide heartbeat.
+        :param ping_interval_secs: seconds between two pings of a socket, 0 never pings
+        :param ping_timeout_secs: > 0 closes and replaces a socket whose pong did not arrive within that many seconds,
+                                  it has to be shorter than ping_interval_secs. 0 (default) never times out
+        """
+        self.ping_interval_secs = ping_interval_secs
+        self.ping_timeout_secs = ping_timeout_secs
+
+    def set_response_cache(self, max_bytes: int, max_entry_bytes: int = 0) -> NoReturn:
+        """
+        answers GET requests from a cache of target responses, following their Cache-Control, Expires, ETag and
+        Last-Modified headers like a shared http cache. stale responses are revalidated with a conditional request.
+        :param max_bytes: bytes of responses kept at most, the least recently used ones are evicted first. 0 disables
+        :param max_entry_bytes: bigger responses are not cached, 0 (default) is max_bytes / 16
+        """
+        self.response_cache_max_bytes = max_bytes
+        self.response_cache_max_entry_bytes = max_entry_bytes
+
+    def set_processes(self, processes: int, start_method: str = "fork") -> NoReturn:
+        """
+        runs the connector in several processes, to use more than one core.
+        :param processes: > 1 makes create_and_start_connector return a ConnectorSupervisor, which starts that many
+                          worker processes. each one registers with every router under its own instance id,
+                          <instance_id>-<n>, and gets 1/processes of the sliding window
+        :param start_method: the multiprocessing start method of the workers. with "spawn" or "forkserver" the code
+                             creating the connector has to be guarded by if __name__ == "__main__"
+        """
+        self.processes = processes
+        self.process_start_method = start_method
+
+    def set_metrics_port(self, metrics_port: int, metrics_host: str = "0.0.0.0") -> NoReturn:
+        """
+        serves the connector metrics in the prometheus text format on http://metrics_host:metrics_port/metrics.
+        they are also available as connector.metrics.to_prometheus_text() without an endpoint.
+        :param metrics_port: 0 picks a free port
+        :param metrics_host: the interface to listen on
+        """
+        self.metrics_port = metrics_port
+        self.metrics_host = metrics_host
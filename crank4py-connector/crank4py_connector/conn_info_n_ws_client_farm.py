@@ -1,28 +1,137 @@
 # coding=utf-8
 # author=torchcc
 import math
-from typing import NoReturn, Dict
+import random
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, NoReturn, Dict, Set, List, Optional, Tuple
 
 from yarl import URL
 
 from util import log
 
 
+class RouterCircuitBreaker(object):
+    """
+    stops the sockets of a router from reconnecting while the router keeps refusing them.
+    after failure_threshold connects in a row failed the circuit opens: failed sockets are dropped instead of being
+    replaced, and only the socket that opened it tries again, after open_secs (half open). once that probe connects
+    the circuit closes and on_close refills the window, if it fails the circuit stays open for longer, up to
+    max_open_secs.
+    clock and rng stand in for time.monotonic and the random module, in tests.
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = 5, open_secs: float = 5, max_open_secs: float = 60,
+                 on_close: Optional[Callable[[], None]] = None, clock: Callable[[], float] = time.monotonic,
+                 rng: Optional[random.Random] = None) -> None:
+        self.failure_threshold: int = failure_threshold
+        self.open_secs: float = open_secs
+        self.max_open_secs: float = max_open_secs
+        self.on_close: Optional[Callable[[], None]] = on_close
+        self._clock: Callable[[], float] = clock
+        self._uniform: Callable[[float, float], float] = (rng or random).uniform
+        self._lock = threading.Lock()
+        self._state: str = self.CLOSED
+        self._failures: int = 0
+        self._cur_open_secs: float = 0
+        self._probe_at: float = 0
+        self._prober: Optional["ConnInfo"] = None
+
+    @property
+    def state(self) -> str:
+        if self._state == self.OPEN and self._clock() >= self._probe_at:
+            return self.HALF_OPEN
+        return self._state
+
+    @property
+    def is_closed(self) -> bool:
+        return self._state == self.CLOSED
+
+    def on_connect_failed(self, conn_info: "ConnInfo") -> Optional[float]:
+        """
+        counts a connect of conn_info that failed.
+        :return: None when conn_info must not reconnect, else the secs it has to wait at least
+        """
+        with self._lock:
+            if self._state == self.CLOSED:
+                self._failures += 1
+                if self._failures < self.failure_threshold:
+                    return 0
+                self._prober = conn_info
+                log.warning(f"circuit to router {conn_info.router_uri} opened after {self._failures} failed connects")
+            elif conn_info is not self._prober:
+                return None
+            # decorrelated jitter, so that the probes of a fleet of connectors do not line up
+            self._cur_open_secs = min(self.max_open_secs,
+                                      self._uniform(self.open_secs, max(self.open_secs, self._cur_open_secs * 3)))
+            self._state = self.OPEN
+            self._probe_at = self._clock() + self._cur_open_secs
+            return self._cur_open_secs
+
+    def may_reconnect(self, conn_info: "ConnInfo") -> bool:
+        """whether a socket that lost its connection may be replaced"""
+        return self._state == self.CLOSED or conn_info is self._prober
+
+    def on_connected(self) -> NoReturn:
+        with self._lock:
+            self._failures = 0
+            if self._state == self.CLOSED:
+                return
+            self._state = self.CLOSED
+            self._cur_open_secs = 0
+            self._prober = None
+        log.info("circuit to router closed, refilling its sliding window")
+        if self.on_close is not None:
+            self.on_close()
+
+
 class ConnInfo(object):
+    _base_retry_millis: int = 500
+    _max_retry_millis: int = 10000
 
-    def __init__(self, router_uri: URL, conn_idx: int) -> None:
+    def __init__(self, router_uri: URL, conn_idx: int, breaker: Optional[RouterCircuitBreaker] = None,
+                 rng: Optional[random.Random] = None) -> None:
         self.router_uri: URL = router_uri
         self._conn_idx: int = conn_idx
         self._cur_conn_attempts: int = 0
+        self._retry_after_millis: float = self._base_retry_millis
+        self.breaker: Optional[RouterCircuitBreaker] = breaker
+        self._uniform: Callable[[float, float], float] = (rng or random).uniform
+        self.conn_started_at: float = time.monotonic()
 
     def on_connected_successfully(self) -> NoReturn:
         self._cur_conn_attempts = 0
+        self._retry_after_millis = self._base_retry_millis
+        if self.breaker is not None:
+            self.breaker.on_connected()
 
     def on_conn_starting(self) -> NoReturn:
         self._cur_conn_attempts += 1
+        self.conn_started_at = time.monotonic()
 
     def retry_after_millis(self) -> int:
-        return 500 + min(10000, int(math.pow(2, self._cur_conn_attempts)))
+        """decorrelated jitter: a random delay between the base and 3 times the previous one, capped"""
+        self._retry_after_millis = min(self._max_retry_millis, self._uniform(self._base_retry_millis,
+                                                                            self._retry_after_millis * 3))
+        return int(self._retry_after_millis)
+
+    def reconnect_after_millis(self, connect_failed: bool) -> Optional[int]:
+        """
+        the millis to wait before replacing a socket that failed.
+        :param connect_failed: the socket never connected, as opposed to having lost its connection
+        :return: None when the router's circuit is open and the socket must not be replaced
+        """
+        delay = self.retry_after_millis()
+        if self.breaker is None:
+            return delay
+        if not connect_failed:
+            return delay if self.breaker.may_reconnect(self) else None
+        hold_secs = self.breaker.on_connect_failed(self)
+        return None if hold_secs is None else max(delay, int(hold_secs * 1000))
 
     def __str__(self) -> str:
         return "ConnectionInfo{" + \
@@ -34,25 +143,341 @@ class ConnInfo(object):
     __repr__ = __str__
 
 
+class SlidingWindowAutoscale(object):
+    """
+    bounds of an autoscaling sliding window.
+    the window of a router grows as soon as its idle sockets run out or its request rate asks for more, and shrinks
+    one socket at a time only after scale_down_delay_secs without growing, so a bursty router does not flap.
+    """
+
+    # seconds a consumed socket needs to be replaced (reconnect + handshake), idle sockets have to cover it
+    refill_secs: float = 1.0
+    # time constant of the exponentially decayed request rate
+    rate_window_secs: float = 10.0
+
+    def __init__(self, min_size: int, max_size: int, scale_down_delay_secs: float = 30) -> None:
+        if not 0 < min_size <= max_size:
+            raise ValueError("sliding window bounds must satisfy 0 < min_size <= max_size")
+        self.min_size: int = min_size
+        self.max_size: int = max_size
+        self.scale_down_delay_secs: float = scale_down_delay_secs
+
+
+class RouterHealthWeighting(object):
+    """
+    bounds of the weighting of sliding windows by router health.
+    every router is scored by its handshake latency, its request completion time and the rate of its failed connects,
+    websocket errors and aborted requests. its window is the base window (fixed or autoscaled) times its score relative
+    to the mean of all routers, clamped to [min_share, max_share] of the base window, so sockets, and with them
+    requests, move towards the healthy routers. a router failing more than drain_error_rate of the time is drained to
+    no sockets at all, unless every router is, and gets its share back as its errors age out over window_secs.
+    """
+
+    # weight of a new latency or error sample in the moving averages
+    sample_weight: float = 0.2
+
+    def __init__(self, min_share: float = 0.25, max_share: float = 2.0, drain_error_rate: float = 0.5,
+                 window_secs: float = 30) -> None:
+        if not 0 <= min_share <= 1 <= max_share:
+            raise ValueError("router weighting bounds must satisfy 0 <= min_share <= 1 <= max_share")
+        self.min_share: float = min_share
+        self.max_share: float = max_share
+        self.drain_error_rate: float = drain_error_rate
+        self.window_secs: float = window_secs
+
+
+class _RouterHealth(object):
+
+    def __init__(self) -> None:
+        self.handshake_secs: Optional[float] = None
+        self.req_secs: Optional[float] = None
+        self._error_rate: float = 0.0
+        self._errors_updated_at: float = time.monotonic()
+
+    @staticmethod
+    def _average(current: Optional[float], sample: float, weight: float) -> float:
+        return sample if current is None else current + weight * (sample - current)
+
+    def observe_handshake(self, secs: float, weight: float) -> NoReturn:
+        self.handshake_secs = self._average(self.handshake_secs, secs, weight)
+
+    def observe_request(self, secs: float, weight: float) -> NoReturn:
+        self.req_secs = self._average(self.req_secs, secs, weight)
+
+    def observe_outcome(self, ok: bool, weight: float, window_secs: float) -> NoReturn:
+        now = time.monotonic()
+        rate = self.error_rate(now, window_secs)
+        self._error_rate = rate + weight * ((0.0 if ok else 1.0) - rate)
+        self._errors_updated_at = now
+
+    def error_rate(self, now: float, window_secs: float) -> float:
+        """fades out while nothing happens, so a drained router gets to try again"""
+        return self._error_rate * math.exp(-(now - self._errors_updated_at) / window_secs)
+
+
+class _RouterWindow(object):
+
+    def __init__(self, size: int) -> None:
+        self.size: int = size
+        self.rate: float = 0.0
+        self.rate_updated_at: float = time.monotonic()
+        self.grown_at: float = 0.0
+        self.health: _RouterHealth = _RouterHealth()
+
+    def decayed_rate(self, now: float, rate_window_secs: float) -> float:
+        return self.rate * math.exp(-(now - self.rate_updated_at) / rate_window_secs)
+
+
+def max_window_size(sliding_window_size: int, autoscale: Optional[SlidingWindowAutoscale] = None,
+                    weighting: Optional[RouterHealthWeighting] = None) -> int:
+    """the most idle sockets a router may have, each of them can take a request at the same time"""
+    size = autoscale.max_size if autoscale else sliding_window_size * 2
+    if weighting is not None:
+        size = max(size, math.ceil((autoscale.max_size if autoscale else sliding_window_size) * weighting.max_share))
+    return size
+
+
 class WebsocketClientFarm(object):
 
-    def __init__(self, sliding_window_size: int) -> None:
+    def __init__(self, sliding_window_size: int, autoscale: Optional[SlidingWindowAutoscale] = None,
+                 weighting: Optional[RouterHealthWeighting] = None) -> None:
         self._max_slding_window_size = sliding_window_size * 2
-        self._connector_socks: Dict[str, int] = dict()
+        self._sliding_window_size = sliding_window_size
+        self._autoscale = autoscale
+        self._weighting = weighting
+        self._connector_socks: Dict[str, Set] = dict()
+        self._windows: Dict[str, _RouterWindow] = dict()
+        self._lock = threading.Lock()
+        # sockets serving requests, and how many, from the moment the router sends one until its response ended or
+        # was cut off
+        self._in_flight: Dict[Any, int] = {}
+        self._released: int = 0
+        self._in_flight_changed = threading.Condition(self._lock)
+        # futures waiting for a number of connected idle sockets, see when_connected
+        self._connected_waiters: List[Tuple[int, Future]] = []
+        self._first_connected_at: Dict[str, float] = {}
+
+    def add_ws(self, register_uri: str, sock) -> NoReturn:
+        with self._lock:
+            self._connector_socks.setdefault(register_uri, set()).add(sock)
+        log.debug("add websocket for registerUrl=%s, current websocketClientFarm=%s", register_uri, self)
+
+    def remove_ws(self, register_uri: str, sock) -> NoReturn:
+        with self._lock:
+            self._connector_socks.get(register_uri, set()).discard(sock)
+
+    def consume_ws(self, register_uri: str, sock) -> NoReturn:
+        """an idle socket was taken by the router to serve a request"""
+        self.remove_ws(register_uri, sock)
+        self.hold_ws(sock)
+        if self._autoscale is None:
+            return
+        now = time.monotonic()
+        with self._lock:
+            window = self._window(register_uri)
+            window.rate = window.decayed_rate(now, self._autoscale.rate_window_secs) + \
+                1 / self._autoscale.rate_window_secs
+            window.rate_updated_at = now
+            if not self._connector_socks.get(register_uri) and window.size < self._autoscale.max_size:
+                # the router ran out of idle sockets, requests are waiting for a reconnect, grow right away
+                window.size = min(self._autoscale.max_size, window.size + max(1, window.size // 2))
+                window.grown_at = now
+                log.info(f"no idle websocket left for registerUrl={register_uri}, growing sliding window to {window.size}")
+
+    def hold_ws(self, sock) -> NoReturn:
+        """
+        a socket started serving a request. a consumed socket serves one, a multiplexed socket stays idle and
+        serves any number of them at once
+        """
+        with self._lock:
+            self._in_flight[sock] = self._in_flight.get(sock, 0) + 1
 
-    def add_ws(self, register_uri: str) -> NoReturn:
-        if register_uri not in self._connector_socks:
-            self._connector_socks[register_uri] = 0
-        self._connector_socks[register_uri] += 1
-        log.debug(f"add websocket for registerUrl={register_uri}, current websocketClientFarm={self}")
+    def release_ws(self, sock) -> NoReturn:
+        """a request a socket was serving ended, whether it completed or not"""
+        with self._in_flight_changed:
+            held = self._in_flight.get(sock)
+            if held is not None:
+                if held > 1:
+                    self._in_flight[sock] = held - 1
+                else:
+                    del self._in_flight[sock]
+                self._released += 1
+                self._in_flight_changed.notify_all()
 
-    def remove_ws(self, register_uri: str) -> NoReturn:
-        self._connector_socks[register_uri] -= 1
+    def in_flight_socks(self) -> List:
+        with self._lock:
+            return list(self._in_flight)
+
+    def in_flight_requests(self) -> int:
+        with self._lock:
+            return sum(self._in_flight.values())
+
+    @property
+    def released(self) -> int:
+        """requests ended so far"""
+        return self._released
+
+    def wait_no_in_flight(self, timeout: float) -> bool:
+        """waits up to timeout secs for every request in flight to end, returns whether they all did"""
+        with self._in_flight_changed:
+            return self._in_flight_changed.wait_for(lambda: not self._in_flight, timeout)
 
     def is_safe_to_add_ws(self, register_uri: URL) -> bool:
         is_not_deregiste_path = not register_uri.path.startswith("/deregister")
-        idle_sock_num = self._connector_socks.get(str(register_uri), 0)
+        idle_sock_num = len(self._connector_socks.get(str(register_uri), ()))
+        if self._autoscale is not None or self._weighting is not None:
+            return is_not_deregiste_path and self.window_size(str(register_uri)) > idle_sock_num
         return is_not_deregiste_path and self._max_slding_window_size > idle_sock_num
 
+    def window_size(self, register_uri: str) -> int:
+        with self._lock:
+            window = self._window(register_uri)
+            if self._weighting is None:
+                return window.size
+            share = self._health_shares(time.monotonic()).get(register_uri, 1.0)
+            return 0 if share == 0 else max(1, round(window.size * share))
+
+    def _health_shares(self, now: float) -> Dict[str, float]:
+        """the share of its base window every router gets, from its health relative to the others"""
+        w = self._weighting
+        # a router without samples of a kind yet is neither faster nor slower than the others at it
+        handshake = self._relative_speeds({uri: window.health.handshake_secs for uri, window in self._windows.items()})
+        req = self._relative_speeds({uri: window.health.req_secs for uri, window in self._windows.items()})
+        scores: Dict[str, float] = {}
+        drained: Set[str] = set()
+        for uri, window in self._windows.items():
+            error_rate = window.health.error_rate(now, w.window_secs)
+            if error_rate > w.drain_error_rate:
+                drained.add(uri)
+            scores[uri] = (1 - error_rate) * handshake.get(uri, 1.0) * req.get(uri, 1.0)
+        if len(drained) == len(self._windows):
+            # draining every router would leave no socket to find out that one recovered
+            drained = set()
+        mean = sum(scores.values()) / len(scores) if scores else 0
+        shares = {uri: max(w.min_share, min(w.max_share, score / mean)) if mean > 0 else 1.0
+                  for uri, score in scores.items()}
+        shares.update((uri, 0.0) for uri in drained)
+        return shares
+
+    @staticmethod
+    def _relative_speeds(latencies: Dict[str, Optional[float]]) -> Dict[str, float]:
+        """mean latency / latency of every router with a latency, > 1 for the faster ones"""
+        known = {uri: max(secs, 0.001) for uri, secs in latencies.items() if secs is not None}
+        mean = sum(known.values()) / len(known) if known else 0
+        return {uri: mean / secs for uri, secs in known.items()}
+
+    def on_handshake(self, register_uri: str, secs: float) -> NoReturn:
+        """a socket to the router connected, secs after it started connecting"""
+        with self._lock:
+            # deregistration sockets do not count, they are never added to the farm
+            if register_uri in self._connector_socks:
+                self._first_connected_at.setdefault(register_uri, time.monotonic())
+            if self._weighting is not None and register_uri in self._windows:
+                health = self._windows[register_uri].health
+                health.observe_handshake(secs, self._weighting.sample_weight)
+                health.observe_outcome(True, self._weighting.sample_weight, self._weighting.window_secs)
+            satisfied = self._pop_connected_waiters()
+        for future in satisfied:
+            future.set_result(True)
+
+    def _connected_count(self) -> int:
+        return sum(1 for socks in self._connector_socks.values() for sock in socks if sock.connected)
+
+    def _pop_connected_waiters(self) -> List[Future]:
+        if not self._connected_waiters:
+            return []
+        connected = self._connected_count()
+        satisfied = [future for min_socks, future in self._connected_waiters if connected >= min_socks]
+        self._connected_waiters = [(n, future) for n, future in self._connected_waiters if connected < n]
+        return satisfied
+
+    def when_connected(self, min_socks: int) -> Future:
+        """a future resolved as soon as at least min_socks idle sockets are connected, over all routers"""
+        future = Future()
+        with self._lock:
+            self._connected_waiters.append((min_socks, future))
+            satisfied = self._pop_connected_waiters()
+        for f in satisfied:
+            f.set_result(True)
+        return future
+
+    def first_connected_at(self) -> Dict[str, float]:
+        """the time.monotonic() at which every router got its first connected socket"""
+        with self._lock:
+            return dict(self._first_connected_at)
+
+    def on_request_done(self, register_uri: str, secs: Optional[float]) -> NoReturn:
+        """a request served through the router completed in secs, None when the router aborted it"""
+        if self._weighting is not None:
+            with self._lock:
+                if register_uri in self._windows:
+                    health = self._windows[register_uri].health
+                    if secs is not None:
+                        health.observe_request(secs, self._weighting.sample_weight)
+                    health.observe_outcome(secs is not None, self._weighting.sample_weight,
+                                           self._weighting.window_secs)
+
+    def on_router_error(self, register_uri: str) -> NoReturn:
+        """a connect to the router failed or one of its sockets broke"""
+        if self._weighting is not None:
+            with self._lock:
+                if register_uri in self._windows:
+                    self._windows[register_uri].health.observe_outcome(False, self._weighting.sample_weight,
+                                                                       self._weighting.window_secs)
+
+    def router_health(self) -> Dict[str, Dict[str, float]]:
+        """handshake and request latency, error rate and window share of every router"""
+        now = time.monotonic()
+        with self._lock:
+            shares = self._health_shares(now) if self._weighting is not None else {}
+            window_secs = self._weighting.window_secs if self._weighting is not None else 1
+            return {uri: {"handshake_secs": window.health.handshake_secs or 0.0,
+                          "req_secs": window.health.req_secs or 0.0,
+                          "error_rate": window.health.error_rate(now, window_secs),
+                          "share": shares.get(uri, 1.0)}
+                    for uri, window in self._windows.items()}
+
+    def rescale(self, register_uri: str) -> int:
+        """
+        re-evaluates the window of a router from its request rate and health.
+        returns how many idle sockets it is missing (> 0) or has in surplus (< 0)
+        """
+        if self._autoscale is None and self._weighting is None:
+            return 0
+        if self._autoscale is not None:
+            now = time.monotonic()
+            with self._lock:
+                window = self._window(register_uri)
+                rate = window.decayed_rate(now, self._autoscale.rate_window_secs)
+                # twice the sockets consumed while one is being replaced, to absorb bursts
+                wanted = math.ceil(2 * rate * self._autoscale.refill_secs)
+                wanted = max(self._autoscale.min_size, min(self._autoscale.max_size, wanted))
+                if wanted > window.size:
+                    window.size = wanted
+                    window.grown_at = now
+                elif wanted < window.size and now - window.grown_at > self._autoscale.scale_down_delay_secs:
+                    window.size -= 1
+        return self.window_size(register_uri) - len(self._connector_socks.get(register_uri, ()))
+
+    def idle_socks(self, register_uri: str) -> List:
+        """idle sockets of a router, oldest first"""
+        with self._lock:
+            socks = list(self._connector_socks.get(register_uri, ()))
+        return sorted(socks, key=lambda s: s.create_time)
+
+    def _window(self, register_uri: str) -> _RouterWindow:
+        if register_uri not in self._windows:
+            initial = self._sliding_window_size
+            if self._autoscale is not None:
+                initial = max(self._autoscale.min_size, min(self._autoscale.max_size, initial))
+            self._windows[register_uri] = _RouterWindow(initial)
+        return self._windows[register_uri]
+
     def to_map(self) -> Dict[str, int]:
-        return self._connector_socks
+        with self._lock:
+            return {uri: len(socks) for uri, socks in self._connector_socks.items()}
+
+    def __str__(self) -> str:
+        return "WebsocketClientFarm{" + str(self.to_map()) + "}"
+
+    __repr__ = __str__
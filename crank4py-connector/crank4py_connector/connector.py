@@ -2,18 +2,36 @@
 # author=torchcc
 
 import ssl
-from concurrent.futures.thread import ThreadPoolExecutor
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
 from enum import Enum
-from typing import List, NoReturn
+from functools import partial
+from typing import Any, Callable, List, NoReturn, Optional, Dict, Union, TYPE_CHECKING
 
+from requests import Request
+from websocket import STATUS_GOING_AWAY
 from yarl import URL
 
-from crank4py_connector.conn_info_n_ws_client_farm import ConnInfo, WebsocketClientFarm
+from crank4py_connector.app_target import create_app_http_client
+from crank4py_connector.conn_info_n_ws_client_farm import ConnInfo, WebsocketClientFarm, SlidingWindowAutoscale, \
+    RouterCircuitBreaker, RouterHealthWeighting, max_window_size
 from crank4py_connector.connector_socket import ConnectorSocket
+from crank4py_connector.intermediate_request import BodyMemoryBudget
+from crank4py_connector.metrics import ConnectorMetrics, MetricsServer
+from crank4py_connector.multiplexed import Multiplexing
+from crank4py_connector.response_cache import ResponseCache
+from crank4py_connector.response_pump import ResponseReadAhead
+from crank4py_connector.router_tls import RouterTLSContext, create_router_tls_context
+from crank4py_connector.scheduler import Scheduler, Heartbeat, default_target_workers
+from crank4py_connector.target_pool import PooledHTTPAdapter, create_pooled_http_client
+from crank4py_connector.tracing import RequestTracer, RingBufferExporter, JsonLinesExporter
 from cranker_protocol.protocol import CrankerProtocolVersion10
-from util import log
+from util import log, HttpClient, configure_logging, dropped_log_records
 
-from crank4py_connector.config import Config
+from crank4py_connector.config import Config, Engine, AppInterface
+
+if TYPE_CHECKING:
+    from crank4py_connector.supervisor import ConnectorSupervisor
 
 
 class State(Enum):
@@ -24,39 +42,307 @@ class State(Enum):
 
 
 class Connector(object):
+    _rescale_interval_secs: float = 1
 
     def __init__(self, router_uris: List[URL], target_uri: URL, target_service_name: str, sliding_window_size: int,
-                 connector_instance_id: str, component_name: str) -> None:
+                 connector_instance_id: str, component_name: str, *, req_body_stream_limit: int = 0,
+                 scheduler: Optional[Scheduler] = None,
+                 window_autoscale: Optional[SlidingWindowAutoscale] = None,
+                 resp_chunk_sizes: Optional[Dict[str, int]] = None,
+                 metrics: Optional[ConnectorMetrics] = None,
+                 http_client: Optional[HttpClient] = None,
+                 circuit_breaker_factory: Optional[Callable[[], RouterCircuitBreaker]] = RouterCircuitBreaker,
+                 ping_interval: float = 5, ping_timeout: float = 0,
+                 response_cache: Optional[ResponseCache] = None,
+                 router_weighting: Optional[RouterHealthWeighting] = None,
+                 body_budget: Optional[BodyMemoryBudget] = None,
+                 target_prewarm: int = 0,
+                 router_tls_factory: Optional[Callable[[], RouterTLSContext]] = create_router_tls_context,
+                 tracer: Optional[RequestTracer] = None,
+                 read_ahead: Optional[ResponseReadAhead] = None,
+                 multiplexing: Optional[Multiplexing] = None) -> None:
         self._router_uris = router_uris
         self._target_uri = target_uri
         self._target_service_name = target_service_name
         self._sliding_window_size = sliding_window_size
         self._connector_instance_id = connector_instance_id
-        self._ws_client_farm = WebsocketClientFarm(sliding_window_size)
+        self._ws_client_farm = WebsocketClientFarm(sliding_window_size, window_autoscale, router_weighting)
+        self._window_autoscale = window_autoscale
+        # the windows have to be re-evaluated over time when they follow the request rate or the router health
+        self._rescales_windows: bool = window_autoscale is not None or router_weighting is not None
+        self._register_uris: List[URL] = []
+        self._circuit_breaker_factory = circuit_breaker_factory
+        self._circuit_breakers: Dict[str, RouterCircuitBreaker] = {}
+        # one tls context per wss router, keyed by its origin so that deregistration sockets share it too
+        self._router_tls_factory = router_tls_factory
+        self._router_tls: Dict[str, RouterTLSContext] = {}
+        self._deregister_socks: List[ConnectorSocket] = []
+        self.response_cache: Optional[ResponseCache] = response_cache
+        self.tracer: Optional[RequestTracer] = tracer
+        self.read_ahead: Optional[ResponseReadAhead] = read_ahead
+        self.multiplexing: Optional[Multiplexing] = multiplexing
         self._component_name = component_name
+        self._req_body_stream_limit = req_body_stream_limit
+        self._body_budget: Optional[BodyMemoryBudget] = body_budget
+        self._resp_chunk_sizes = resp_chunk_sizes
+        self.scheduler = scheduler or Scheduler(target_workers=default_target_workers(
+            len(router_uris) * max_window_size(sliding_window_size, window_autoscale, router_weighting)))
         self._state = State.NOT_STARTED
+        self.heartbeat: Heartbeat = Heartbeat(self._call_later, ping_interval, ping_timeout)
+        self.metrics: ConnectorMetrics = metrics or ConnectorMetrics()
+        self.metrics.idle_sockets.set_function(self._collect_idle_sockets)
+        self.metrics.sliding_window_size.set_function(self._collect_window_sizes)
+        self.metrics.circuit_open.set_function(self._collect_open_circuits)
+        self.metrics.log_dropped.set_function(lambda: {(): dropped_log_records()})
+        self.metrics.tls_handshakes.set_function(
+            lambda: {(router, kind.split("_")[0]): n for router, stats in self.tls_stats().items()
+                     for kind, n in stats.items()})
+        if router_weighting is not None:
+            self.metrics.router_share.set_function(
+                lambda: {(uri,): health["share"] for uri, health in self.router_health().items()})
+        if response_cache is not None:
+            self.metrics.response_cache.set_function(
+                lambda: {(event,): n for event, n in response_cache.stats().items()
+                         if event in ("hits", "misses", "revalidated", "stored", "evicted")})
+            self.metrics.response_cache_bytes.set_function(lambda: {(): response_cache.stats()["bytes"]})
+        if read_ahead is not None:
+            self.metrics.read_ahead_stall_secs.set_function(
+                lambda: {(side,): read_ahead.stats()[f"{side}_stall_secs"] for side in ("target", "router")})
+        if body_budget is not None:
+            self.metrics.request_body_buffer_bytes.set_function(lambda: {(): body_budget.stats()["bytes"]})
+            self.metrics.request_body_spills.set_function(lambda: {(): body_budget.stats()["spilled"]})
+        self.metrics.startup_secs.set_function(
+            lambda: {(phase,): secs for phase, secs in self.startup_stats().items()
+                     if phase in ("start", "first_socket", "target_prewarm") and secs is not None})
+        self._metrics_server: Optional[MetricsServer] = None
+        # connections opened to the target by start(), before the first request needs them
+        self._target_prewarm: int = target_prewarm
+        self._prewarmed: Future = Future()
+        self._prewarm_secs: Optional[float] = None
+        self._started_at: float = 0
+        self._start_secs: Optional[float] = None
+        if http_client is None:
+            # one keep-alive connection to the target for every worker that may be calling it, the target workers
+            # grow with the idle sockets the windows can have
+            http_client, _ = create_pooled_http_client(self.scheduler.target.max_workers)
+        self.http_client: HttpClient = http_client
+        self._target_pool: Optional[PooledHTTPAdapter] = None
+        adapter = http_client.get_adapter(str(target_uri))
+        if isinstance(adapter, PooledHTTPAdapter):
+            self._target_pool = adapter
+            self.metrics.target_pool_connections.set_function(
+                lambda: {(event,): n for event, n in adapter.pool_stats.to_dict().items()})
+            self.metrics.target_pool_idle.set_function(lambda: {(): adapter.stats()["idle"]})
+
+    def target_pool_stats(self) -> Dict[str, int]:
+        """hits, misses, evicted and discarded connections of the target pool, and how many are idle right now"""
+        return self._target_pool.stats() if self._target_pool is not None else {}
+
+    def _evict_idle_target_conns(self) -> NoReturn:
+        if self._state != State.RUNNING:
+            return
+        try:
+            self._target_pool.evict_idle()
+        except Exception as e:
+            log.warning(f"can not evict idle target connections, err: {e}")
+        finally:
+            self.scheduler.call_later(self._target_pool.idle_timeout / 2, self._evict_idle_target_conns)
+
+    def _collect_idle_sockets(self) -> Dict[tuple, float]:
+        idle = self._ws_client_farm.to_map()
+        return {(str(uri.origin()),): idle.get(str(uri), 0) for uri in self._register_uris}
+
+    def _collect_window_sizes(self) -> Dict[tuple, float]:
+        return {(str(uri.origin()),): self._ws_client_farm.window_size(str(uri)) for uri in self._register_uris}
+
+    def _collect_open_circuits(self) -> Dict[tuple, float]:
+        return {(str(uri.origin()),): 0 if self._circuit_breakers[str(uri)].is_closed else 1
+                for uri in self._register_uris if str(uri) in self._circuit_breakers}
+
+    def tls_stats(self) -> Dict[str, Dict[str, int]]:
+        """full and resumed tls handshakes with every wss router"""
+        return {origin: ctx.stats() for origin, ctx in self._router_tls.items()}
+
+    def router_health(self) -> Dict[str, Dict[str, float]]:
+        """handshake and request latency, error rate and window share of every router, see RouterHealthWeighting"""
+        health = self._ws_client_farm.router_health()
+        return {str(uri.origin()): health[str(uri)] for uri in self._register_uris if str(uri) in health}
+
+    def stats(self) -> Dict[str, object]:
+        """
+        idle sockets and window size over all routers, scheduler lanes, the target pool, buffered bodies, tls,
+        request tracing, response read-ahead and multiplexed sockets
+        """
+        idle = self._ws_client_farm.to_map()
+        return {
+            "idle_sockets": sum(idle.get(str(uri), 0) for uri in self._register_uris),
+            "sliding_window_size": sum(self._ws_client_farm.window_size(str(uri)) for uri in self._register_uris),
+            "open_circuits": sum(0 if breaker.is_closed else 1 for breaker in self._circuit_breakers.values()),
+            "heartbeat_sockets": len(self.heartbeat),
+            "scheduler": self.scheduler.stats(),
+            "target_pool": self.target_pool_stats(),
+            "response_cache": self.response_cache.stats() if self.response_cache is not None else {},
+            "request_body": self._body_budget.stats() if self._body_budget is not None else {},
+            "tls": {kind: sum(stats[kind] for stats in self.tls_stats().values())
+                    for kind in ("full_handshakes", "resumed_handshakes")},
+            "tracing": self.tracer.stats() if self.tracer is not None else {},
+            "read_ahead": self.read_ahead.stats() if self.read_ahead is not None else {},
+            "multiplexed": self.multiplexing.stats() if self.multiplexing is not None else {},
+        }
+
+    def request_traces(self) -> List[Dict[str, Any]]:
+        """the phase breakdowns of the slow, and sampled, requests kept in memory, oldest first"""
+        return self.tracer.recent() if self.tracer is not None else []
+
+    def startup_stats(self) -> Dict[str, object]:
+        """
+        secs from calling start() until it returned, until the first socket and every router's first socket were
+        connected, and until the target connections were pre-warmed. None for what has not happened yet
+        """
+        first_connected = {str(URL(uri).origin()): at - self._started_at
+                           for uri, at in self._ws_client_farm.first_connected_at().items()}
+        return {
+            "start": self._start_secs,
+            "first_socket": min(first_connected.values()) if first_connected else None,
+            "routers": first_connected,
+            "target_prewarm": self._prewarm_secs,
+            "target_prewarmed": self._prewarmed.result() if self._prewarmed.done() else 0,
+        }
+
+    def ready(self, min_sockets: int = 1) -> Future:
+        """
+        a future resolved with startup_stats() once min_sockets idle sockets are connected, over all routers,
+        and the target connections are pre-warmed. asyncio code can await asyncio.wrap_future(connector.ready())
+        """
+        ready = Future()
+        connected = self._ws_client_farm.when_connected(min_sockets)
+        # handed to whichever of the two futures completes last
+        token = [True]
+
+        def on_done(_):
+            if connected.done() and self._prewarmed.done():
+                try:
+                    token.pop()
+                except IndexError:
+                    return
+                ready.set_result(self.startup_stats())
+
+        connected.add_done_callback(on_done)
+        self._prewarmed.add_done_callback(on_done)
+        return ready
+
+    def wait_until_ready(self, min_sockets: int = 1, timeout: Optional[float] = None) -> bool:
+        """waits up to timeout secs for ready(min_sockets), returns whether the connector got ready in time"""
+        try:
+            self.ready(min_sockets).result(timeout)
+            return True
+        except FutureTimeoutError:
+            return False
+
+    def _prewarm_target(self) -> NoReturn:
+        """opens target_prewarm connections to the target on the target lane, while the routers are connected to"""
+        if self._target_pool is None or self._target_prewarm <= 0:
+            self._prewarmed.set_result(0)
+            return
+        request = self.http_client.prepare_request(Request("GET", str(self._target_uri)))
+        # the verify setting requests will send with, e.g. a ca bundle from the environment, picks the same pool
+        verify = self.http_client.merge_environment_settings(request.url, {}, None, None, None)["verify"]
+
+        def prewarm() -> int:
+            try:
+                opened = self._target_pool.prewarm(request, self._target_prewarm, verify)
+            except Exception as e:
+                log.warning(f"can not pre-warm connections to {self._target_uri}, err: {e}")
+                opened = 0
+            self._prewarm_secs = time.monotonic() - self._started_at
+            log.info(f"pre-warmed {opened} connections to {self._target_uri} in {self._prewarm_secs:.3f}s")
+            self._prewarmed.set_result(opened)
+            return opened
+
+        self.scheduler.target.submit(prewarm)
+
+    def serve_metrics(self, port: int, host: str = "0.0.0.0") -> MetricsServer:
+        """serves self.metrics in the prometheus text format on http://host:port/metrics until shutdown"""
+        self._metrics_server = MetricsServer(self.metrics.registry, port, host).start()
+        return self._metrics_server
+
+    def _call_later(self, delay_secs: float, task: Callable) -> NoReturn:
+        self.scheduler.call_later(delay_secs, task)
 
     def start(self) -> NoReturn:
+        self._started_at = time.monotonic()
+        self._prewarm_target()
         for uri in self._router_uris:
             register_uri = uri.join(
                 URL.build(path="register/", query={"connectorInstanceID": self._connector_instance_id,
                                                    "componentName": self._component_name}))
             log.info("connecting to " + str(register_uri))
-            for i in range(self._sliding_window_size):
-                conn_info = ConnInfo(register_uri, i)
-                self._connect_to_router(register_uri, conn_info)
-                self._ws_client_farm.add_ws(str(register_uri))
+            self._register_uris.append(register_uri)
+            if self._circuit_breaker_factory is not None:
+                breaker = self._circuit_breaker_factory()
+                breaker.on_close = partial(self._on_circuit_closed, register_uri)
+                self._circuit_breakers[str(register_uri)] = breaker
+            if self._router_tls_factory is not None and uri.scheme in ("wss", "https"):
+                self._router_tls[str(uri.origin())] = self._router_tls_factory()
+        # the sockets connect concurrently on the ws_io lane. they are started slot by slot over the routers rather
+        # than router by router, so that every router gets a socket first when the lane is capped
+        window_sizes = {str(uri): self._ws_client_farm.window_size(str(uri)) for uri in self._register_uris}
+        for i in range(max(window_sizes.values(), default=0)):
+            for register_uri in self._register_uris:
+                if i < window_sizes[str(register_uri)]:
+                    conn_info = ConnInfo(register_uri, i, self._circuit_breakers.get(str(register_uri)))
+                    self._connect_to_router(register_uri, conn_info)
 
+        self._start_secs = time.monotonic() - self._started_at
         log.info(f"connector started for component={self._component_name}, for path=/{self._target_service_name}")
         self._state = State.RUNNING
+        self.heartbeat.start()
+        if self._rescales_windows:
+            self.scheduler.call_later(self._rescale_interval_secs, self._rescale_windows)
+        if self._target_pool is not None and self._target_pool.idle_timeout > 0:
+            self.scheduler.call_later(self._target_pool.idle_timeout / 2, self._evict_idle_target_conns)
 
-    def _connect_to_router(self, register_uri, conn_info) -> NoReturn:
+    def _rescale_windows(self) -> NoReturn:
+        if self._state != State.RUNNING:
+            return
+        try:
+            for register_uri in self._register_uris:
+                diff = self._ws_client_farm.rescale(str(register_uri))
+                if diff > 0:
+                    self._fill_window(register_uri)
+                elif diff < 0:
+                    surplus = [sock for sock in self._ws_client_farm.idle_socks(str(register_uri)) if sock.connected]
+                    for sock in surplus[:-diff]:
+                        sock.retire()
+        except Exception as e:
+            log.error(f"can not rescale sliding windows, err: {e}", exc_info=True)
+        finally:
+            self.scheduler.call_later(self._rescale_interval_secs, self._rescale_windows)
+
+    def _fill_window(self, register_uri: URL) -> NoReturn:
+        breaker = self._circuit_breakers.get(str(register_uri))
+        if breaker is not None and not breaker.is_closed:
+            # only the probing socket connects while the circuit is open
+            return
+        while self._state == State.RUNNING and self._ws_client_farm.is_safe_to_add_ws(register_uri):
+            idle = self._ws_client_farm.to_map().get(str(register_uri), 0)
+            if idle >= self._ws_client_farm.window_size(str(register_uri)):
+                break
+            self._connect_to_router(register_uri, ConnInfo(register_uri, idle, breaker))
+
+    def _on_circuit_closed(self, register_uri: URL) -> NoReturn:
+        """a probe connected to the router again, replace the sockets that were dropped while its circuit was open"""
+        self.scheduler.call_later(0, lambda: self._fill_window(register_uri))
+
+    def _connect_to_router(self, register_uri, conn_info, add_to_farm: bool = True) -> ConnectorSocket:
         upgrade_req_headers = {
             "CrankerProtocol": CrankerProtocolVersion10,
             "Route": self._target_service_name
         }
-        sock = ConnectorSocket(register_uri, self._target_uri, conn_info,
-                               self._ws_client_farm, self._component_name, headers=upgrade_req_headers)
+        if self.multiplexing is not None:
+            # routers that do not know the multiplexed protocol ignore the offer and go on with CrankerProtocol
+            upgrade_req_headers.update(self.multiplexing.upgrade_headers())
+        sock = self._create_socket(register_uri, conn_info, upgrade_req_headers)
 
         def runnable():
             try:
@@ -64,9 +350,10 @@ class Connector(object):
                     log.info(
                         f"connector {self._connector_instance_id} will not reconnect to router as it is being shut down")
                 elif self._ws_client_farm.is_safe_to_add_ws(register_uri):
-                    log.info(f"connector {self._connector_instance_id} is adding another connectorSocket...")
+                    log.info("connector %s is adding another connectorSocket...", self._connector_instance_id)
                     self._connect_to_router(sock.register_uri, conn_info)
-                    self._ws_client_farm.add_ws(str(sock.register_uri))
+                    if self._rescales_windows:
+                        self._fill_window(sock.register_uri)
                 else:
                     log.warning(f"unexpected error happened, will not add websocket for this connector with "
                                 f"id {self._connector_instance_id}, current websocket client farm={self._ws_client_farm}")
@@ -75,11 +362,88 @@ class Connector(object):
 
         sock.when_consumed(runnable)
         if self._state != State.SHUTDOWN:
+            if add_to_farm:
+                # counted before it runs, so that it can not be consumed before it is added
+                self._ws_client_farm.add_ws(str(register_uri), sock)
             conn_info.on_conn_starting()
-            sock.thread_pool.submit(sock.run_forever, sslopt={"cert_reqs": ssl.CERT_NONE}, ping_interval=5)
-        log.debug(f"connected to router, register url = {register_uri}")
+            self.metrics.connect_attempts.labels(str(register_uri.origin())).inc()
+            self._run_socket(sock)
+        log.debug("connected to router, register url = %s", register_uri)
+        return sock
+
+    def _create_socket(self, register_uri: URL, conn_info: ConnInfo, headers: dict) -> ConnectorSocket:
+        return ConnectorSocket(register_uri, self._target_uri, conn_info, self._ws_client_farm, self._component_name,
+                               self.scheduler, headers=headers, **self._socket_options(register_uri))
+
+    def _socket_options(self, register_uri: URL) -> Dict[str, Any]:
+        """the keyword arguments every socket to register_uri is created with, whatever the engine"""
+        return dict(
+            req_body_stream_limit=self._req_body_stream_limit,
+            resp_chunk_sizes=self._resp_chunk_sizes,
+            metrics=self.metrics,
+            http_client=self.http_client,
+            response_cache=self.response_cache,
+            body_budget=self._body_budget,
+            router_tls=self._router_tls.get(str(register_uri.origin())),
+            tracer=self.tracer,
+            read_ahead=self.read_ahead,
+            multiplexing=self.multiplexing,
+        )
+
+    def _run_socket(self, sock: ConnectorSocket) -> NoReturn:
+        self.scheduler.ws_io.submit(self._run_forever, sock)
+
+    def _run_forever(self, sock: ConnectorSocket) -> NoReturn:
+        # pinged by the heartbeat once connected, instead of by a ping thread of its own
+        self.heartbeat.add(sock)
+        try:
+            sock.run_forever(sslopt={"cert_reqs": ssl.CERT_NONE})
+        finally:
+            self.heartbeat.discard(sock)
+
+    def wait_deregistered(self, timeout: float) -> bool:
+        """waits up to timeout secs for the routers to close the deregistration sockets opened by shutdown()"""
+        deadline = time.monotonic() + timeout
+        return all(sock.closed.wait(max(0.0, deadline - time.monotonic())) for sock in self._deregister_socks)
+
+    def drain(self, timeout: float) -> Dict[str, int]:
+        """
+        shuts down without cutting off the requests being served: stops replacing consumed sockets, closes the idle
+        ones so that the routers send no more requests here, waits up to timeout secs for the requests in flight to
+        finish, closes the sockets of those that did not, and deregisters from the routers.
+        :return: how many idle sockets were closed, and how many requests in flight completed and were cut off
+        """
+        deadline = time.monotonic() + timeout
+        # consumed and failed sockets are no longer replaced from here on
+        self._state = State.SHUTTING_DOWN
+        released_before = self._ws_client_farm.released
+        idle_closed = 0
+        for register_uri in self._register_uris:
+            for sock in self._ws_client_farm.idle_socks(str(register_uri)):
+                sock.retire(reason=b"Connector draining")
+                idle_closed += 1
+        in_flight = self._ws_client_farm.in_flight_requests()
+        log.info(f"draining connector {self._connector_instance_id}: closed {idle_closed} idle sockets, waiting up to "
+                 f"{timeout}s for {in_flight} requests in flight")
+        self._ws_client_farm.wait_no_in_flight(max(0.0, deadline - time.monotonic()))
+        completed = self._ws_client_farm.released - released_before
+        cut_off = self._ws_client_farm.in_flight_requests()
+        for sock in self._ws_client_farm.in_flight_socks():
+            log.warning(f"cutting off the requests in flight on websocket {sock.sock_id} to {sock.register_uri}, "
+                        f"drain timed out after {timeout}s")
+            try:
+                sock.close(status=STATUS_GOING_AWAY, reason=b"Connector drain timed out", timeout=0)
+            except Exception as e:
+                log.warning(f"can not close websocket {sock.sock_id}, err: {e}")
+        self.shutdown()
+        result = {"idle_closed": idle_closed, "completed": completed, "cut_off": cut_off}
+        log.info(f"drained connector {self._connector_instance_id}: {result}")
+        return result
 
     def shutdown(self) -> NoReturn:
+        if self._state == State.SHUTDOWN:
+            # e.g. by drain(), the scheduler takes no more sockets
+            return
         self._state = State.SHUTTING_DOWN
         for uri in self._router_uris:
             deregister: URL = uri.join(URL.build(path="/deregister/",
@@ -87,13 +451,87 @@ class Connector(object):
                                                         "componentName": self._component_name}))
             log.info(f"desconnecting to {deregister}")
             deregister_info = ConnInfo(deregister, 0)
-            self._connect_to_router(deregister, deregister_info)
+            self._deregister_socks.append(self._connect_to_router(deregister, deregister_info, add_to_farm=False))
         self._state = State.SHUTDOWN
+        self.heartbeat.stop()
+        if self._metrics_server is not None:
+            self._metrics_server.shutdown()
+            self._metrics_server.server_close()
+        if self.tracer is not None:
+            self.tracer.close()
+        # the sockets started so far, the deregistration ones included, and the requests in flight run to their end
+        self.scheduler.shutdown()
+        # closes the target adapters: the idle pooled connections, or the lifespan and event loop of an asgi app target,
+        # which cuts off the requests the app is still answering, see drain()
+        self.http_client.close()
+
+
+def _create_tracer(c: Config) -> Optional[RequestTracer]:
+    if not c.request_tracing:
+        return None
+    exporters = []
+    if c.trace_ring_buffer_size > 0:
+        exporters.append(RingBufferExporter(c.trace_ring_buffer_size))
+    if c.trace_jsonl_path:
+        exporters.append(JsonLinesExporter(c.trace_jsonl_path))
+    return RequestTracer(exporters + list(c.trace_exporters), c.trace_slow_threshold_secs, c.trace_sample_rate)
 
 
-def create_and_start_connector(c: Config) -> Connector:
-    connector = Connector(c.router_uris, c.target_uri, c.target_service_name, c.sliding_window_size, c.instance_id,
-                          c.component_name)
+def create_and_start_connector(c: Config) -> Union[Connector, "ConnectorSupervisor"]:
+    configure_logging(c.log_level, c.access_log_sample_rate, c.log_queue_size)
+    if c.processes > 1:
+        from crank4py_connector.supervisor import ConnectorSupervisor
+        return ConnectorSupervisor(c).start()
+    connector_cls = Connector
+    if c.engine == Engine.ASYNCIO:
+        from crank4py_connector.aio_connector import AioConnector
+        connector_cls = AioConnector
+    window_autoscale = None
+    if c.sliding_window_max_size:
+        window_autoscale = SlidingWindowAutoscale(c.sliding_window_min_size, c.sliding_window_max_size,
+                                                  c.sliding_window_scale_down_delay_secs)
+    router_weighting = None
+    if c.router_weighting:
+        router_weighting = RouterHealthWeighting(c.router_weight_min_share, c.router_weight_max_share,
+                                                 c.router_drain_error_rate, c.router_health_window_secs)
+    target_workers = c.target_workers or default_target_workers(
+        len(c.router_uris) * max_window_size(c.sliding_window_size, window_autoscale, router_weighting))
+    scheduler = Scheduler(c.ws_io_workers, target_workers, c.reconnect_workers, c.max_queue_size,
+                          c.resp_read_ahead_workers)
+    if c.target_app is not None:
+        http_client = create_app_http_client(c.target_app, asgi=c.target_app_interface == AppInterface.ASGI)
+    else:
+        http_client, _ = create_pooled_http_client(
+            c.target_pool_maxsize or scheduler.target.max_workers,
+            c.target_pool_idle_timeout_secs, c.target_tcp_keepalive_secs, c.target_pool_block, c.target_unix_socket)
+    circuit_breaker_factory = None
+    if c.circuit_failure_threshold > 0:
+        circuit_breaker_factory = partial(RouterCircuitBreaker, c.circuit_failure_threshold, c.circuit_open_secs,
+                                          c.circuit_max_open_secs)
+    connector = connector_cls(
+        c.router_uris, c.target_uri, c.target_service_name, c.sliding_window_size, c.instance_id, c.component_name,
+        req_body_stream_limit=c.req_body_stream_limit,
+        scheduler=scheduler,
+        window_autoscale=window_autoscale,
+        resp_chunk_sizes=c.resp_chunk_sizes,
+        http_client=http_client,
+        circuit_breaker_factory=circuit_breaker_factory,
+        ping_interval=c.ping_interval_secs,
+        ping_timeout=c.ping_timeout_secs,
+        response_cache=ResponseCache(c.response_cache_max_bytes, c.response_cache_max_entry_bytes)
+        if c.response_cache_max_bytes > 0 else None,
+        router_weighting=router_weighting,
+        body_budget=BodyMemoryBudget(c.req_body_memory_budget, c.req_body_spill_threshold, c.req_body_spill_dir),
+        target_prewarm=c.target_prewarm_connections,
+        router_tls_factory=partial(create_router_tls_context, c.router_tls_verify, c.router_ca_file,
+                                   c.router_ca_path),
+        tracer=_create_tracer(c),
+        read_ahead=ResponseReadAhead(c.resp_read_ahead_bytes, scheduler.read_ahead)
+        if c.resp_read_ahead_bytes > 0 else None,
+        multiplexing=Multiplexing(c.mux_stream_window_bytes, c.mux_stream_window_timeout_secs)
+        if c.multiplexed_protocol else None)
+    if c.metrics_port is not None:
+        connector.serve_metrics(c.metrics_port, c.metrics_host)
     try:
         connector.start()
     except Exception as e:
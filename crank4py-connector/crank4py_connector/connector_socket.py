@@ -1,22 +1,35 @@
 # coding=utf-8
 # author=torchcc
+import socket
+import ssl
+import struct
 import threading
 import time
-from concurrent.futures.thread import ThreadPoolExecutor
-from typing import NoReturn, ClassVar, Optional, Callable, Union
+from functools import partial
+from typing import Any, NoReturn, ClassVar, Optional, Callable, Union, Dict, Mapping, List
 from uuid import UUID, uuid4
 
 import six
 from requests import Response
+from requests.structures import CaseInsensitiveDict
 from websocket import WebSocket as WebSocket_, WebSocketTimeoutException, ABNF, getdefaulttimeout, WebSocketException, \
-    STATUS_UNEXPECTED_CONDITION, STATUS_NORMAL
+    STATUS_UNEXPECTED_CONDITION, STATUS_NORMAL, WebSocketConnectionClosedException
 from websocket import WebSocketApp
+from websocket._socket import DEFAULT_SOCKET_OPTION
+from websocket._url import parse_url
 from yarl import URL
 
 from crank4py_connector.conn_info_n_ws_client_farm import WebsocketClientFarm, ConnInfo
-from crank4py_connector.intermediate_request import IntermediateRequest
-from cranker_protocol.protocol import ProtocolRequest, ProtocolResponseBuilder, ProtocolResponse, HeadersBuilder
-from util import HttpClient, log, create_http_client
+from crank4py_connector.intermediate_request import IntermediateRequest, BodyMemoryBudget, UNBOUNDED_BODY_MEMORY
+from crank4py_connector.metrics import ConnectorMetrics, NULL_METRICS
+from crank4py_connector.multiplexed import Multiplexing, MultiplexedSession
+from crank4py_connector.response_cache import ResponseCache, CacheEntry
+from crank4py_connector.response_pump import ResponseReadAhead
+from crank4py_connector.router_tls import RouterTLSContext
+from crank4py_connector.scheduler import LaneFullError, Scheduler
+from crank4py_connector.tracing import RequestTracer, RequestTrace
+from cranker_protocol.protocol import ProtocolRequest, ProtocolResponseBuilder, HeadersBuilder
+from util import HttpClient, log, create_http_client, sample_access_log
 
 
 class WebSocket(WebSocket_):
@@ -39,7 +52,13 @@ class ConnectorSocket(WebSocketApp):
     _http_client: ClassVar[HttpClient] = create_http_client()
 
     def __init__(self, src_uri: URL, target_uri: URL, conn_info: ConnInfo,
-                 ws_clien_farm: WebsocketClientFarm, component_name: str, **kwargs):
+                 ws_clien_farm: WebsocketClientFarm, component_name: str, scheduler: Scheduler, *,
+                 req_body_stream_limit: int = 0, resp_chunk_sizes: Optional[Dict[str, int]] = None,
+                 metrics: Optional[ConnectorMetrics] = None, http_client: Optional[HttpClient] = None,
+                 response_cache: Optional[ResponseCache] = None, body_budget: Optional[BodyMemoryBudget] = None,
+                 router_tls: Optional[RouterTLSContext] = None, tracer: Optional[RequestTracer] = None,
+                 read_ahead: Optional[ResponseReadAhead] = None, multiplexing: Optional[Multiplexing] = None,
+                 **kwargs):
         self.register_uri: URL = src_uri
         self.target_uri: URL = target_uri
         self.conn_info: ConnInfo = conn_info
@@ -47,13 +66,40 @@ class ConnectorSocket(WebSocketApp):
         self.create_time: int = int(time.time() * 1000)
         self.ws_client_farm: WebsocketClientFarm = ws_clien_farm
         self._component_name: str = component_name
+        self._req_body_stream_limit: int = req_body_stream_limit
+        self._resp_chunk_sizes: Dict[str, int] = resp_chunk_sizes or {}
         self.req_to_target: Optional[IntermediateRequest] = None
         self.had_error: bool = False
         self.req_complete: bool = False
         self.new_sock_added: bool = False
-        self.new_sock_added: bool = False
+        self.connected: bool = False
+        # the close frame is sent, the read loop tears the socket down
+        self._closing: bool = False
+        # set once the socket is torn down, whether it ever connected or not
+        self.closed: threading.Event = threading.Event()
         self.when_consumed_action: Optional[Callable] = None
-        self.thread_pool = ThreadPoolExecutor(max_workers=2)
+        self.scheduler: Scheduler = scheduler
+        self.metrics: ConnectorMetrics = metrics or NULL_METRICS
+        if http_client is not None:
+            self._http_client = http_client
+        self._response_cache: Optional[ResponseCache] = response_cache
+        self._body_budget: BodyMemoryBudget = body_budget or UNBOUNDED_BODY_MEMORY
+        self._router_tls: Optional[RouterTLSContext] = router_tls
+        self._router_label: str = str(src_uri.origin())
+        self._tracer: Optional[RequestTracer] = tracer
+        self._read_ahead: Optional[ResponseReadAhead] = read_ahead
+        self._multiplexing: Optional[Multiplexing] = multiplexing
+        # the streams of the socket once the router chose the multiplexed protocol, None for protocol 1.0
+        self.session: Optional[MultiplexedSession] = None
+        self._trace: Optional[RequestTrace] = None
+        self._connected_at: float = 0
+        self._req_received_at: float = 0
+        self._target_called_at: float = 0
+        # holds one token while a request is in flight, list.pop() hands it to exactly one of the threads ending it
+        self._req_in_flight: List[bool] = []
+        # the reader stops reading, and so cannot see pongs, while the target is behind on the request body
+        self._reader_parked: bool = False
+        self._reader_resumed_tm: float = 0
 
         super().__init__(
             url=str(self.register_uri),
@@ -109,6 +155,7 @@ class ConnectorSocket(WebSocketApp):
         if self.sock:
             raise WebSocketException("socket is already opened")
         thread = None
+        torn_down = False
         self.keep_running = True
         self.last_ping_tm = 0
         self.last_pong_tm = 0
@@ -119,14 +166,17 @@ class ConnectorSocket(WebSocketApp):
             If close_frame is set, we will invoke the on_close handler with the
             statusCode and reason from there.
             """
-            if thread and thread.isAlive():
+            nonlocal torn_down
+            if torn_down:
+                return
+            torn_down = True
+            if thread and thread.is_alive():
                 event.set()
                 thread.join()
             self.keep_running = False
             if self.sock:
                 self.sock.close()
-            close_args = self._get_close_args(
-                close_frame.data if close_frame else None)
+            close_args = self._get_close_args(close_frame)
             self._callback(self.on_close, *close_args)
             self.sock = None
 
@@ -135,17 +185,24 @@ class ConnectorSocket(WebSocketApp):
                 self.get_mask_key, sockopt=sockopt, sslopt=sslopt,
                 fire_cont_frame=self.on_cont_message is not None,
                 skip_utf8_validation=skip_utf8_validation,
-                enable_multithread=True if ping_interval else False,
+                # responses and heartbeats are written from other threads than the read loop
+                enable_multithread=True,
                 sock_id=self.sock_id
             )
             self.sock.settimeout(getdefaulttimeout())
+            tls_sock = None
+            if self._router_tls is not None and not http_proxy_host:
+                # websocket-client builds a new SSLContext for every connect, hand it a socket of the router's instead
+                tls_sock = self._connect_tls(sockopt)
             self.sock.connect(
                 self.url, header=self.header, cookie=self.cookie,
                 http_proxy_host=http_proxy_host,
                 http_proxy_port=http_proxy_port, http_no_proxy=http_no_proxy,
                 http_proxy_auth=http_proxy_auth, subprotocols=self.subprotocols,
                 host=host, origin=origin, suppress_origin=suppress_origin,
-                proxy_type=proxy_type)
+                proxy_type=proxy_type, socket=tls_sock)
+            if tls_sock is not None:
+                self._router_tls.on_connected(tls_sock)
             if not dispatcher:
                 dispatcher = self.create_dispatcher(ping_timeout)
 
@@ -155,7 +212,7 @@ class ConnectorSocket(WebSocketApp):
                 event = threading.Event()
                 thread = threading.Thread(
                     target=self._send_ping, args=(ping_interval, event, ping_payload))
-                thread.setDaemon(True)
+                thread.daemon = True
                 thread.start()
 
             def read():
@@ -197,6 +254,8 @@ class ConnectorSocket(WebSocketApp):
                 return True
 
             dispatcher.read(self.sock.sock, read, check)
+            # close() stops the dispatcher without a close frame, the ping thread must still be stopped
+            teardown()
         except (Exception, KeyboardInterrupt, SystemExit) as e:
             self._callback(self.on_error, e)
             if isinstance(e, SystemExit):
@@ -205,6 +264,85 @@ class ConnectorSocket(WebSocketApp):
             teardown()
             return not isinstance(e, KeyboardInterrupt)
 
+    def _connect_tls(self, sockopt: list) -> Optional[ssl.SSLSocket]:
+        """a tls connection to the router made with its shared context, None for ws:// routers"""
+        hostname, port, _, is_secure = parse_url(self.url)
+        if not is_secure:
+            return None
+        sock = socket.create_connection((hostname, port), getdefaulttimeout())
+        try:
+            for opt in DEFAULT_SOCKET_OPTION + list(sockopt):
+                sock.setsockopt(*opt)
+            return self._router_tls.wrap_socket(sock, server_hostname=hostname)
+        except Exception:
+            sock.close()
+            raise
+
+    def send_raw_frame(self, frame: memoryview) -> NoReturn:
+        """writes a frame that is already built and masked, see ResponsePump"""
+        if self.sock is None or not self.sock.connected:
+            raise WebSocketConnectionClosedException("Connection is already closed.")
+        with self.sock.lock:
+            while frame:
+                frame = frame[self.sock._send(frame):]
+
+    def send_heartbeat(self) -> NoReturn:
+        """pings the router, called by the connector's Heartbeat"""
+        if self.sock is not None and self.sock.connected:
+            self.last_ping_tm = time.time()
+            self.sock.ping()
+
+    def pong_overdue(self, ping_timeout: float) -> bool:
+        """a pong still queued behind request body frames is not overdue, its time runs from when reading resumed"""
+        if self._reader_parked:
+            return False
+        return bool(self.last_ping_tm) and self.last_pong_tm < self.last_ping_tm and \
+            time.time() - max(self.last_ping_tm, self._reader_resumed_tm) > ping_timeout
+
+    def abort(self, reason: str) -> NoReturn:
+        """drops the connection without a close handshake, the read loop fails and the socket gets replaced"""
+        log.info(f"aborting websocket {self.sock_id} to {self.register_uri}: {reason}")
+        sock = self.sock
+        if sock is not None and sock.sock is not None:
+            sock.sock.shutdown(socket.SHUT_RDWR)
+
+    def close(self, status: int = STATUS_NORMAL, reason: bytes = b"", timeout: float = 3) -> NoReturn:
+        """
+        starts the closing handshake from any thread. only the close frame is sent here, the read loop gets the
+        router's answer and tears the socket down: WebSocket.close() would read the answer itself and close the socket
+        under the read loop, which then waits in select until its timeout.
+        the socket is shut down if the router does not answer within timeout secs, at once for 0
+        """
+        sock = self.sock
+        if sock is None or not sock.connected:
+            if not self._closing:
+                # not connected yet, there is no read loop to hand the close to
+                super().close()
+            return
+        self._closing = True
+        # the read loop must not answer the router's close frame with one of its own
+        sock.connected = False
+        try:
+            sock.send(struct.pack("!H", status) + reason, ABNF.OPCODE_CLOSE)
+        except Exception as e:
+            log.debug(f"failed to send close frame to router, sockId={self.sock_id}, err: {e}")
+            timeout = 0
+        if timeout > 0:
+            self._run_later(timeout, partial(self._shutdown_sock, sock))
+        else:
+            self._shutdown_sock(sock)
+
+    def _shutdown_sock(self, sock: WebSocket) -> NoReturn:
+        """wakes the read loop up with the end of the stream, it stops and tears the socket down"""
+        if self.sock is not sock:
+            return
+        self.keep_running = False
+        try:
+            sock.sock.shutdown(socket.SHUT_RDWR)
+        except (OSError, AttributeError):
+            # torn down meanwhile
+            pass
+
     def when_consumed(self, runnable: Callable) -> NoReturn:
         self.when_consumed_action = runnable
 
@@ -213,44 +351,94 @@ class ConnectorSocket(WebSocketApp):
             log.info(f"received error for {self.conn_info}, but it was already handled so ignoring it")
             return
         self.had_error = True
+        self.ws_client_farm.on_router_error(str(self.register_uri))
         if not self.new_sock_added:
-            self.ws_client_farm.remove_ws(str(self.register_uri))
-            delay: int = self.conn_info.retry_after_millis()
+            self.ws_client_farm.remove_ws(str(self.register_uri), self)
+            delay: Optional[int] = self.conn_info.reconnect_after_millis(connect_failed=not self.connected)
+            if delay is None:
+                # the circuit to the router is open, its window is refilled once a probe connects again
+                log.info(f"circuit to router {self.register_uri} is open, not replacing socket {self.sock_id}")
+                self.new_sock_added = True
+                return
+            self.metrics.reconnects.labels(self._router_label).inc()
             log.info(f"going to reconnect to router after {delay} ms")
 
             def delay_task():
-                time.sleep(delay / 1000)
                 self.when_consumed_action()
                 self.new_sock_added = True
-            self.thread_pool.submit(delay_task)
+            self._run_later(delay / 1000, delay_task)
+
+    def _run_later(self, delay_secs: float, task: Callable) -> NoReturn:
+        self.scheduler.call_later(delay_secs, task)
+
+    def retire(self, reason: bytes = b"Sliding window shrunk") -> NoReturn:
+        """closes an idle socket that the sliding window no longer needs, without replacing it"""
+        self.new_sock_added = True
+        self.ws_client_farm.remove_ws(str(self.register_uri), self)
+        log.debug("retiring idle websocket %s to %s", self.sock_id, self.register_uri)
+        if self.session is not None:
+            # the requests streaming over it are finished first
+            self.session.close_when_idle(reason)
+            return
+        # no waiting for the router to answer the close frame, many sockets may be retired in a row
+        self.close(status=STATUS_NORMAL, reason=reason, timeout=0)
 
     @staticmethod
     def on_websocket_connect(self, *args) -> NoReturn:
         """on open"""
-        log.debug(f"connected to {self.sock.sock.getpeername()}, sockeId={self.sock.sock_id}")
+        self.connected = True
+        self._connected_at = time.monotonic()
+        self.conn_info.on_connected_successfully()
+        self.ws_client_farm.on_handshake(str(self.register_uri), self._connected_at - self.conn_info.conn_started_at)
+        self.metrics.connects.labels(self._router_label).inc()
+        self._negotiate_protocol()
+        log.debug("connected to %s, sockeId=%s", self._peername(), self.sock.sock_id)
+
+    def _peername(self):
+        """the address of the router end of the connected websocket"""
+        return self.sock.sock.getpeername()
+
+    def _negotiate_protocol(self) -> NoReturn:
+        """starts a multiplexed session if the router chose that protocol in its upgrade response"""
+        if self._multiplexing is not None and self._multiplexing.accepted_by(self.sock.getheaders() or {}):
+            log.debug("router %s accepted the multiplexed protocol, sockId=%s", self.register_uri, self.sock_id)
+            self.session = self._multiplexing.new_session(self)
 
     @staticmethod
     def on_websocket_error(self, err: Exception) -> NoReturn:
         log.warning(f"websocket error: {err}", exc_info=True)
+        self.metrics.websocket_errors.labels(type(err).__name__).inc()
         self.reconnect_to_ws_server()
 
     @staticmethod
     def on_websocket_close(self, code: int, reason: str) -> NoReturn:
-        log.debug(f"connection {self.sock_id} closed: {code} - {reason}")
-        if not self.new_sock_added:
-            log.debug(f"going to reconnect to router, webswocket close code: {code}")
-            self.ws_client_farm.remove_ws(str(self.register_uri))
+        log.debug("connection %s closed: %s - %s", self.sock_id, code, reason)
+        self.closed.set()
+        # no code when the socket was closed locally without a close frame from the router
+        self.metrics.websocket_closes.labels(str(code) if code is not None else "none").inc()
+        # after an error the replacement is already scheduled, with a backoff
+        if not self.new_sock_added and not self.had_error:
+            log.debug("going to reconnect to router, webswocket close code: %s", code)
+            self.ws_client_farm.remove_ws(str(self.register_uri), self)
             self.when_consumed_action()
             self.new_sock_added = True
+        if self.session is not None:
+            self.session.abort_all("Socket to Router closed")
         if not self.req_complete and self.req_to_target is not None:
             if code != STATUS_UNEXPECTED_CONDITION:
                 log.info(f"websocket closed before the target response was processed, This may be because the user"
                          f"closed therire browser, Going to cancel request to target {self.req_to_target.url}")
                 self.req_to_target.abort(Exception("Socket to Router closed"))
+            self._end_req(self.metrics.requests_aborted)
 
     @staticmethod
     def on_message(self, msg: Union[str, bytes]) -> NoReturn:
-        if isinstance(msg, str):
+        if self.session is not None:
+            if isinstance(msg, bytes):
+                self.session.on_message(msg)
+            else:
+                log.warning(f"got a text message on multiplexed websocket {self.sock_id}, ignoring it")
+        elif isinstance(msg, str):
             self.on_websocket_text(msg)
         elif isinstance(msg, bytes):
             self.on_websocket_binary(msg)
@@ -259,7 +447,18 @@ class ConnectorSocket(WebSocketApp):
 
     def on_websocket_binary(self, payload: bytes) -> NoReturn:
         if payload:
-            self.req_to_target.content.append(payload)
+            self.metrics.req_bytes.inc(len(payload))
+            stream = self.req_to_target.body_stream
+            if stream is None or not stream.is_full():
+                self.req_to_target.add_body_part(payload)
+                return
+            # blocks until the target has taken in some of the body
+            self._reader_parked = True
+            try:
+                self.req_to_target.add_body_part(payload)
+            finally:
+                self._reader_resumed_tm = time.time()
+                self._reader_parked = False
 
     def on_websocket_text(self, msg: str) -> NoReturn:
         ptc_req = ProtocolRequest(msg)
@@ -269,36 +468,66 @@ class ConnectorSocket(WebSocketApp):
             self._on_req_received()
             self._new_req_to_target(ptc_req)
             if ptc_req.req_has_no_body():
-                self._send_req_to_target()
+                self._trace_mark("body_received")
+                self._start_req_to_target()
             elif ptc_req.req_body_pending():
-                log.debug(f"request body pending, sockId={self.sock_id}")
+                log.debug("request body pending, sockId=%s", self.sock_id)
+                if self.req_to_target.body_stream is not None:
+                    self._start_req_to_target()
         elif ptc_req.req_body_ended():
-            log.debug(f"no further request body is coming, sockId={self.sock_id}")
-            self._send_req_to_target()
+            log.debug("no further request body is coming, sockId=%s", self.sock_id)
+            self._trace_mark("body_received")
+            if self.req_to_target.body_stream is not None:
+                self.req_to_target.end_body()
+            else:
+                self._start_req_to_target()
 
     def _on_req_received(self) -> NoReturn:
-        self.ws_client_farm.remove_ws(str(self.register_uri))
+        self._req_received_at = time.monotonic()
+        self._req_in_flight.append(True)
+        self.metrics.in_flight.inc()
+        self.ws_client_farm.consume_ws(str(self.register_uri), self)
         self.conn_info.on_connected_successfully()
         self.when_consumed_action()
         self.new_sock_added = True
 
+    def prepare_req_to_target(self, ptc_req: ProtocolRequest, trace_id: str,
+                              waiting_since: float) -> IntermediateRequest:
+        """
+        the target request of a request from the router, with its headers, body handling, chunk size and trace.
+        waiting_since is when the router could have sent it, the start of the socket_idle phase
+        """
+        dest: URL = self.target_uri.join(URL(ptc_req.dest))
+        if sample_access_log():
+            log.info("going to send %s to %s, component is %s", ptc_req, dest, self._component_name)
+        req = IntermediateRequest(ptc_req.method, str(dest), self._http_client, self._body_budget)
+        if self._tracer is not None:
+            req.set_trace(self._tracer.start(self._router_label, trace_id, ptc_req.method, str(dest), waiting_since))
+        self._put_headers_to(req, ptc_req)
+        if self._req_body_stream_limit > 0 and ptc_req.req_body_pending():
+            req.stream_body(self._req_body_stream_limit)
+        chunk_size = self._resp_chunk_size(dest.path)
+        if chunk_size:
+            req.set_chunk_size(chunk_size)
+        if self._read_ahead is not None:
+            req.set_read_ahead(self._read_ahead)
+        return req
+
     def _new_req_to_target(self, ptc_req: ProtocolRequest) -> NoReturn:
         ptc_resp = ProtocolResponseBuilder.new_builder()
-        req_dest: str = ptc_req.dest
-        ptc_resp.with_src_url(req_dest).with_method(ptc_req.method)
-        dest: URL = self.target_uri.join(URL(req_dest))
-        log.info(f"going to send {ptc_req} to {dest}, component is {self._component_name}")
-        self.req_to_target = IntermediateRequest(ptc_req.method, str(dest), self._http_client)
-        self._put_headers_to(self.req_to_target, ptc_req)
+        ptc_resp.with_src_url(ptc_req.dest).with_method(ptc_req.method)
+        self.req_to_target = self.prepare_req_to_target(ptc_req, str(self.sock_id), self._connected_at)
+        self._trace = self.req_to_target.trace
 
         def on_resp_begin(resp: Response):
+            if self._target_called_at:
+                self.metrics.ttfb.observe(time.monotonic() - self._target_called_at)
             ptc_resp.with_resp_status(resp.status_code).with_resp_reason(resp.reason)
 
         def on_resp_headers(resp: Response):
             try:
-                ptc_resp.with_resp_headers(self._parse_headers(dict(resp.headers)))
-                ptc_resp_msg: ProtocolResponse = ProtocolResponse(ptc_resp.build())
-                self.send(ptc_resp_msg.to_protocol_msg())
+                ptc_resp.with_resp_headers(self._parse_headers(resp.headers))
+                self.send(ptc_resp.to_protocol_msg())
             except OSError as e:
                 log.warning(f"error occurred while sending header back to routr: {e}", exc_info=True)
 
@@ -306,6 +535,8 @@ class ConnectorSocket(WebSocketApp):
 
     def _send_req_to_target(self) -> NoReturn:
         def callabck(result: IntermediateRequest.Result):
+            self.metrics.resp_bytes.inc(result.resp_body_bytes)
+            self._end_req(self.metrics.requests_succeeded if result.is_succeeded else self.metrics.requests_failed)
             if result.is_succeeded:
                 self.req_complete = True
                 log.debug("closing websocet because response is fully processed")
@@ -316,21 +547,125 @@ class ConnectorSocket(WebSocketApp):
                     self.close(status=STATUS_UNEXPECTED_CONDITION, reason=b"Proxy failure")
 
         log.debug("request headers received")
+        if self._response_cache is not None and self._serve_from_cache(callabck):
+            return
+        self._target_called_at = time.monotonic()
+        self._trace_mark("target_called")
         self.req_to_target.fire_req_from_connector_to_target_service(callabck)
         log.debug("request body is fully sent")
 
+    def _serve_from_cache(self, callback: Callable[[IntermediateRequest.Result], Any]) -> bool:
+        """answers the request from the response cache if it can, else prepares the target request to fill it"""
+        req = self.req_to_target
+        req_headers = CaseInsensitiveDict(req.headers)
+        if not self._response_cache.is_cacheable_request(req.method, req_headers):
+            return False
+        entry, fresh = self._response_cache.get(req.method, req.url, req_headers)
+        if fresh:
+            log.debug("serving %s from the response cache, sockId=%s", req.url, self.sock_id)
+            self._target_called_at = 0
+            if self._trace is not None:
+                self._trace.from_cache = True
+            req.serve(entry.to_response(), callback)
+            return True
+        if entry is not None:
+            for header, value in entry.conditional_headers().items():
+                req.update_header(header, value)
+        req.on_resp(partial(self._cache_resp, req_headers, entry))
+        return False
+
+    def _cache_resp(self, req_headers: Mapping[str, str], revalidating: Optional[CacheEntry],
+                    resp: Response) -> Response:
+        cache = self._response_cache
+        if revalidating is not None:
+            if resp.status_code == 304:
+                resp.close()
+                return cache.revalidated(revalidating, resp).to_response()
+            cache.count("misses")
+        size = cache.storable_size(resp)
+        if size is None:
+            return resp
+        # as the target sent it, content-encoding included, like the response pump does
+        body = resp.raw.read(decode_content=False)
+        resp.raw.release_conn()
+        if len(body) != size:
+            raise IOError(f"target sent {len(body)} of {size} body bytes for {self.req_to_target.url}")
+        return cache.put(self.req_to_target.method, self.req_to_target.url, req_headers, resp, body).to_response()
+
+    def _end_req(self, outcome) -> NoReturn:
+        """counts a request once, whichever of the target callback or the socket close comes first"""
+        try:
+            self._req_in_flight.pop()
+        except IndexError:
+            return
+        self.ws_client_farm.release_ws(self)
+        trace, self._trace = self._trace, None
+        self.count_req_end(outcome, self._req_received_at, trace)
+
+    def count_req_end(self, outcome, received_at: float, trace: Optional[RequestTrace]) -> NoReturn:
+        """counts the end of a request received at received_at, for the metrics, router health and tracing"""
+        self.metrics.in_flight.dec()
+        outcome.inc()
+        duration = time.monotonic() - received_at
+        self.metrics.duration.observe(duration)
+        if outcome is self.metrics.requests_aborted:
+            self.ws_client_farm.on_request_done(str(self.register_uri), None)
+        elif outcome is self.metrics.requests_succeeded:
+            # failed requests are the target's doing, not the router's
+            self.ws_client_farm.on_request_done(str(self.register_uri), duration)
+        if trace is not None:
+            self._finish_trace(trace, outcome)
+
+    def _trace_mark(self, point: str) -> NoReturn:
+        if self._trace is not None:
+            self._trace.mark(point)
+
+    def _finish_trace(self, trace: RequestTrace, outcome) -> NoReturn:
+        if outcome is self.metrics.requests_succeeded:
+            outcome_name = "success"
+        elif outcome is self.metrics.requests_aborted:
+            outcome_name = "aborted"
+        else:
+            outcome_name = "failure"
+        self._tracer.finish(trace, outcome_name)
+        for phase, secs in trace.phases().items():
+            if secs is not None:
+                self.metrics.request_phase.labels(phase).observe(secs)
+
+    def _start_req_to_target(self) -> NoReturn:
+        """
+        fires the target request off the reader thread, so that while the target is called and the response streamed
+        the reader keeps streaming the body to it, answering pings and sees the router close the socket
+        """
+        try:
+            self._submit_req_to_target()
+        except LaneFullError as e:
+            log.warning(f"refusing request to {self.req_to_target.url} on sockId={self.sock_id}, err: {e}")
+            self.req_to_target.abort(e)
+            self._end_req(self.metrics.requests_failed)
+            self.close(status=STATUS_UNEXPECTED_CONDITION, reason=b"Connector busy")
+
+    def _submit_req_to_target(self) -> NoReturn:
+        self.scheduler.target.submit(self._send_req_to_target)
+
+    def _resp_chunk_size(self, path: str) -> Optional[int]:
+        """the chunk size configured for the longest path prefix matching path"""
+        matched = None
+        for prefix in self._resp_chunk_sizes:
+            if path.startswith(prefix) and (matched is None or len(prefix) > len(matched)):
+                matched = prefix
+        return self._resp_chunk_sizes[matched] if matched is not None else None
+
     @staticmethod
     def _put_headers_to(req_to_target: IntermediateRequest, ptc_req: ProtocolRequest) -> NoReturn:
         for line in ptc_req.headers:
-            if ":" in line:
-                pos = line.index(":")
-                header, value = line[0:pos], line[pos + 1:]
+            header, has_value, value = line.partition(":")
+            if has_value:
                 req_to_target.update_header(header, value)
         req_to_target.update_header("Via", "1.1 crnk")
 
     @staticmethod
-    def _parse_headers(header_fields: dict) -> HeadersBuilder:
+    def _parse_headers(header_fields: Mapping[str, str]) -> HeadersBuilder:
         headers = HeadersBuilder()
-        for name, value in header_fields.items():
-            headers.append_header(name, value)
+        headers.append_header_items(header_fields.items())
         return headers
@@ -1,67 +1,411 @@
 # coding=utf-8
 # author=torchcc
 
-from typing import List, Optional, Callable, Any, NoReturn
+import io
+import tempfile
+from collections import deque
+from threading import Condition, Lock
+from typing import List, Optional, Callable, Any, NoReturn, Deque, Union, Iterator, IO, Dict
 
-from requests import Response
-from websocket import WebSocketApp, ABNF
+from requests import Response, Request
+from websocket import WebSocketApp
 
+from crank4py_connector import tracing
+from crank4py_connector.response_pump import ResponsePump, ResponseReadAhead
+from crank4py_connector.tracing import RequestTrace
 from util import HttpClient
 
 
+class BodyStream(object):
+    """
+    a bounded hand-off of request body frames from the websocket reader to the target request.
+    the reader blocks in put() (or parks, see on_drain) once max_buffered_bytes are waiting, which stops it reading
+    the router socket, so the router is slowed down to the pace of the target.
+    """
+
+    def __init__(self, max_buffered_bytes: int) -> None:
+        self._max_buffered_bytes: int = max_buffered_bytes
+        self._frames: Deque[bytes] = deque()
+        self._buffered_bytes: int = 0
+        self._ended: bool = False
+        self._error: Optional[Exception] = None
+        self._drain_callback: Optional[Callable[[], Any]] = None
+        self._consumed_callback: Optional[Callable[[int], Any]] = None
+        self._cond: Condition = Condition()
+
+    def put(self, data: bytes, block: bool = True) -> NoReturn:
+        with self._cond:
+            if block:
+                self._cond.wait_for(self._has_room)
+            if self._error is not None or self._ended:
+                return
+            self._frames.append(data)
+            self._buffered_bytes += len(data)
+            self._cond.notify_all()
+
+    def is_full(self) -> bool:
+        return not self._has_room()
+
+    def on_drain(self, callback: Callable[[], Any]) -> NoReturn:
+        """calls callback once, from the consuming thread, as soon as there is room for more frames"""
+        with self._cond:
+            if not self._has_room():
+                self._drain_callback = callback
+                return
+        callback()
+
+    def on_consumed(self, callback: Callable[[int], Any]) -> NoReturn:
+        """calls callback with the size of every frame the target takes, from the consuming thread"""
+        self._consumed_callback = callback
+
+    def end(self) -> NoReturn:
+        with self._cond:
+            self._ended = True
+            self._cond.notify_all()
+        self._fire_drain_callback()
+
+    def abort(self, e: Exception) -> NoReturn:
+        with self._cond:
+            self._error = e
+            self._frames.clear()
+            self._cond.notify_all()
+        self._fire_drain_callback()
+
+    def _has_room(self) -> bool:
+        return self._buffered_bytes < self._max_buffered_bytes or self._error is not None or self._ended
+
+    def _fire_drain_callback(self) -> NoReturn:
+        with self._cond:
+            callback, self._drain_callback = self._drain_callback, None
+        if callback is not None:
+            callback()
+
+    def __iter__(self) -> Iterator[bytes]:
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._frames or self._ended or self._error is not None)
+                if self._error is not None:
+                    raise self._error
+                if not self._frames:
+                    return
+                data = self._frames.popleft()
+                self._buffered_bytes -= len(data)
+                self._cond.notify_all()
+            if self._has_room():
+                self._fire_drain_callback()
+            if self._consumed_callback is not None:
+                self._consumed_callback(len(data))
+            yield data
+
+
+class BodyMemoryBudget(object):
+    """
+    the memory all buffered request bodies of a connector may take together.
+    a body is kept in memory while it fits both spill_threshold and the budget, the rest of it goes to a temp file,
+    so a few concurrent large uploads can not take the connector's memory.
+    """
+
+    def __init__(self, max_bytes: int = 0, spill_threshold: int = 0, spill_dir: Optional[str] = None) -> None:
+        """
+        :param max_bytes: bytes of request bodies held in memory over all requests, 0 for no limit
+        :param spill_threshold: bodies bigger than that go to a temp file, 0 spills only when max_bytes is used up
+        :param spill_dir: where temp files are created, the system temp dir by default
+        """
+        self.max_bytes: int = max_bytes
+        self.spill_threshold: int = spill_threshold
+        self.spill_dir: Optional[str] = spill_dir
+        self._used: int = 0
+        self._spilled: int = 0
+        self._lock: Lock = Lock()
+
+    def new_buffer(self) -> "BodyBuffer":
+        return BodyBuffer(self)
+
+    def reserve(self, size: int) -> bool:
+        with self._lock:
+            if self.max_bytes > 0 and self._used + size > self.max_bytes:
+                return False
+            self._used += size
+            return True
+
+    def release(self, size: int) -> NoReturn:
+        with self._lock:
+            self._used -= size
+
+    def on_spill(self) -> NoReturn:
+        with self._lock:
+            self._spilled += 1
+
+    def stats(self) -> Dict[str, int]:
+        """bytes held in memory right now and bodies spilled to disk so far"""
+        return {"bytes": self._used, "spilled": self._spilled}
+
+
+# buffers of requests created without a connector keep their bodies in memory, as before
+UNBOUNDED_BODY_MEMORY = BodyMemoryBudget()
+
+
+class _FramesReader(io.RawIOBase):
+    """a raw stream over the frames of a body kept in memory, so that they never have to be joined"""
+
+    def __init__(self, frames: List[bytes]) -> None:
+        super().__init__()
+        self._frames: List[bytes] = frames
+        self._index: int = 0
+        self._frame: memoryview = memoryview(b"")
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        while not self._frame:
+            if self._index == len(self._frames):
+                return 0
+            self._frame = memoryview(self._frames[self._index])
+            self._index += 1
+        n = min(len(b), len(self._frame))
+        b[:n] = self._frame[:n]
+        self._frame = self._frame[n:]
+        return n
+
+
+class BodyBuffer(object):
+    """
+    a request body buffered until it is complete, for targets that need its length up front.
+    frames stay in memory while the budget allows, after that the whole body moves to an anonymous temp file.
+    """
+
+    def __init__(self, budget: BodyMemoryBudget = UNBOUNDED_BODY_MEMORY) -> None:
+        self._budget: BodyMemoryBudget = budget
+        self._frames: List[bytes] = []
+        self._reserved: int = 0
+        self._file: Optional[IO[bytes]] = None
+        self.size: int = 0
+        self._handed_off: bool = False
+        self._closed: bool = False
+        self._lock: Lock = Lock()
+
+    @property
+    def spilled(self) -> bool:
+        return self._file is not None
+
+    def write(self, data: bytes) -> NoReturn:
+        """appends a frame. once the buffer is closed or discarded the frame is dropped, the budget is not charged"""
+        with self._lock:
+            if self._closed:
+                return
+            self.size += len(data)
+            if self._file is None:
+                threshold = self._budget.spill_threshold
+                if (threshold <= 0 or self.size <= threshold) and self._budget.reserve(len(data)):
+                    self._reserved += len(data)
+                    self._frames.append(data)
+                    return
+                self._spill()
+            self._file.write(data)
+
+    def _spill(self) -> NoReturn:
+        """called with self._lock held"""
+        self._file = tempfile.TemporaryFile(dir=self._budget.spill_dir)
+        for frame in self._frames:
+            self._file.write(frame)
+        self._frames = []
+        self._budget.release(self._reserved)
+        self._reserved = 0
+        self._budget.on_spill()
+
+    def open(self) -> IO[bytes]:
+        """the whole body, read from the start. the buffer stays usable until close()"""
+        with self._lock:
+            self._handed_off = True
+            if self._file is None:
+                return _FramesReader(self._frames)
+            self._file.flush()
+            self._file.seek(0)
+            return self._file
+
+    def discard(self) -> NoReturn:
+        """closes the buffer unless its body was handed to the target, which closes it once it is done"""
+        with self._lock:
+            if not self._handed_off:
+                self._close()
+
+    def close(self) -> NoReturn:
+        with self._lock:
+            self._close()
+
+    def _close(self) -> NoReturn:
+        """called with self._lock held"""
+        if self._closed:
+            return
+        self._closed = True
+        self._frames = []
+        self._budget.release(self._reserved)
+        self._reserved = 0
+        if self._file is not None:
+            self._file.close()
+
+
 class IntermediateRequest(object):
-    _chunk_size: int = 16384
+    _default_chunk_size: int = 16384
 
-    def __init__(self, method: str = "GET", url: str = "", client: HttpClient = None) -> None:
+    def __init__(self, method: str = "GET", url: str = "", client: HttpClient = None,
+                 body_budget: BodyMemoryBudget = UNBOUNDED_BODY_MEMORY) -> None:
         self.method: str = method
         self.url: str = url
         self.client: HttpClient = client
-        self.content: List[bytes] = []
+        self.content: BodyBuffer = body_budget.new_buffer()
+        self.body_stream: Optional[BodyStream] = None
+        self.chunk_size: int = self._default_chunk_size
         self.headers: dict = dict()
+        self._on_resp: Optional[Callable[[Response], Response]] = None
         self._on_resp_begin: Optional[Callable[[Response], Any]] = None
         self._on_resp_headers: Optional[Callable[[Response], Any]] = None
         self._ws_session: Optional[WebSocketApp] = None
         self.result_error: Optional[Exception] = None
+        self.trace: Optional[RequestTrace] = None
+        self._read_ahead: Optional[ResponseReadAhead] = None
+        self._frame_prefix: bytes = b""
 
     def update_header(self, header, value) -> NoReturn:
         self.headers[header] = value
 
+    def on_resp(self, runnalbe: Optional[Callable[[Response], Response]]) -> "IntermediateRequest":
+        """lets the caller look at the target response first, and replace it with the one to send to the router"""
+        self._on_resp = runnalbe
+        return self
+
     def on_resp_begin(self, runnalbe: Optional[Callable[[Response], Any]]) -> "IntermediateRequest":
         self._on_resp_begin = runnalbe
         return self
-    
+
     def on_resp_headers(self, runnalbe: Optional[Callable[[Response], Any]]) -> "IntermediateRequest":
         self._on_resp_headers = runnalbe
         return self
-    
+
     def set_ws_session(self, ws: WebSocketApp) -> "IntermediateRequest":
         self._ws_session = ws
         return self
 
+    def set_chunk_size(self, chunk_size: int) -> "IntermediateRequest":
+        """the largest piece of response body sent to the router in one binary message"""
+        self.chunk_size = chunk_size
+        return self
+
+    def set_trace(self, trace: Optional[RequestTrace]) -> "IntermediateRequest":
+        """records the target connect, response headers and end of the response body on trace"""
+        self.trace = trace
+        return self
+
+    def set_read_ahead(self, read_ahead: Optional[ResponseReadAhead]) -> "IntermediateRequest":
+        """reads the response from the target while the earlier chunks are still being sent to the router"""
+        self._read_ahead = read_ahead
+        return self
+
+    def set_frame_prefix(self, prefix: bytes) -> "IntermediateRequest":
+        """the bytes every binary message of the response body starts with, e.g. its stream on a multiplexed socket"""
+        self._frame_prefix = prefix
+        return self
+
+    def stream_body(self, max_buffered_bytes: int) -> "IntermediateRequest":
+        """send the body to the target while it is still arriving from the router, instead of buffering it all"""
+        self.body_stream = BodyStream(max_buffered_bytes)
+        return self
+
+    def add_body_part(self, payload: bytes, block: bool = True) -> NoReturn:
+        if self.body_stream is not None:
+            self.body_stream.put(payload, block)
+        else:
+            self.content.write(payload)
+
+    def end_body(self) -> NoReturn:
+        if self.body_stream is not None:
+            self.body_stream.end()
+
     def abort(self, e: Exception):
         self.result_error = e
+        if self.body_stream is not None:
+            self.body_stream.abort(e)
+        else:
+            self.content.discard()
 
     class Result(object):
         def __init__(self):
             self.is_succeeded: bool = False
             self.failure: Optional[Exception] = None
+            self.resp_body_bytes: int = 0
 
     def fire_req_from_connector_to_target_service(self, callback: Callable[[Result], Any]):
-        data = b"".join(self.content)
         result = self.Result()
         try:
             if self.result_error is not None:
                 raise self.result_error
-            resp: Response = self.client.request(self.method, self.url, headers=self.headers, data=data, stream=True)
-            self._on_resp_begin(resp)
-            self._on_resp_headers(resp)
-            for chunk in resp.iter_content(chunk_size=self._chunk_size):
-                if not chunk:
-                    break
-                self._ws_session.send(chunk, opcode=ABNF.OPCODE_BINARY)
-            result.is_succeeded = True
+            if self.trace is not None:
+                tracing.activate(self.trace)
+            try:
+                resp: Response = self._send(self._body())
+            finally:
+                if self.trace is not None:
+                    tracing.activate(None)
+            if self.result_error is not None:
+                # the router went away while the target was answering, nothing of the response can be sent
+                resp.close()
+                raise self.result_error
+            if self._on_resp is not None:
+                resp = self._on_resp(resp)
+            self._deliver(resp, result)
+        except Exception as e:
+            result.failure = e
+        finally:
+            if self.body_stream is not None:
+                # unblock the websocket reader if the target answered before reading the whole body
+                self.body_stream.end()
+            else:
+                self.content.close()
+            callback(result)
+
+    def serve(self, resp: Response, callback: Callable[[Result], Any]) -> NoReturn:
+        """sends resp to the router as if the target had answered with it, without calling the target"""
+        result = self.Result()
+        try:
+            self._deliver(resp, result)
         except Exception as e:
             result.failure = e
         finally:
             callback(result)
 
+    def _deliver(self, resp: Response, result: Result) -> NoReturn:
+        if self.trace is not None:
+            self.trace.mark("resp_begin")
+            self.trace.status = resp.status_code
+        self._on_resp_begin(resp)
+        self._on_resp_headers(resp)
+        if self._read_ahead is not None:
+            result.resp_body_bytes = self._read_ahead.pump(resp, self._ws_session, self.chunk_size,
+                                                           self._frame_prefix)
+        else:
+            result.resp_body_bytes = ResponsePump.for_chunk_size(self.chunk_size, len(self._frame_prefix)).pump(
+                resp, self._ws_session, self._frame_prefix)
+        if self.trace is not None:
+            self.trace.mark("resp_end")
+            self.trace.resp_bytes = result.resp_body_bytes
+        result.is_succeeded = True
+
+    def _body(self) -> Union[bytes, BodyStream, IO[bytes]]:
+        if self.body_stream is not None:
+            return self.body_stream
+        # an empty body is sent as before, with the Content-Length: 0 requests gives it
+        return self.content.open() if self.content.size else b""
+
+    def _send(self, data: Union[bytes, BodyStream, IO[bytes]]) -> Response:
+        if isinstance(data, bytes):
+            return self.client.request(self.method, self.url, headers=self.headers, data=data, stream=True)
+        prepared = self.client.prepare_request(Request(self.method, self.url, headers=self.headers, data=data))
+        if not isinstance(data, BodyStream):
+            # the buffered body is complete, its length is known whether it is in memory or in a temp file
+            prepared.headers["Content-Length"] = str(self.content.size)
+        if "Content-Length" in prepared.headers:
+            # requests sends iterables chunked, but when the client told us the length we keep it for the target
+            prepared.headers.pop("Transfer-Encoding", None)
+        settings = self.client.merge_environment_settings(prepared.url, {}, True, None, None)
+        return self.client.send(prepared, **settings)
@@ -0,0 +1,366 @@
+# coding=utf-8
+# author=torchcc
+import bisect
+import math
+import socketserver
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from typing import Callable, Dict, Iterator, List, NoReturn, Optional, Sequence, Tuple
+
+from util import log
+
+LabelValues = Tuple[str, ...]
+
+DEFAULT_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+class _Metric(object):
+    """
+    a named metric with one series per combination of label values.
+    series are created once by labels(), the hot path keeps a reference to its series and only updates numbers on it,
+    each series has its own lock so writers on different series never wait for each other.
+    """
+    type_name: str = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> None:
+        self.name: str = name
+        self.documentation: str = documentation
+        self.labelnames: Tuple[str, ...] = tuple(labelnames)
+        self._series: Dict[LabelValues, object] = {}
+        self._lock = threading.Lock()
+        self._function: Optional[Callable[[], Dict[LabelValues, float]]] = None
+
+    def labels(self, *values: str):
+        if len(values) != len(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {values}")
+        series = self._series.get(values)
+        if series is None:
+            with self._lock:
+                series = self._series.setdefault(values, self._new_series())
+        return series
+
+    def _new_series(self):
+        raise NotImplementedError
+
+    def set_function(self, function: Callable[[], Dict[LabelValues, float]]) -> NoReturn:
+        """reads the series from function at collection time, for values that are cheaper to look up than to track"""
+        self._function = function
+
+    def samples(self) -> Iterator[Tuple[str, LabelValues, Tuple[str, ...], float]]:
+        """(sample name, label values, extra label names, value), extra labels come after the metric's own ones"""
+        if self._function is not None:
+            for values, value in self._function().items():
+                yield self.name, values, (), value
+            return
+        for values, series in list(self._series.items()):
+            yield from series.samples(self.name, values)
+
+
+class _ValueSeries(object):
+
+    def __init__(self) -> None:
+        self._value: float = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1) -> NoReturn:
+        with self._lock:
+            self._value += amount
+
+    @property
+    def value(self) -> float:
+        return self._value
+
+    def samples(self, name: str, values: LabelValues):
+        yield name, values, (), self._value
+
+
+class _GaugeSeries(_ValueSeries):
+
+    def dec(self, amount: float = 1) -> NoReturn:
+        with self._lock:
+            self._value -= amount
+
+    def set(self, value: float) -> NoReturn:
+        self._value = value
+
+
+class _HistogramSeries(object):
+
+    def __init__(self, buckets: Tuple[float, ...]) -> None:
+        self._buckets = buckets
+        self._counts: List[int] = [0] * (len(buckets) + 1)
+        self._sum: float = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> NoReturn:
+        i = bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            self._counts[i] += 1
+            self._sum += value
+
+    @property
+    def count(self) -> int:
+        return sum(self._counts)
+
+    def samples(self, name: str, values: LabelValues):
+        with self._lock:
+            counts, total = list(self._counts), self._sum
+        cumulative = 0
+        for bound, count in zip(self._buckets + (math.inf,), counts):
+            cumulative += count
+            yield name + "_bucket", values + (_format_value(bound),), ("le",), cumulative
+        yield name + "_sum", values, (), total
+        yield name + "_count", values, (), cumulative
+
+
+class Counter(_Metric):
+    type_name = "counter"
+
+    def _new_series(self) -> _ValueSeries:
+        return _ValueSeries()
+
+    def inc(self, amount: float = 1) -> NoReturn:
+        self.labels().inc(amount)
+
+
+class Gauge(_Metric):
+    type_name = "gauge"
+
+    def _new_series(self) -> _GaugeSeries:
+        return _GaugeSeries()
+
+    def inc(self, amount: float = 1) -> NoReturn:
+        self.labels().inc(amount)
+
+    def dec(self, amount: float = 1) -> NoReturn:
+        self.labels().dec(amount)
+
+    def set(self, value: float) -> NoReturn:
+        self.labels().set(value)
+
+
+class Histogram(_Metric):
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_LATENCY_BUCKETS) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.buckets: Tuple[float, ...] = tuple(sorted(buckets))
+
+    def _new_series(self) -> _HistogramSeries:
+        return _HistogramSeries(self.buckets)
+
+    def observe(self, value: float) -> NoReturn:
+        self.labels().observe(value)
+
+
+class MetricsRegistry(object):
+
+    def __init__(self) -> None:
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"metric {metric.name} is already registered")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def metrics(self) -> List[_Metric]:
+        with self._lock:
+            return list(self._metrics.values())
+
+    def to_prometheus_text(self) -> str:
+        """the registry in the prometheus text exposition format, version 0.0.4"""
+        lines: List[str] = []
+        for metric in self.metrics():
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type_name}")
+            for sample_name, values, extra_names, value in metric.samples():
+                labels = _format_labels(metric.labelnames + extra_names, values)
+                lines.append(f"{sample_name}{labels} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+def _with_label(series: str, name: str, value: str) -> str:
+    """'a{b="c"}' -> 'a{name="value",b="c"}'"""
+    metric, _, labels = series.partition("{")
+    labels = labels.rstrip("}")
+    return f'{metric}{{{name}="{value}"' + (f",{labels}}}" if labels else "}")
+
+
+def merge_prometheus_texts(texts: Sequence[str], workers: Optional[Sequence[str]] = None) -> str:
+    """
+    merges the metrics of several processes by the TYPE of every family: the values of a counter or histogram series
+    that shows up more than once are added up, a gauge keeps the value of every process under a worker label, e.g.
+    the health share of a router, which does not add up. workers are the label values of texts, their indexes by
+    default. the samples of a family stay together under its HELP and TYPE lines, also when only some processes have
+    a series
+    """
+    # family name -> its comment lines and its samples, in the order they show up first
+    families: Dict[str, Tuple[Dict[str, None], Dict[str, float]]] = {}
+    for i, text in enumerate(texts):
+        worker = workers[i] if workers is not None else str(i)
+        family, is_gauge = "", False
+        for line in text.splitlines():
+            if not line:
+                continue
+            if line.startswith("#"):
+                parts = line.split(" ", 3)
+                if len(parts) >= 3 and parts[1] in ("HELP", "TYPE"):
+                    if parts[2] != family:
+                        family, is_gauge = parts[2], False
+                    if parts[1] == "TYPE":
+                        is_gauge = len(parts) == 4 and parts[3].strip() == "gauge"
+                families.setdefault(family, ({}, {}))[0].setdefault(line, None)
+                continue
+            series, _, value = line.rpartition(" ")
+            if is_gauge:
+                series = _with_label(series, "worker", worker)
+            samples = families.setdefault(family, ({}, {}))[1]
+            samples[series] = samples.get(series, 0) + float(value)
+    lines: List[str] = []
+    for comments, samples in families.values():
+        lines.extend(comments)
+        lines.extend(f"{series} {_format_value(value)}" for series, value in samples.items())
+    return "\n".join(lines) + "\n"
+
+
+class ConnectorMetrics(object):
+    """the metrics of one connector, its farm and its sockets"""
+
+    def __init__(self, registry: Optional[MetricsRegistry] = None) -> None:
+        self.registry: MetricsRegistry = registry or MetricsRegistry()
+        r = self.registry
+        self.idle_sockets = r.gauge("crank4py_idle_sockets", "Idle sockets registered to a router.", ["router"])
+        self.sliding_window_size = r.gauge("crank4py_sliding_window_size", "Idle sockets wanted per router.",
+                                           ["router"])
+        self.connect_attempts = r.counter("crank4py_connect_attempts_total", "Websocket connects started.",
+                                          ["router"])
+        self.connects = r.counter("crank4py_connects_total", "Websocket connects that succeeded.", ["router"])
+        self.reconnects = r.counter("crank4py_reconnects_total", "Reconnects scheduled after a socket error.",
+                                    ["router"])
+        self.circuit_open = r.gauge("crank4py_router_circuit_open",
+                                    "1 while reconnects to a router are held back by its circuit breaker.", ["router"])
+        self.log_dropped = r.counter("crank4py_log_records_dropped_total",
+                                     "Log records dropped because the log thread fell behind.")
+        self.tls_handshakes = r.counter("crank4py_tls_handshakes_total",
+                                        "TLS handshakes with a router, by kind: full, or resumed from the session of "
+                                        "an earlier socket.", ["router", "kind"])
+        self.router_share = r.gauge("crank4py_router_window_share",
+                                    "Share of the sliding window a router gets from its health, 1 is an even share.",
+                                    ["router"])
+        self.startup_secs = r.gauge("crank4py_startup_seconds",
+                                    "Secs from starting the connector to a startup phase, by phase: start (start() "
+                                    "returned), first_socket (a router socket connected) and target_prewarm.",
+                                    ["phase"])
+        self.response_cache = r.counter("crank4py_response_cache_total",
+                                        "Response cache lookups and stores, by event: hits, misses, revalidated "
+                                        "(the target answered 304), stored and evicted.", ["event"])
+        self.response_cache_bytes = r.gauge("crank4py_response_cache_bytes", "Bytes held by the response cache.")
+        self.request_body_buffer_bytes = r.gauge("crank4py_request_body_buffer_bytes",
+                                                 "Bytes of buffered request bodies held in memory.")
+        self.request_body_spills = r.counter("crank4py_request_body_spills_total",
+                                             "Buffered request bodies moved to a temp file.")
+        self.requests_in_flight = r.gauge("crank4py_requests_in_flight", "Requests being proxied to the target.")
+        self.requests = r.counter("crank4py_requests_total", "Requests proxied, by outcome.", ["outcome"])
+        self.target_ttfb = r.histogram("crank4py_target_time_to_first_byte_seconds",
+                                       "Time from calling the target to receiving its response headers.")
+        self.request_duration = r.histogram("crank4py_request_duration_seconds",
+                                            "Time from receiving a request from the router to the end of its response.")
+        self.request_phase = r.histogram("crank4py_request_phase_seconds",
+                                         "Time traced requests spent in each phase: socket_idle (the socket waiting "
+                                         "for the request), body_upload, target_connect, target_ttfb and "
+                                         "response_stream.", ["phase"])
+        self.read_ahead_stall_secs = r.counter("crank4py_response_read_ahead_stall_seconds_total",
+                                               "Secs a side of the response read-ahead waited for the other, by side: "
+                                               "target (reads waiting for the router to take a chunk) and router "
+                                               "(writes waiting for the target).", ["side"])
+        self.request_bytes = r.counter("crank4py_request_body_bytes_total", "Request body bytes sent to the target.")
+        self.response_bytes = r.counter("crank4py_response_body_bytes_total",
+                                        "Response body bytes sent to the router.")
+        self.websocket_errors = r.counter("crank4py_websocket_errors_total", "Websocket errors, by exception type.",
+                                          ["type"])
+        self.websocket_closes = r.counter("crank4py_websocket_closes_total", "Websocket closes, by close code.",
+                                          ["code"])
+        self.target_pool_connections = r.counter("crank4py_target_pool_connections_total",
+                                                 "Target connections checked out of the pool, by event: hits reused a "
+                                                 "kept connection, misses opened one, evicted and discarded closed one.",
+                                                 ["event"])
+        self.target_pool_idle = r.gauge("crank4py_target_pool_idle_connections",
+                                        "Open connections kept idle for the target.")
+        # series updated for every request, resolved once
+        self.requests_succeeded = self.requests.labels("success")
+        self.requests_failed = self.requests.labels("failure")
+        self.requests_aborted = self.requests.labels("aborted")
+        self.in_flight = self.requests_in_flight.labels()
+        self.ttfb = self.target_ttfb.labels()
+        self.duration = self.request_duration.labels()
+        self.req_bytes = self.request_bytes.labels()
+        self.resp_bytes = self.response_bytes.labels()
+
+    def to_prometheus_text(self) -> str:
+        return self.registry.to_prometheus_text()
+
+
+class MetricsServer(socketserver.ThreadingMixIn, HTTPServer):
+    """serves a registry in the prometheus text format on /metrics, a thread per scrape"""
+    daemon_threads = True
+
+    def __init__(self, registry: MetricsRegistry, port: int, host: str = "0.0.0.0") -> None:
+        self.registry: MetricsRegistry = registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/metrics", "/"):
+                    self.send_error(404)
+                    return
+                body = registry.to_prometheus_text().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        super().__init__((host, port), Handler)
+
+    def start(self) -> "MetricsServer":
+        threading.Thread(target=self.serve_forever, name="crank4py-metrics", daemon=True).start()
+        log.info(f"serving metrics on http://{self.server_address[0]}:{self.server_port}/metrics")
+        return self
+
+
+# used by sockets created without a connector, so that they never have to check for missing metrics
+NULL_METRICS = ConnectorMetrics()
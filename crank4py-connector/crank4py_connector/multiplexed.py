@@ -0,0 +1,358 @@
+# coding=utf-8
+# author=torchcc
+import struct
+import threading
+import time
+from typing import Dict, List, Mapping, NoReturn, Optional, Union, TYPE_CHECKING
+
+from requests import Response
+from websocket import ABNF, STATUS_NORMAL
+
+from crank4py_connector.intermediate_request import IntermediateRequest
+from crank4py_connector.scheduler import LaneFullError
+from cranker_protocol.protocol import HeadersBuilder, ProtocolRequest, ProtocolResponseBuilder, StreamMessage, \
+    CrankerProtocolVersion30, CrankerSubprotocol10, CrankerSubprotocol30, RequestBodyPendingMarker, \
+    RequestHasNoBodyMarker
+from util import log
+
+if TYPE_CHECKING:
+    from crank4py_connector.connector_socket import ConnectorSocket
+
+# the error codes of RST_STREAM, the websocket close codes of the same meaning
+RST_PROXY_FAILURE = 1011
+RST_TRY_AGAIN_LATER = 1013
+
+
+class StreamResetError(Exception):
+    pass
+
+
+class Multiplexing(object):
+    """
+    offers the multiplexed cranker protocol (3.0) to the routers. a router that accepts it sends any number of
+    concurrent requests over every socket, each one a stream with flow control of its own, so a few long lived
+    sockets carry the traffic that took a socket, and a handshake, per request. a router that does not accept it
+    gets protocol 1.0 sockets as before.
+    """
+
+    def __init__(self, stream_window_bytes: int = 1024 * 1024, stream_window_timeout: float = 60) -> None:
+        """
+        :param stream_window_bytes: response bytes of a stream sent to the router and not acknowledged by it yet,
+        the stream waits once that many are
+        :param stream_window_timeout: seconds a stream waits for the router to acknowledge its window, after that it
+        is reset. 0 or less waits forever
+        """
+        self.stream_window_bytes: int = stream_window_bytes
+        self.stream_window_timeout: float = stream_window_timeout
+        self._lock = threading.Lock()
+        self._counts: Dict[str, int] = {"sockets": 0, "streams": 0, "served": 0, "reset": 0, "refused": 0,
+                                        "timed_out": 0}
+
+    @staticmethod
+    def upgrade_headers() -> Dict[str, str]:
+        """the headers offering protocol 3.0 on the upgrade request, next to the CrankerProtocol: 1.0 of old routers"""
+        return {"Sec-WebSocket-Protocol": CrankerSubprotocol30 + ", " + CrankerSubprotocol10}
+
+    @staticmethod
+    def accepted_by(resp_headers: Mapping[str, str]) -> bool:
+        """whether the lowercased headers of the router's upgrade response chose protocol 3.0"""
+        return resp_headers.get("sec-websocket-protocol", "").strip() == CrankerSubprotocol30 or \
+            resp_headers.get("crankerprotocol", "").strip() == CrankerProtocolVersion30
+
+    def new_session(self, sock: "ConnectorSocket") -> "MultiplexedSession":
+        self.count("sockets")
+        return MultiplexedSession(self, sock)
+
+    def count(self, event: str, n: int = 1) -> NoReturn:
+        with self._lock:
+            self._counts[event] += n
+
+    def stats(self) -> Dict[str, int]:
+        """
+        multiplexed sockets and streams open right now, streams served, reset by the router, refused for lack
+        of a target worker, and reset because the router did not acknowledge their window in time
+        """
+        with self._lock:
+            return dict(self._counts)
+
+
+class MultiplexedSession(object):
+    """
+    the streams of one multiplexed socket. messages are handled on the thread reading the socket, which never waits
+    for a target: requests run on the target lane and their bodies are handed over without blocking
+    """
+
+    def __init__(self, multiplexing: Multiplexing, sock: "ConnectorSocket") -> None:
+        self.multiplexing: Multiplexing = multiplexing
+        self.sock: "ConnectorSocket" = sock
+        self._streams: Dict[int, _Stream] = {}
+        self._lock = threading.Lock()
+        # set once the socket is to be closed as soon as its last stream ended
+        self._close_reason: Optional[bytes] = None
+        self._ended: bool = False
+
+    def on_message(self, data: bytes) -> NoReturn:
+        try:
+            msg = StreamMessage.parse(data)
+        except struct.error:
+            log.warning(f"got a message of {len(data)} bytes too short for a stream message, sockId={self.sock.sock_id}")
+            return
+        with self._lock:
+            stream = self._streams.get(msg.stream_id)
+            if stream is None and msg.msg_type == StreamMessage.HEADER and not self._ended:
+                stream = self._streams[msg.stream_id] = _Stream(self, msg.stream_id)
+        if stream is None:
+            # e.g. a window update for a response that has ended meanwhile
+            log.debug("ignoring %s of no open stream, sockId=%s", msg, self.sock.sock_id)
+        elif msg.msg_type == StreamMessage.HEADER:
+            stream.on_header(msg)
+        elif msg.msg_type == StreamMessage.DATA:
+            stream.on_data(msg)
+        elif msg.msg_type == StreamMessage.WINDOW_UPDATE:
+            stream.on_window_update(msg.int_payload())
+        elif msg.msg_type == StreamMessage.RST_STREAM:
+            stream.on_reset(msg)
+        else:
+            log.warning(f"got {msg} of an unknown type, sockId={self.sock.sock_id}")
+
+    def send(self, msg: bytes) -> NoReturn:
+        self.sock.send(msg, ABNF.OPCODE_BINARY)
+
+    def on_stream_started(self) -> NoReturn:
+        self.sock.metrics.in_flight.inc()
+        self.sock.ws_client_farm.hold_ws(self.sock)
+        self.multiplexing.count("streams")
+
+    def on_stream_ended(self, stream: "_Stream") -> NoReturn:
+        self.sock.ws_client_farm.release_ws(self.sock)
+        self.multiplexing.count("streams", -1)
+        self.discard(stream)
+
+    def discard(self, stream: "_Stream") -> NoReturn:
+        """forgets a stream, its id may be used again"""
+        with self._lock:
+            self._streams.pop(stream.stream_id, None)
+            close_reason = self._close_reason if not self._streams else None
+        if close_reason is not None:
+            self._close(close_reason)
+
+    def close_when_idle(self, reason: bytes) -> NoReturn:
+        """closes the socket once the streams open on it ended, right away if there are none"""
+        with self._lock:
+            self._close_reason = reason
+            idle = not self._streams
+        if idle:
+            self._close(reason)
+
+    def _close(self, reason: bytes) -> NoReturn:
+        log.debug("closing multiplexed websocket %s to %s", self.sock.sock_id, self.sock.register_uri)
+        try:
+            self.sock.close(status=STATUS_NORMAL, reason=reason, timeout=0)
+        except Exception as e:
+            log.debug(f"can not close websocket {self.sock.sock_id}, err: {e}")
+
+    def abort_all(self, reason: str) -> NoReturn:
+        """the socket closed, every stream still open on it is given up on"""
+        with self._lock:
+            self._ended = True
+            streams = list(self._streams.values())
+        if streams:
+            log.info(f"websocket {self.sock.sock_id} closed with {len(streams)} streams open, going to cancel them")
+        for stream in streams:
+            stream.abort(StreamResetError(reason))
+        self.multiplexing.count("sockets", -1)
+
+
+class _Stream(object):
+    """one request of a multiplexed socket, and the writer of its response, see ResponsePump"""
+
+    def __init__(self, session: MultiplexedSession, stream_id: int) -> None:
+        self._session: MultiplexedSession = session
+        self.stream_id: int = stream_id
+        self._header_parts: List[str] = []
+        self.req: Optional[IntermediateRequest] = None
+        self._received_at: float = time.monotonic()
+        self._target_called_at: float = 0
+        self._cond = threading.Condition()
+        # response bytes sent and not acknowledged by the router yet
+        self._unacked: int = 0
+        self._error: Optional[Exception] = None
+        # holds one token while the request is in flight, list.pop() hands it to exactly one of the threads ending it
+        self._in_flight: List[bool] = []
+
+    def on_header(self, msg: StreamMessage) -> NoReturn:
+        if self.req is not None:
+            log.warning(f"got {msg} after the request headers, sockId={self._session.sock.sock_id}")
+            return
+        self._header_parts.append(msg.payload.decode("utf-8"))
+        if msg.has(StreamMessage.END_HEADER):
+            self._start(msg.has(StreamMessage.END_STREAM))
+
+    def _start(self, has_no_body: bool) -> NoReturn:
+        sock = self._session.sock
+        header = "".join(self._header_parts).rstrip("\n")
+        self._header_parts = []
+        ptc_req = ProtocolRequest(header + "\n" + (RequestHasNoBodyMarker if has_no_body else RequestBodyPendingMarker))
+        self._in_flight.append(True)
+        self._session.on_stream_started()
+        self.req = sock.prepare_req_to_target(ptc_req, f"{sock.sock_id}/{self.stream_id}", self._received_at)
+        ptc_resp = ProtocolResponseBuilder.new_builder().with_src_url(ptc_req.dest).with_method(ptc_req.method)
+
+        def on_resp_begin(resp: Response):
+            sock.metrics.ttfb.observe(time.monotonic() - self._target_called_at)
+            ptc_resp.with_resp_status(resp.status_code).with_resp_reason(resp.reason)
+
+        def on_resp_headers(resp: Response):
+            headers = HeadersBuilder()
+            headers.append_header_items(resp.headers.items())
+            ptc_resp.with_resp_headers(headers)
+            self._session.send(StreamMessage.header(self.stream_id, ptc_resp.build_v3()))
+
+        self.req.on_resp_begin(on_resp_begin).on_resp_headers(on_resp_headers).set_ws_session(self)
+        self.req.set_frame_prefix(StreamMessage.prefix(StreamMessage.DATA, 0, self.stream_id))
+        if has_no_body:
+            self._mark("body_received")
+            self._fire()
+        elif self.req.body_stream is not None:
+            # the router may send more of the body as the target takes it in
+            self.req.body_stream.on_consumed(self._ack)
+            self._fire()
+
+    def on_data(self, msg: StreamMessage) -> NoReturn:
+        if self.req is None:
+            log.warning(f"got {msg} before the request headers, sockId={self._session.sock.sock_id}")
+            return
+        if msg.payload:
+            self._session.sock.metrics.req_bytes.inc(len(msg.payload))
+            self.req.add_body_part(msg.payload, block=False)
+            if self.req.body_stream is None:
+                # buffered bodies are taken in right away, held in memory or spilled, see BodyMemoryBudget
+                self._ack(len(msg.payload))
+        if msg.has(StreamMessage.END_STREAM):
+            log.debug("no further request body is coming, stream=%s", self.stream_id)
+            self._mark("body_received")
+            if self.req.body_stream is not None:
+                self.req.end_body()
+            else:
+                self._fire()
+
+    def _ack(self, size: int) -> NoReturn:
+        try:
+            self._session.send(StreamMessage.window_update(self.stream_id, size))
+        except Exception as e:
+            log.debug(f"can not acknowledge {size} body bytes of stream {self.stream_id}, err: {e}")
+
+    def on_window_update(self, size: int) -> NoReturn:
+        with self._cond:
+            self._unacked -= size
+            self._cond.notify_all()
+
+    def on_reset(self, msg: StreamMessage) -> NoReturn:
+        reason = msg.payload[4:].decode("utf-8", "replace")
+        log.info(f"router reset stream {self.stream_id} with {msg.int_payload()} {reason}, going to cancel request to "
+                 f"target {self.req.url if self.req is not None else ''}")
+        self._session.multiplexing.count("reset")
+        self.abort(StreamResetError(f"Stream reset by router: {reason}"))
+
+    def abort(self, e: Exception) -> NoReturn:
+        with self._cond:
+            self._error = e
+            self._cond.notify_all()
+        if self.req is None:
+            # reset before its headers were complete, nothing was started for it yet
+            self._session.discard(self)
+            return
+        self.req.abort(e)
+        self._end(self._session.sock.metrics.requests_aborted)
+
+    def _fire(self) -> NoReturn:
+        try:
+            self._session.sock.scheduler.target.submit(self._send_to_target)
+        except LaneFullError as e:
+            log.warning(f"refusing stream {self.stream_id}, err: {e}")
+            self._session.multiplexing.count("refused")
+            self._reset(RST_TRY_AGAIN_LATER, "Connector busy")
+            self.req.abort(e)
+            self._end(self._session.sock.metrics.requests_failed)
+
+    def _send_to_target(self) -> NoReturn:
+        def callback(result: IntermediateRequest.Result):
+            self._session.sock.metrics.resp_bytes.inc(result.resp_body_bytes)
+            if self._error is not None:
+                # ended when the router reset it, or the socket closed
+                return
+            if result.is_succeeded:
+                try:
+                    self._session.send(StreamMessage.data(self.stream_id, end_stream=True))
+                except Exception as e:
+                    log.warning(f"can not end stream {self.stream_id}, err: {e}")
+                    result.is_succeeded = False
+            else:
+                log.warning(f"request to target {self.req.url} failed, err: {result.failure}")
+                self._reset(RST_PROXY_FAILURE, "Proxy failure")
+            metrics = self._session.sock.metrics
+            self._end(metrics.requests_succeeded if result.is_succeeded else metrics.requests_failed)
+
+        self._target_called_at = time.monotonic()
+        self._mark("target_called")
+        self.req.fire_req_from_connector_to_target_service(callback)
+
+    def _reset(self, code: int, reason: str) -> NoReturn:
+        try:
+            self._session.send(StreamMessage.rst_stream(self.stream_id, code, reason))
+        except Exception as e:
+            log.debug(f"can not reset stream {self.stream_id}, err: {e}")
+
+    def _end(self, outcome) -> NoReturn:
+        try:
+            self._in_flight.pop()
+        except IndexError:
+            return
+        self._session.on_stream_ended(self)
+        if outcome is self._session.sock.metrics.requests_succeeded:
+            self._session.multiplexing.count("served")
+        self._session.sock.count_req_end(outcome, self._received_at, self.req.trace)
+
+    def _mark(self, point: str) -> NoReturn:
+        if self.req.trace is not None:
+            self.req.trace.mark(point)
+
+    # the response body is written through these two, see ResponsePump
+
+    def send_raw_frame(self, frame: memoryview) -> NoReturn:
+        length = frame[1] & 0x7f
+        if length == 0x7e:
+            length = struct.unpack_from("!H", frame, 2)[0]
+        elif length == 0x7f:
+            length = struct.unpack_from("!Q", frame, 2)[0]
+        self._wait_for_window(length - StreamMessage.PREFIX.size)
+        self._session.sock.send_raw_frame(frame)
+
+    def send(self, data: Union[str, bytes], opcode: int = ABNF.OPCODE_BINARY) -> NoReturn:
+        self._wait_for_window(len(data) - StreamMessage.PREFIX.size)
+        self._session.sock.send(data, opcode)
+
+    def _wait_for_window(self, size: int) -> NoReturn:
+        """waits until the router acknowledged enough of the response for size more bytes to fit the window"""
+        window = self._session.multiplexing.stream_window_bytes
+        timeout = self._session.multiplexing.stream_window_timeout
+        with self._cond:
+            fits = self._cond.wait_for(lambda: self._unacked < window or self._error is not None,
+                                       timeout if timeout > 0 else None)
+            if self._error is not None:
+                raise self._error
+            if fits:
+                self._unacked += size
+                return
+        # the router stopped reading the stream, give it up instead of holding the target worker forever
+        e = StreamResetError(f"router acknowledged no response bytes of stream {self.stream_id} within {timeout}s")
+        log.warning(f"resetting stream {self.stream_id}, err: {e}")
+        self._session.multiplexing.count("timed_out")
+        self._reset(RST_PROXY_FAILURE, "Stream window timed out")
+        self.abort(e)
+        raise e
+
+    def __str__(self) -> str:
+        return "Stream{" + str(self.stream_id) + " " + str(self.req.url if self.req is not None else "") + "}"
+
+    __repr__ = __str__
@@ -0,0 +1,235 @@
+# coding=utf-8
+# author=torchcc
+import threading
+import time
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+from typing import Callable, Dict, List, Mapping, NoReturn, Optional, Tuple
+
+from requests import Response
+from requests.structures import CaseInsensitiveDict
+
+# never stored, they describe the connection to the target rather than the response
+_HOP_BY_HOP_HEADERS = {"connection", "keep-alive", "proxy-authenticate", "proxy-authorization", "te", "trailer",
+                       "transfer-encoding", "upgrade"}
+_CACHEABLE_STATUS = {200, 203, 204, 300, 301, 404, 410}
+
+
+def parse_cache_control(value: Optional[str]) -> Dict[str, Optional[str]]:
+    """'public, max-age=60' -> {'public': None, 'max-age': '60'}"""
+    directives: Dict[str, Optional[str]] = {}
+    for part in (value or "").split(","):
+        name, has_value, arg = part.strip().partition("=")
+        if name:
+            directives[name.lower()] = arg.strip().strip('"') if has_value else None
+    return directives
+
+
+def _secs(value: Optional[str]) -> Optional[int]:
+    try:
+        return max(0, int(value))
+    except (TypeError, ValueError):
+        return None
+
+
+def _http_date(value: Optional[str]) -> Optional[float]:
+    if not value:
+        return None
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError, OverflowError):
+        return None
+
+
+def hit_rate_percent(stats: Mapping[str, int]) -> int:
+    """the lookups answered from the cache, revalidated ones included, of the counts in ResponseCache.stats()"""
+    lookups = stats["hits"] + stats["misses"] + stats["revalidated"]
+    return round(100 * (stats["hits"] + stats["revalidated"]) / lookups) if lookups else 0
+
+
+class CacheEntry(object):
+    """a stored response: status, end-to-end headers and the body exactly as the target sent it"""
+
+    def __init__(self, status: int, reason: str, headers: List[Tuple[str, str]], body: bytes,
+                 fresh_secs: float, age: float = 0, clock: Callable[[], float] = time.monotonic) -> None:
+        self.status: int = status
+        self.reason: str = reason
+        self.headers: List[Tuple[str, str]] = headers
+        self.body: bytes = body
+        self._clock: Callable[[], float] = clock
+        self.stored_at: float = clock() - age
+        self.fresh_until: float = self.stored_at + fresh_secs
+        lowered = CaseInsensitiveDict(headers)
+        self.etag: Optional[str] = lowered.get("ETag")
+        self.last_modified: Optional[str] = lowered.get("Last-Modified")
+
+    @property
+    def size(self) -> int:
+        return len(self.body) + sum(len(name) + len(value) for name, value in self.headers)
+
+    def is_fresh(self) -> bool:
+        return self._clock() < self.fresh_until
+
+    def conditional_headers(self) -> Dict[str, str]:
+        """the headers asking the target whether this entry is still valid"""
+        headers = {}
+        if self.etag is not None:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified is not None:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+    def to_response(self) -> Response:
+        """a requests Response as if the target had just sent this entry"""
+        resp = Response()
+        resp.status_code = self.status
+        resp.reason = self.reason
+        resp.headers = CaseInsensitiveDict(self.headers)
+        resp.headers["Age"] = str(int(self._clock() - self.stored_at))
+        resp._content = self.body
+        resp._content_consumed = True
+        return resp
+
+
+class ResponseCache(object):
+    """
+    a shared http cache of target responses, keyed on method, url and the request headers named by Vary.
+    responses are stored only when the target allows a shared cache to, i.e. not no-store, private or with cookies,
+    and when they say how long they stay fresh or carry an ETag/Last-Modified to revalidate them with.
+    entries are evicted least recently used first once max_bytes are stored.
+    clock stands in for time.monotonic, in tests.
+    """
+
+    def __init__(self, max_bytes: int, max_entry_bytes: int = 0, clock: Callable[[], float] = time.monotonic) -> None:
+        self.max_bytes: int = max_bytes
+        self.max_entry_bytes: int = max_entry_bytes or max(1, max_bytes // 16)
+        self._entries: "OrderedDict[Tuple[str, str, Tuple], CacheEntry]" = OrderedDict()
+        # the request headers every url varies on, as last told by the target
+        self._vary: Dict[Tuple[str, str], Tuple[str, ...]] = {}
+        self._bytes: int = 0
+        self._clock: Callable[[], float] = clock
+        self._lock = threading.Lock()
+        self._stats: Dict[str, int] = {"hits": 0, "misses": 0, "revalidated": 0, "stored": 0, "evicted": 0}
+
+    def count(self, event: str) -> NoReturn:
+        with self._lock:
+            self._stats[event] += 1
+
+    @staticmethod
+    def is_cacheable_request(method: str, req_headers: Mapping[str, str]) -> bool:
+        if method != "GET" or "Authorization" in req_headers or "Range" in req_headers:
+            return False
+        # conditional requests of the client are answered by the target, whose 304 only the client can use
+        if "If-None-Match" in req_headers or "If-Modified-Since" in req_headers:
+            return False
+        return "no-store" not in parse_cache_control(req_headers.get("Cache-Control"))
+
+    @staticmethod
+    def _wants_revalidation(req_headers: Mapping[str, str]) -> bool:
+        directives = parse_cache_control(req_headers.get("Cache-Control"))
+        return "no-cache" in directives or directives.get("max-age") == "0" or \
+            req_headers.get("Pragma", "").lower() == "no-cache"
+
+    def get(self, method: str, url: str, req_headers: Mapping[str, str]) -> Tuple[Optional[CacheEntry], bool]:
+        """the stored variant for this request, if any, and whether it can be served without asking the target"""
+        with self._lock:
+            vary = self._vary.get((method, url))
+            entry = None
+            if vary is not None:
+                entry = self._entries.get((method, url, tuple(req_headers.get(name) for name in vary)))
+            if entry is None:
+                self._stats["misses"] += 1
+                return None, False
+            self._entries.move_to_end((method, url, tuple(req_headers.get(name) for name in vary)))
+        fresh = entry.is_fresh() and not self._wants_revalidation(req_headers)
+        if fresh:
+            self.count("hits")
+        return entry, fresh
+
+    def storable_size(self, resp: Response) -> Optional[int]:
+        """the body size of resp when it may be stored, None when it may not"""
+        if resp.status_code not in _CACHEABLE_STATUS or "Set-Cookie" in resp.headers:
+            return None
+        directives = parse_cache_control(resp.headers.get("Cache-Control"))
+        if "no-store" in directives or "private" in directives or resp.headers.get("Vary", "").strip() == "*":
+            return None
+        if self._fresh_secs(resp.headers, directives) <= 0 and "ETag" not in resp.headers and \
+                "Last-Modified" not in resp.headers:
+            return None
+        size = _secs(resp.headers.get("Content-Length"))
+        if size is None or size > self.max_entry_bytes:
+            return None
+        return size
+
+    @staticmethod
+    def _fresh_secs(headers: Mapping[str, str], directives: Dict[str, Optional[str]]) -> float:
+        if "no-cache" in directives:
+            return 0
+        for name in ("s-maxage", "max-age"):
+            secs = _secs(directives.get(name))
+            if secs is not None:
+                return secs
+        expires = _http_date(headers.get("Expires"))
+        if expires is None:
+            return 0
+        date = _http_date(headers.get("Date")) or time.time()
+        return expires - date
+
+    def put(self, method: str, url: str, req_headers: Mapping[str, str], resp: Response,
+            body: bytes) -> CacheEntry:
+        headers = [(name, value) for name, value in resp.headers.items()
+                   if name.lower() not in _HOP_BY_HOP_HEADERS and name.lower() != "age"]
+        directives = parse_cache_control(resp.headers.get("Cache-Control"))
+        entry = CacheEntry(resp.status_code, resp.reason, headers, body,
+                           self._fresh_secs(resp.headers, directives), _secs(resp.headers.get("Age")) or 0,
+                           self._clock)
+        vary = tuple(sorted({name.strip().title() for name in resp.headers.get("Vary", "").split(",")
+                             if name.strip()}))
+        key = (method, url, tuple(req_headers.get(name) for name in vary))
+        with self._lock:
+            if self._vary.get((method, url)) != vary:
+                # the target varies on other headers now, the variants stored so far can not be found any more
+                self._drop_url(method, url)
+                self._vary[(method, url)] = vary
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old.size
+            self._entries[key] = entry
+            self._bytes += entry.size
+            self._stats["stored"] += 1
+            while self._bytes > self.max_bytes and self._entries:
+                evicted_key, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.size
+                self._stats["evicted"] += 1
+                if not any(k[:2] == evicted_key[:2] for k in self._entries):
+                    self._vary.pop(evicted_key[:2], None)
+        return entry
+
+    def _drop_url(self, method: str, url: str) -> NoReturn:
+        for key in [k for k in self._entries if k[:2] == (method, url)]:
+            self._bytes -= self._entries.pop(key).size
+
+    def revalidated(self, entry: CacheEntry, not_modified: Response) -> CacheEntry:
+        """the target answered 304 to entry's validators: refresh its headers and how long it stays fresh"""
+        updates = CaseInsensitiveDict((name, value) for name, value in not_modified.headers.items()
+                                      if name.lower() not in _HOP_BY_HOP_HEADERS and
+                                      name.lower() not in ("content-length", "age"))
+        headers = [(name, updates.pop(name, value)) for name, value in entry.headers] + list(updates.items())
+        merged = CaseInsensitiveDict(headers)
+        fresh = CacheEntry(entry.status, entry.reason, headers, entry.body,
+                           self._fresh_secs(merged, parse_cache_control(merged.get("Cache-Control"))),
+                           clock=self._clock)
+        with self._lock:
+            for key, stored in self._entries.items():
+                if stored is entry:
+                    self._entries[key] = fresh
+                    self._bytes += fresh.size - entry.size
+                    break
+            self._stats["revalidated"] += 1
+        return fresh
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            stats = dict(self._stats, entries=len(self._entries), bytes=self._bytes)
+        stats["hit_rate_percent"] = hit_rate_percent(stats)
+        return stats
@@ -0,0 +1,341 @@
+# coding=utf-8
+# author=torchcc
+import http.client
+import io
+import os
+import struct
+import sys
+import threading
+import time
+from collections import deque
+from typing import Deque, Dict, List, NoReturn, Optional, Tuple
+
+from requests import Response
+from websocket import ABNF
+
+from crank4py_connector.scheduler import Lane
+
+try:
+    import numpy
+except ImportError:
+    # without numpy messages are masked with big int arithmetic, which allocates per message
+    numpy = None
+
+# 1 byte of fin/opcode, 1 byte of mask/length, up to 8 bytes of extended length, 4 bytes of masking key
+_MAX_FRAME_HEADER_SIZE = 14
+
+
+class _UndecodedReader(io.RawIOBase):
+    """the body of a urllib3 response as the target sent it, read through its public api"""
+
+    def __init__(self, raw) -> None:
+        super().__init__()
+        self._raw = raw
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        # read1 returns what has arrived instead of waiting for len(b) bytes, urllib3 < 2 has no read1
+        read = getattr(self._raw, "read1", None) or self._raw.read
+        data = read(len(b), decode_content=False)
+        b[:len(data)] = data
+        return len(data)
+
+
+class ResponsePump(object):
+    """
+    copies a target response body to the router as binary websocket messages.
+    the body is read straight off the target connection into one reusable buffer, and every message is framed and
+    masked in place in that buffer, so a chunk costs no allocation when numpy is installed. whatever a read returns
+    is sent right away, a short read gives a short message rather than waiting for the buffer to fill up.
+    """
+
+    _local = threading.local()
+
+    def __init__(self, chunk_size: int, prefix_size: int = 0) -> None:
+        """
+        :param chunk_size: the most body bytes sent in one message
+        :param prefix_size: the length of the bytes every message starts with before the body, see pump()
+        """
+        self.chunk_size: int = chunk_size
+        self.prefix_size: int = prefix_size
+        self._prefix: bytes = b""
+        self._buf: bytearray = bytearray(_MAX_FRAME_HEADER_SIZE + prefix_size + chunk_size)
+        self._view: memoryview = memoryview(self._buf)
+        self._payload: memoryview = self._view[_MAX_FRAME_HEADER_SIZE + prefix_size:]
+        self._spread_size: int = (prefix_size + chunk_size + 3) // 4 * 4
+        if numpy is not None:
+            # the masking key is repeated over a message in a buffer of its own, and xored into the message in place
+            self._np_buf = numpy.frombuffer(self._buf, dtype=numpy.uint8)
+            self._key_words = numpy.empty(self._spread_size // 4, dtype=numpy.uint32)
+            self._key_bytes = self._key_words.view(numpy.uint8)
+        else:
+            # multiplying a 32-bit masking key by this repeats it over a whole message, in one step
+            self._key_spreader: int = int.from_bytes(b"\x01\x00\x00\x00" * (self._spread_size // 4), "little")
+
+    @classmethod
+    def for_chunk_size(cls, chunk_size: int, prefix_size: int = 0) -> "ResponsePump":
+        """the pump of the calling thread for this chunk size, so its buffer is reused by every request it serves"""
+        pumps: Dict[Tuple[int, int], ResponsePump] = cls._local.__dict__.setdefault("pumps", {})
+        pump = pumps.get((chunk_size, prefix_size))
+        if pump is None:
+            pump = pumps[(chunk_size, prefix_size)] = cls(chunk_size, prefix_size)
+        return pump
+
+    def set_prefix(self, prefix: bytes) -> NoReturn:
+        """the bytes every message starts with, e.g. the stream a body belongs to on a multiplexed socket"""
+        if len(prefix) != self.prefix_size:
+            raise ValueError(f"the prefix of this pump is {self.prefix_size} bytes long, got {len(prefix)}")
+        self._prefix = prefix
+
+    def pump(self, resp: Response, ws, prefix: bytes = b"") -> int:
+        """sends the whole body of resp to ws, every message starting with prefix, returns the number of body bytes sent"""
+        self.set_prefix(prefix)
+        reader = self._raw_reader(resp)
+        if reader is None:
+            return self._pump_decoded(resp, ws)
+        sent = 0
+        try:
+            while True:
+                frame, n = self.fill(reader)
+                if not n:
+                    break
+                ws.send_raw_frame(frame)
+                sent += n
+        except BaseException:
+            resp.close()
+            raise
+        resp.raw.release_conn()
+        return sent
+
+    def fill(self, reader: io.IOBase) -> Tuple[Optional[memoryview], int]:
+        """
+        reads the next piece of a body from reader into the buffer and frames it, returns the frame and the number of
+        body bytes in it, (None, 0) at the end of the body. the frame is only valid until the next fill
+        """
+        n = reader.readinto(self._payload)
+        return (self._frame(n), n) if n else (None, 0)
+
+    def _frame(self, n: int) -> memoryview:
+        """
+        masks the prefix and the first n bytes of the payload area, and writes a binary frame header right in
+        front of them
+        """
+        if self.prefix_size:
+            # masking the last message scrambled it
+            self._buf[_MAX_FRAME_HEADER_SIZE:_MAX_FRAME_HEADER_SIZE + self.prefix_size] = self._prefix
+            n += self.prefix_size
+        key = os.urandom(4)
+        if numpy is not None:
+            self._key_words[:(n + 3) // 4].fill(int.from_bytes(key, sys.byteorder))
+            payload = self._np_buf[_MAX_FRAME_HEADER_SIZE:_MAX_FRAME_HEADER_SIZE + n]
+            numpy.bitwise_xor(payload, self._key_bytes[:n], out=payload)
+        else:
+            payload = self._view[_MAX_FRAME_HEADER_SIZE:_MAX_FRAME_HEADER_SIZE + n]
+            mask = int.from_bytes(key, "little") * self._key_spreader
+            if n != self._spread_size:
+                mask &= (1 << (n << 3)) - 1
+            payload[:] = (int.from_bytes(payload, "little") ^ mask).to_bytes(n, "little")
+        if n < ABNF.LENGTH_7:
+            header = struct.pack("!BB", 0x80 | ABNF.OPCODE_BINARY, 0x80 | n)
+        elif n < ABNF.LENGTH_16:
+            header = struct.pack("!BBH", 0x80 | ABNF.OPCODE_BINARY, 0x80 | 0x7e, n)
+        else:
+            header = struct.pack("!BBQ", 0x80 | ABNF.OPCODE_BINARY, 0x80 | 0x7f, n)
+        start = _MAX_FRAME_HEADER_SIZE - 4 - len(header)
+        self._buf[start:_MAX_FRAME_HEADER_SIZE - 4] = header
+        self._buf[_MAX_FRAME_HEADER_SIZE - 4:_MAX_FRAME_HEADER_SIZE] = key
+        return self._view[start:_MAX_FRAME_HEADER_SIZE + n]
+
+    @staticmethod
+    def _raw_reader(resp: Response) -> Optional[io.IOBase]:
+        """
+        what the body of resp is read from as the target sent it, content-encoding included, which is what the
+        forwarded response headers describe. the http.client response under urllib3, or the body of an in-process
+        app target, is read straight into the pump's buffer, unless urllib3 holds bytes of the body already.
+        other urllib3 responses are read through their public read1() or read(), at the cost of a copy
+        """
+        raw = resp.raw
+        if not hasattr(raw, "release_conn") or not hasattr(raw, "read"):
+            return None
+        fp = getattr(raw, "_fp", None)
+        if isinstance(fp, (http.client.HTTPResponse, io.RawIOBase)) and not getattr(raw, "_decoded_buffer", None):
+            return fp
+        return _UndecodedReader(raw)
+
+    def _pump_decoded(self, resp: Response, ws) -> int:
+        sent = 0
+        for chunk in resp.iter_content(chunk_size=self.chunk_size):
+            if not chunk:
+                break
+            ws.send(self._prefix + chunk if self._prefix else chunk, opcode=ABNF.OPCODE_BINARY)
+            sent += len(chunk)
+        return sent
+
+
+class _ReadAheadTransfer(object):
+    """
+    one response moving through the slots of a read-ahead: read() fills free slots from the target on a read-ahead
+    worker while write() sends the filled ones to the router on the pumping thread. whichever side ends last hands
+    the slots back
+    """
+
+    def __init__(self, read_ahead: "ResponseReadAhead", slots: List[ResponsePump], reader, resp: Response) -> None:
+        self._read_ahead: "ResponseReadAhead" = read_ahead
+        self._slots: List[ResponsePump] = slots
+        self._reader = reader
+        self._resp: Response = resp
+        self._free: Deque[ResponsePump] = deque(slots)
+        self._filled: Deque[Tuple[ResponsePump, memoryview, int]] = deque()
+        self._cond = threading.Condition()
+        self._eof: bool = False
+        self._error: Optional[BaseException] = None
+        self._abandoned: bool = False
+        self._reading: bool = True
+        self._sides: int = 2
+        self.target_stall_secs: float = 0
+        self.router_stall_secs: float = 0
+
+    def read(self) -> NoReturn:
+        try:
+            while True:
+                with self._cond:
+                    if not self._free and not self._abandoned:
+                        started = time.monotonic()
+                        self._cond.wait_for(lambda: self._free or self._abandoned)
+                        self.target_stall_secs += time.monotonic() - started
+                    if self._abandoned:
+                        break
+                    slot = self._free.popleft()
+                frame, n = slot.fill(self._reader)
+                with self._cond:
+                    if n:
+                        self._filled.append((slot, frame, n))
+                    else:
+                        self._eof = True
+                    self._cond.notify_all()
+                if not n:
+                    break
+        except BaseException as e:
+            with self._cond:
+                self._error = e
+                self._cond.notify_all()
+        finally:
+            with self._cond:
+                self._reading = False
+                abandoned = self._abandoned
+            if abandoned:
+                # the writer gave up while this side was still reading, closing the response is left to it
+                self._resp.close()
+            self._side_done()
+
+    def write(self, ws) -> int:
+        sent = 0
+        try:
+            while True:
+                with self._cond:
+                    if not self._filled and not self._eof and self._error is None:
+                        started = time.monotonic()
+                        self._cond.wait_for(lambda: self._filled or self._eof or self._error is not None)
+                        self.router_stall_secs += time.monotonic() - started
+                    if self._filled:
+                        slot, frame, n = self._filled.popleft()
+                    elif self._error is not None:
+                        raise self._error
+                    else:
+                        break
+                ws.send_raw_frame(frame)
+                sent += n
+                with self._cond:
+                    self._free.append(slot)
+                    self._cond.notify_all()
+        except BaseException:
+            with self._cond:
+                self._abandoned = True
+                reading = self._reading
+                self._cond.notify_all()
+            if not reading:
+                self._resp.close()
+            raise
+        finally:
+            self._side_done()
+        self._resp.raw.release_conn()
+        return sent
+
+    def _side_done(self) -> NoReturn:
+        with self._cond:
+            self._sides -= 1
+            last = self._sides == 0
+        if last:
+            self._read_ahead.on_transfer_done(self)
+            self._read_ahead.release_slots(self._slots)
+
+
+class ResponseReadAhead(object):
+    """
+    lets target reads run ahead of router writes. while the thread pumping a response writes one chunk to the router,
+    a worker of the read-ahead lane already reads the next ones from the target, into up to max_bytes of slots.
+    once every slot is filled the reader waits, so a slow router still slows the target down instead of taking
+    memory. responses that fit in one chunk, or that come while every reader is busy, are pumped serially as before.
+    """
+
+    def __init__(self, max_bytes: int, executor: Lane) -> None:
+        """
+        :param max_bytes: bytes of response read ahead of the router writes, at least two chunks are
+        :param executor: where the readers run
+        """
+        self.max_bytes: int = max_bytes
+        self._executor: Lane = executor
+        self._spare: Dict[Tuple[int, int], List[List[ResponsePump]]] = {}
+        self._lock = threading.Lock()
+        self._pumped: int = 0
+        self._serial: int = 0
+        self._target_stall_secs: float = 0
+        self._router_stall_secs: float = 0
+
+    def pump(self, resp: Response, ws, chunk_size: int, prefix: bytes = b"") -> int:
+        """sends the whole body of resp to ws like ResponsePump.pump, returns the number of body bytes sent"""
+        reader = ResponsePump._raw_reader(resp)
+        length = resp.headers.get("Content-Length")
+        if reader is None or (length is not None and length.isdigit() and int(length) <= chunk_size):
+            return ResponsePump.for_chunk_size(chunk_size, len(prefix)).pump(resp, ws, prefix)
+        slots = self._acquire_slots(chunk_size, prefix)
+        transfer = _ReadAheadTransfer(self, slots, reader, resp)
+        if self._executor.try_submit(transfer.read) is None:
+            self.release_slots(slots)
+            with self._lock:
+                self._serial += 1
+            return ResponsePump.for_chunk_size(chunk_size, len(prefix)).pump(resp, ws, prefix)
+        return transfer.write(ws)
+
+    def _acquire_slots(self, chunk_size: int, prefix: bytes) -> List[ResponsePump]:
+        slots = None
+        with self._lock:
+            spare = self._spare.get((chunk_size, len(prefix)))
+            if spare:
+                slots = spare.pop()
+        if slots is None:
+            slots = [ResponsePump(chunk_size, len(prefix)) for _ in range(max(2, self.max_bytes // chunk_size))]
+        for slot in slots:
+            slot.set_prefix(prefix)
+        return slots
+
+    def release_slots(self, slots: List[ResponsePump]) -> NoReturn:
+        with self._lock:
+            self._spare.setdefault((slots[0].chunk_size, slots[0].prefix_size), []).append(slots)
+
+    def on_transfer_done(self, transfer: _ReadAheadTransfer) -> NoReturn:
+        with self._lock:
+            self._pumped += 1
+            self._target_stall_secs += transfer.target_stall_secs
+            self._router_stall_secs += transfer.router_stall_secs
+
+    def stats(self) -> Dict[str, float]:
+        """
+        responses pumped with read-ahead and serially for lack of a free reader. target_stall_secs is how long readers
+        waited for the router to free a slot, router_stall_secs how long router writes waited for the target
+        """
+        with self._lock:
+            return {"pumped": self._pumped, "serial": self._serial, "target_stall_secs": self._target_stall_secs,
+                    "router_stall_secs": self._router_stall_secs}
@@ -0,0 +1,63 @@
+# coding=utf-8
+# author=torchcc
+import ssl
+import threading
+from typing import Dict, NoReturn, Optional, Union
+
+from util import get_trust_all_ssl_ctx
+
+
+class RouterTLSContext(ssl.SSLContext):
+    """
+    the SSLContext of one router, shared by all the sockets to it instead of building one per connect.
+    every connect offers the router the TLS session of the last one, so that replacement sockets resume it with an
+    abbreviated handshake instead of a full one.
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__()
+        self._session: Optional[ssl.SSLSession] = None
+        self._lock = threading.Lock()
+        self.full_handshakes: int = 0
+        self.resumed_handshakes: int = 0
+
+    def wrap_socket(self, sock, server_side=False, do_handshake_on_connect=True, suppress_ragged_eofs=True,
+                    server_hostname=None, session=None) -> ssl.SSLSocket:
+        return super().wrap_socket(sock, server_side, do_handshake_on_connect, suppress_ragged_eofs, server_hostname,
+                                   session or self._session)
+
+    def wrap_bio(self, incoming, outgoing, server_side=False, server_hostname=None, session=None) -> ssl.SSLObject:
+        # used by asyncio's ssl transport
+        return super().wrap_bio(incoming, outgoing, server_side, server_hostname, session or self._session)
+
+    def on_connected(self, ssl_obj: Union[ssl.SSLSocket, ssl.SSLObject]) -> NoReturn:
+        """
+        counts the handshake of a socket and keeps its session for the next connect.
+        call it once the websocket upgrade response was read, TLS 1.3 sends its session tickets after the handshake
+        """
+        with self._lock:
+            if ssl_obj.session_reused:
+                self.resumed_handshakes += 1
+            else:
+                self.full_handshakes += 1
+            if ssl_obj.session is not None:
+                self._session = ssl_obj.session
+
+    def stats(self) -> Dict[str, int]:
+        return {"full_handshakes": self.full_handshakes, "resumed_handshakes": self.resumed_handshakes}
+
+
+def create_router_tls_context(verify: bool = False, ca_file: Optional[str] = None,
+                              ca_path: Optional[str] = None) -> RouterTLSContext:
+    """
+    :param verify: False (default) trusts any router certificate, like get_trust_all_ssl_ctx. True verifies the
+                   certificate and host name of the router against ca_file/ca_path, or the system CAs
+    """
+    if not verify:
+        return get_trust_all_ssl_ctx(RouterTLSContext)
+    ctx = RouterTLSContext(ssl.PROTOCOL_TLS_CLIENT)
+    if ca_file or ca_path:
+        ctx.load_verify_locations(ca_file, ca_path)
+    else:
+        ctx.load_default_certs(ssl.Purpose.SERVER_AUTH)
+    return ctx
@@ -0,0 +1,322 @@
+# coding=utf-8
+# author=torchcc
+import heapq
+import itertools
+import math
+import os
+import threading
+import time
+from concurrent.futures import Executor, Future
+from concurrent.futures.thread import ThreadPoolExecutor
+from typing import Callable, Dict, List, NoReturn, Optional, Set, Tuple
+
+from util import log
+
+
+class LaneFullError(Exception):
+    pass
+
+
+def default_target_workers(sockets: int = 0) -> int:
+    """
+    one target worker for every socket that can take a request at the same time, at least min(32, cpu + 4).
+    a request holds its worker until its response is sent, the ones coming while all are busy wait in the queue
+    """
+    return max(sockets, min(32, (os.cpu_count() or 1) + 4))
+
+
+class Lane(Executor):
+    """a named pool of workers with a bounded queue in front of it"""
+
+    def __init__(self, name: str, max_workers: int, max_queue_size: int) -> None:
+        self.name: str = name
+        self.max_workers: int = max_workers
+        self.max_queue_size: int = max_queue_size
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f"crank4py-{name}")
+        self._lock = threading.Lock()
+        self._pending: int = 0
+        self._active: int = 0
+        self._submitted: int = 0
+        self._completed: int = 0
+        self._rejected: int = 0
+        self._shutdown: bool = False
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        with self._lock:
+            if 0 < self.max_queue_size <= self._pending - self.max_workers:
+                self._rejected += 1
+                raise LaneFullError(f"{self.name} lane is full, {self.max_workers} workers busy and "
+                                    f"{self.max_queue_size} tasks queued")
+            self._pending += 1
+            self._submitted += 1
+        try:
+            return self._executor.submit(self._run, fn, *args, **kwargs)
+        except Exception:
+            with self._lock:
+                self._pending -= 1
+            raise
+
+    def try_submit(self, fn: Callable, *args, **kwargs) -> Optional[Future]:
+        """runs fn only if a worker is free to start it right away, None otherwise or once the lane is shut down"""
+        with self._lock:
+            if self._shutdown or self._pending >= self.max_workers:
+                return None
+            self._pending += 1
+            self._submitted += 1
+        try:
+            return self._executor.submit(self._run, fn, *args, **kwargs)
+        except Exception:
+            with self._lock:
+                self._pending -= 1
+            raise
+
+    def _run(self, fn: Callable, *args, **kwargs):
+        with self._lock:
+            self._active += 1
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self._lock:
+                self._active -= 1
+                self._pending -= 1
+                self._completed += 1
+
+    def shutdown(self, wait: bool = True, **kwargs) -> NoReturn:
+        with self._lock:
+            self._shutdown = True
+        self._executor.shutdown(wait=wait)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "max_workers": self.max_workers,
+                "active": self._active,
+                "queued": self._pending - self._active,
+                "submitted": self._submitted,
+                "completed": self._completed,
+                "rejected": self._rejected,
+            }
+
+
+class ThreadLane(Executor):
+    """
+    a lane that runs every task on a thread of its own, for tasks lasting as long as a socket does. in a pool the
+    sockets taken by requests in flight would hold the workers, and cap the requests in flight instead of the idle
+    sockets. max_workers caps the tasks running at once, 0 for no cap
+    """
+
+    def __init__(self, name: str, max_workers: int = 0) -> None:
+        self.name: str = name
+        self.max_workers: int = max_workers
+        self._lock = threading.Lock()
+        self._seq = itertools.count(1)
+        self._shutdown: bool = False
+        self._active: int = 0
+        self._submitted: int = 0
+        self._completed: int = 0
+        self._rejected: int = 0
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError("cannot schedule new futures after shutdown")
+            if 0 < self.max_workers <= self._active:
+                self._rejected += 1
+                raise LaneFullError(f"{self.name} lane is full, {self.max_workers} threads running")
+            self._active += 1
+            self._submitted += 1
+        future = Future()
+        future.set_running_or_notify_cancel()
+        thread = threading.Thread(target=self._run, args=(future, fn, args, kwargs),
+                                  name=f"crank4py-{self.name}-{next(self._seq)}", daemon=True)
+        try:
+            thread.start()
+        except Exception:
+            with self._lock:
+                self._active -= 1
+            raise
+        return future
+
+    def try_submit(self, fn: Callable, *args, **kwargs) -> Optional[Future]:
+        """runs fn unless max_workers tasks are running, None if they are"""
+        try:
+            return self.submit(fn, *args, **kwargs)
+        except LaneFullError:
+            return None
+
+    def _run(self, future: Future, fn: Callable, args: tuple, kwargs: dict) -> NoReturn:
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            with self._lock:
+                self._active -= 1
+                self._completed += 1
+
+    def shutdown(self, wait: bool = True, **kwargs) -> NoReturn:
+        """no new tasks are started, running ones end with their sockets"""
+        with self._lock:
+            self._shutdown = True
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "max_workers": self.max_workers,
+                "active": self._active,
+                "queued": 0,
+                "submitted": self._submitted,
+                "completed": self._completed,
+                "rejected": self._rejected,
+            }
+
+
+class Scheduler(object):
+    """
+    the connector wide workers shared by all its sockets:
+    ws_io runs the websocket read loops, a thread each, target runs target requests fired off the read loops,
+    reconnect runs delayed and replacement connects, read_ahead reads target responses ahead of the router writes.
+    """
+
+    def __init__(self, ws_io_workers: int = 0, target_workers: int = 0, reconnect_workers: int = 2,
+                 max_queue_size: int = 1024, read_ahead_workers: int = 0) -> None:
+        self.ws_io: ThreadLane = ThreadLane("ws-io", ws_io_workers)
+        self.target: Lane = Lane("target", target_workers or default_target_workers(), max_queue_size)
+        self.reconnect: Lane = Lane("reconnect", reconnect_workers, max_queue_size)
+        # responses are pumped by target workers, each of them may need a reader
+        self.read_ahead: Lane = Lane("read-ahead", read_ahead_workers or self.target.max_workers, max_queue_size)
+        self._timers: List[Tuple[float, int, Callable]] = []
+        self._timer_seq = itertools.count()
+        self._timer_cond = threading.Condition()
+        self._timer_thread = None
+        self._stopped: bool = False
+
+    def call_later(self, delay_secs: float, task: Callable) -> NoReturn:
+        """runs task on the reconnect lane after delay_secs, without parking a worker while waiting"""
+        with self._timer_cond:
+            if self._stopped:
+                return
+            heapq.heappush(self._timers, (time.monotonic() + delay_secs, next(self._timer_seq), task))
+            if self._timer_thread is None:
+                self._timer_thread = threading.Thread(target=self._run_timers, name="crank4py-timer", daemon=True)
+                self._timer_thread.start()
+            self._timer_cond.notify()
+
+    def _run_timers(self) -> NoReturn:
+        while True:
+            with self._timer_cond:
+                while not self._stopped and (not self._timers or self._timers[0][0] > time.monotonic()):
+                    self._timer_cond.wait(self._timers[0][0] - time.monotonic() if self._timers else None)
+                if self._stopped:
+                    return
+                _, _, task = heapq.heappop(self._timers)
+            try:
+                self.reconnect.submit(task)
+            except Exception as e:
+                if self._stopped:
+                    # shut down between taking the task off the heap and submitting it, dropped like the pending ones
+                    log.debug(f"dropping delayed task {task}, the scheduler is shut down")
+                else:
+                    log.error(f"can not run delayed task {task}, err: {e}")
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        with self._timer_cond:
+            timers = len(self._timers)
+        return {
+            "ws_io": self.ws_io.stats(),
+            "target": self.target.stats(),
+            "reconnect": dict(self.reconnect.stats(), timers=timers),
+            "read_ahead": self.read_ahead.stats(),
+        }
+
+    def shutdown(self, wait: bool = False) -> NoReturn:
+        """drops the pending delayed tasks, running tasks are finished"""
+        with self._timer_cond:
+            self._stopped = True
+            self._timers.clear()
+            self._timer_cond.notify()
+        for lane in (self.ws_io, self.target, self.reconnect, self.read_ahead):
+            lane.shutdown(wait=wait)
+
+
+class Heartbeat(object):
+    """
+    pings the open sockets of a connector and closes the ones whose pong is overdue, from one timer instead of a ping
+    thread per socket. sockets are spread over the slots of a wheel that turns once per ping_interval, so the pings of
+    a big window do not all go out at the same instant, and every tick only visits the sockets of two slots: the ones
+    to ping, and the ones pinged ping_timeout ago whose pong has to be there by now.
+    the sockets need send_heartbeat(), pong_overdue(ping_timeout) and abort(reason).
+    a ping_interval of 0 or less never pings, no wheel is built and sockets are not tracked.
+    """
+
+    def __init__(self, call_later: Callable[[float, Callable], None], ping_interval: float = 5,
+                 ping_timeout: float = 0, slots: int = 8) -> None:
+        if ping_timeout and ping_interval and ping_interval <= ping_timeout:
+            raise ValueError("ping_interval has to be longer than ping_timeout")
+        self.ping_interval: float = ping_interval
+        self.ping_timeout: float = ping_timeout
+        self._call_later = call_later
+        self._wheel: List[Set] = [set() for _ in range(slots)] if ping_interval > 0 else []
+        self._slot_of: Dict[object, int] = {}
+        self._tick_secs: float = ping_interval / slots if ping_interval > 0 else 0
+        # how many slots behind the cursor the pongs are checked, at least a whole tick after the ping
+        self._timeout_slots: int = min(slots - 1, max(1, math.ceil(ping_timeout / self._tick_secs))) \
+            if ping_interval > 0 else 0
+        self._cursor: int = 0
+        self._next_slot = itertools.count()
+        self._lock = threading.Lock()
+        self._running: bool = False
+
+    def add(self, sock) -> NoReturn:
+        if not self._wheel:
+            return
+        with self._lock:
+            slot = next(self._next_slot) % len(self._wheel)
+            self._slot_of[sock] = slot
+            self._wheel[slot].add(sock)
+
+    def discard(self, sock) -> NoReturn:
+        if not self._wheel:
+            return
+        with self._lock:
+            slot = self._slot_of.pop(sock, None)
+            if slot is not None:
+                self._wheel[slot].discard(sock)
+
+    def __len__(self) -> int:
+        return len(self._slot_of)
+
+    def start(self) -> NoReturn:
+        if self.ping_interval <= 0 or self._running:
+            return
+        self._running = True
+        self._call_later(self._tick_secs, self._tick)
+
+    def stop(self) -> NoReturn:
+        self._running = False
+
+    def _tick(self) -> NoReturn:
+        if not self._running:
+            return
+        try:
+            with self._lock:
+                to_ping = list(self._wheel[self._cursor])
+                to_check = list(self._wheel[(self._cursor - self._timeout_slots) % len(self._wheel)]) \
+                    if self.ping_timeout > 0 else []
+                self._cursor = (self._cursor + 1) % len(self._wheel)
+            for sock in to_check:
+                try:
+                    if sock.pong_overdue(self.ping_timeout):
+                        log.warning(f"no pong from router within {self.ping_timeout}s, closing sockId={sock.sock_id}")
+                        sock.abort("ping/pong timed out")
+                except Exception as e:
+                    log.debug(f"failed to close timed out socket, sockId={sock.sock_id}, err: {e}")
+            for sock in to_ping:
+                try:
+                    sock.send_heartbeat()
+                except Exception as e:
+                    log.debug(f"failed to ping router, sockId={sock.sock_id}, err: {e}")
+        except Exception as e:
+            log.error(f"heartbeat tick failed, err: {e}", exc_info=True)
+        finally:
+            self._call_later(self._tick_secs, self._tick)
@@ -0,0 +1,247 @@
+# coding=utf-8
+# author=torchcc
+import copy
+import math
+import multiprocessing
+import signal
+import threading
+import time
+from multiprocessing.connection import Connection, wait
+from typing import Any, Callable, Dict, List, NoReturn, Optional, Tuple
+
+from crank4py_connector.config import Config
+from crank4py_connector.metrics import MetricsServer, merge_prometheus_texts
+from crank4py_connector.response_cache import hit_rate_percent
+from util import log, flush_logs
+
+_deregister_timeout_secs = 5
+
+
+def _worker_config(c: Config, index: int) -> Config:
+    """the config of one worker process: its own instance id, its share of the sliding window and of the body memory"""
+    wc = copy.copy(c)
+    wc.processes = 1
+    wc.metrics_port = None
+    wc.instance_id = f"{c.instance_id}-{index}"
+    wc.sliding_window_size = max(1, math.ceil(c.sliding_window_size / c.processes))
+    if c.sliding_window_max_size:
+        wc.sliding_window_min_size = max(1, math.ceil(c.sliding_window_min_size / c.processes))
+        wc.sliding_window_max_size = max(wc.sliding_window_min_size,
+                                         math.ceil(c.sliding_window_max_size / c.processes))
+    if c.req_body_memory_budget:
+        wc.req_body_memory_budget = max(1, math.ceil(c.req_body_memory_budget / c.processes))
+    return wc
+
+
+def _run_worker(c: Config, pipe: Connection) -> NoReturn:
+    """a worker process, runs one connector until the supervisor asks it to shut down or goes away"""
+    # ctrl-c reaches the whole process group, let the supervisor shut the workers down in order
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    from crank4py_connector.connector import create_and_start_connector
+    connector = create_and_start_connector(c)
+    while True:
+        try:
+            command = pipe.recv()
+        except (EOFError, OSError):
+            command = "shutdown"
+        # commands with arguments come as tuples
+        command, *args = command if isinstance(command, tuple) else (command,)
+        if command == "stats":
+            pipe.send(connector.stats())
+        elif command == "metrics":
+            pipe.send(connector.metrics.to_prometheus_text())
+        elif command == "traces":
+            pipe.send(connector.request_traces())
+        elif command == "ready":
+            pipe.send(connector.wait_until_ready(*args))
+        elif command in ("shutdown", "drain"):
+            result = connector.drain(*args) if command == "drain" else connector.shutdown()
+            connector.wait_deregistered(_deregister_timeout_secs)
+            try:
+                pipe.send(result)
+            except (BrokenPipeError, OSError):
+                pass
+            # the process ends with os._exit(), which skips the atexit hook writing out the queued log records
+            flush_logs()
+            return
+
+
+# the ratios in the workers' stats, they do not add up and are computed again from the added up counts
+_RATIOS: Dict[str, Callable[[Dict[str, Any]], Any]] = {"hit_rate_percent": hit_rate_percent}
+
+
+def _sum_stats(stats: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """adds up the numbers of the workers' stats, key by key"""
+    total: Dict[str, Any] = {}
+    for s in stats:
+        for key, value in s.items():
+            if isinstance(value, dict):
+                total[key] = _sum_stats([total.get(key, {}), value])
+            elif key in _RATIOS:
+                total[key] = value
+            elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                total[key] = total.get(key, 0) + value
+            else:
+                total.setdefault(key, value)
+    for key, ratio in _RATIOS.items():
+        if key in total:
+            total[key] = ratio(total)
+    return total
+
+
+class _Worker(object):
+
+    def __init__(self, index: int, process: multiprocessing.Process, pipe: Connection) -> None:
+        self.index: int = index
+        self.process: multiprocessing.Process = process
+        self.pipe: Connection = pipe
+        self.lock = threading.Lock()
+        self.started_at: float = time.monotonic()
+
+    def ask(self, command: Any) -> Any:
+        with self.lock:
+            self.pipe.send(command)
+            return self.pipe.recv()
+
+
+class ConnectorSupervisor(object):
+    """
+    runs a connector in each of c.processes worker processes, so that the framing, tls and response pumping of one
+    deployment are spread over several cores instead of sharing one GIL.
+    every worker connects to all routers with its own instance id, <instance_id>-<n>, and 1/processes of the sliding
+    window. a worker that dies is started again, shutdown() makes every worker deregister and stop.
+    """
+    _restart_delay_secs: float = 1
+    _max_restart_delay_secs: float = 60
+    # a worker that exits sooner than this after being started is failing, not crashing once
+    _healthy_after_secs: float = 30
+
+    def __init__(self, c: Config) -> None:
+        self._config: Config = c
+        self._ctx = multiprocessing.get_context(c.process_start_method)
+        self._workers: List[Optional[_Worker]] = [None] * c.processes
+        self._fast_exits: List[int] = [0] * c.processes
+        self._running: bool = False
+        self._metrics_server: Optional[MetricsServer] = None
+        self._monitor: Optional[threading.Thread] = None
+
+    def start(self) -> "ConnectorSupervisor":
+        self._running = True
+        for i in range(len(self._workers)):
+            self._start_worker(i)
+        self._monitor = threading.Thread(target=self._watch_workers, name="crank4py-supervisor", daemon=True)
+        self._monitor.start()
+        if self._config.metrics_port is not None:
+            self._metrics_server = MetricsServer(self, self._config.metrics_port, self._config.metrics_host).start()
+        log.info(f"supervisor started {len(self._workers)} connector processes for path=/"
+                 f"{self._config.target_service_name}")
+        return self
+
+    def _start_worker(self, index: int) -> NoReturn:
+        pipe, child_pipe = self._ctx.Pipe()
+        process = self._ctx.Process(target=_run_worker, args=(_worker_config(self._config, index), child_pipe),
+                                    name=f"crank4py-connector-{index}", daemon=True)
+        process.start()
+        child_pipe.close()
+        self._workers[index] = _Worker(index, process, pipe)
+
+    def _watch_workers(self) -> NoReturn:
+        while self._running:
+            workers = {w.process.sentinel: w for w in self._workers if w is not None}
+            for sentinel in wait(list(workers), timeout=1):
+                worker = workers[sentinel]
+                if not self._running:
+                    return
+                worker.process.join()
+                worker.pipe.close()
+                if time.monotonic() - worker.started_at < self._healthy_after_secs:
+                    self._fast_exits[worker.index] += 1
+                else:
+                    self._fast_exits[worker.index] = 0
+                delay = min(self._max_restart_delay_secs,
+                            self._restart_delay_secs * 2 ** (self._fast_exits[worker.index] - 1))
+                log.error(f"connector process {worker.index} exited with {worker.process.exitcode}, "
+                          f"restarting it in {delay}s")
+                time.sleep(delay)
+                if self._running:
+                    self._start_worker(worker.index)
+
+    def _ask_all(self, command: str) -> List[Any]:
+        return [answer for _, answer in self._ask_each(command)]
+
+    def _ask_each(self, command: str) -> List[Tuple[int, Any]]:
+        """the index and answer of every worker that answered"""
+        answers = []
+        for worker in self._workers:
+            try:
+                answers.append((worker.index, worker.ask(command)))
+            except (EOFError, OSError) as e:
+                log.warning(f"connector process {worker.index} did not answer {command}, err: {e}")
+        return answers
+
+    def stats(self) -> Dict[str, Any]:
+        """the stats of all workers added up"""
+        return dict(_sum_stats(self._ask_all("stats")), processes=len(self._workers))
+
+    def wait_until_ready(self, min_sockets: int = 1, timeout: Optional[float] = None) -> bool:
+        """
+        waits up to timeout secs for every worker to get ready, see Connector.wait_until_ready.
+        min_sockets is split between the workers like the sliding window
+        """
+        per_worker = max(1, math.ceil(min_sockets / len(self._workers)))
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for worker in self._workers:
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                if not worker.ask(("ready", per_worker, remaining)):
+                    return False
+            except (EOFError, OSError) as e:
+                log.warning(f"connector process {worker.index} did not answer ready, err: {e}")
+                return False
+        return True
+
+    def request_traces(self) -> List[Dict[str, Any]]:
+        """the traces kept by every worker, oldest first"""
+        traces = [t for answer in self._ask_all("traces") for t in answer]
+        return sorted(traces, key=lambda t: t["started_at"])
+
+    def to_prometheus_text(self) -> str:
+        """the metrics of all workers, see merge_prometheus_texts. gauges are labelled with the worker's index"""
+        answers = self._ask_each("metrics")
+        return merge_prometheus_texts([text for _, text in answers], [str(index) for index, _ in answers])
+
+    def shutdown(self, timeout: float = 10) -> NoReturn:
+        """every worker deregisters from the routers and stops, those still running after timeout secs are killed"""
+        self._stop_workers("shutdown", timeout)
+
+    def drain(self, timeout: float) -> Dict[str, int]:
+        """every worker drains, see Connector.drain, and stops. returns the drain results of all workers added up"""
+        results = self._stop_workers(("drain", timeout), timeout + _deregister_timeout_secs)
+        return _sum_stats([r for r in results if isinstance(r, dict)])
+
+    def _stop_workers(self, command: Any, timeout: float) -> List[Any]:
+        self._running = False
+        workers = [w for w in self._workers if w is not None]
+        for worker in workers:
+            try:
+                with worker.lock:
+                    worker.pipe.send(command)
+            except OSError:
+                pass
+        deadline = time.monotonic() + timeout
+        results = []
+        for worker in workers:
+            try:
+                if worker.pipe.poll(max(0.0, deadline - time.monotonic())):
+                    results.append(worker.pipe.recv())
+            except (EOFError, OSError):
+                pass
+            worker.process.join(max(0.0, deadline - time.monotonic()))
+            if worker.process.is_alive():
+                log.warning(f"connector process {worker.index} did not stop in {timeout}s, terminating it")
+                worker.process.terminate()
+            worker.pipe.close()
+        if self._metrics_server is not None:
+            self._metrics_server.shutdown()
+            self._metrics_server.server_close()
+        return results
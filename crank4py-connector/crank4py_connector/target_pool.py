@@ -0,0 +1,231 @@
+# coding=utf-8
+# author=torchcc
+import socket
+import threading
+import time
+from functools import partial
+from typing import Dict, List, NoReturn, Optional, Tuple, Union
+
+from requests import PreparedRequest
+from requests.adapters import HTTPAdapter
+from urllib3 import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.exceptions import NewConnectionError
+
+from crank4py_connector.tracing import active_trace
+from util import HttpClient, create_http_client
+
+
+class PoolStats(object):
+    """what happened to the connections checked out of the target pools"""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        # a pooled connection was reused
+        self.hits: int = 0
+        # a new connection had to be opened
+        self.misses: int = 0
+        # a pooled connection was closed because it stayed idle for too long
+        self.evicted: int = 0
+        # a connection was closed on release because its pool was already full
+        self.discarded: int = 0
+
+    def count(self, event: str) -> NoReturn:
+        with self._lock:
+            setattr(self, event, getattr(self, event) + 1)
+
+    def to_dict(self) -> Dict[str, int]:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "evicted": self.evicted, "discarded": self.discarded}
+
+
+class _TrackedPoolMixin(object):
+    """counts hits and misses of a urllib3 connection pool and closes connections left idle for idle_timeout secs"""
+
+    def __init__(self, *args, pool_stats: PoolStats, idle_timeout: float, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.pool_stats: PoolStats = pool_stats
+        self.idle_timeout: float = idle_timeout
+
+    def _get_conn(self, timeout=None):
+        conn = super()._get_conn(timeout)
+        if self._is_expired(conn, time.monotonic()):
+            conn.close()
+            self.pool_stats.count("evicted")
+        self.pool_stats.count("hits" if conn.sock is not None else "misses")
+        return conn
+
+    def _put_conn(self, conn) -> NoReturn:
+        if conn is not None:
+            if self.pool is not None and self.pool.full():
+                self.pool_stats.count("discarded")
+            conn.crank4py_idle_since = time.monotonic()
+        super()._put_conn(conn)
+
+    def _is_expired(self, conn, now: float) -> bool:
+        return conn is not None and conn.sock is not None and \
+            0 < self.idle_timeout < now - getattr(conn, "crank4py_idle_since", now)
+
+    def evict_idle(self) -> int:
+        """closes the pooled connections that stayed idle for too long, returns how many"""
+        if self.pool is None or self.idle_timeout <= 0:
+            return 0
+        now = time.monotonic()
+        # holding the queue's lock, no connection can be checked out while it is being closed
+        with self.pool.mutex:
+            expired = [conn for conn in self.pool.queue if self._is_expired(conn, now)]
+            for conn in expired:
+                conn.close()
+        for _ in expired:
+            self.pool_stats.count("evicted")
+        return len(expired)
+
+    def idle_connections(self) -> int:
+        if self.pool is None:
+            return 0
+        return sum(1 for conn in list(self.pool.queue) if conn is not None and conn.sock is not None)
+
+
+class _TimedConnectMixin(object):
+    """charges the time spent opening a connection, tls handshake included, to the request traced on this thread"""
+
+    def connect(self) -> NoReturn:
+        trace = active_trace()
+        if trace is None:
+            return super().connect()
+        started = time.monotonic()
+        try:
+            super().connect()
+        finally:
+            trace.add_connect(time.monotonic() - started)
+
+
+class TimedHTTPConnection(_TimedConnectMixin, HTTPConnection):
+    pass
+
+
+class TimedHTTPSConnection(_TimedConnectMixin, HTTPSConnection):
+    pass
+
+
+class UnixHTTPConnection(_TimedConnectMixin, HTTPConnection):
+    """an http connection over a unix domain socket, whatever host the request is addressed to"""
+
+    def __init__(self, *args, unix_socket: str, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.unix_socket: str = unix_socket
+
+    def _new_conn(self) -> socket.socket:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            if isinstance(self.timeout, (int, float)):
+                sock.settimeout(self.timeout)
+            sock.connect(self.unix_socket)
+        except OSError as e:
+            sock.close()
+            raise NewConnectionError(self, f"Failed to connect to unix socket {self.unix_socket}: {e}") from e
+        return sock
+
+
+class TrackedHTTPConnectionPool(_TrackedPoolMixin, HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TrackedUnixHTTPConnectionPool(_TrackedPoolMixin, HTTPConnectionPool):
+    ConnectionCls = UnixHTTPConnection
+
+
+class TrackedHTTPSConnectionPool(_TrackedPoolMixin, HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+class PooledHTTPAdapter(HTTPAdapter):
+    """
+    an HTTPAdapter whose pools report hits and misses, and evict connections that stay idle for idle_timeout secs.
+    with unix_socket every http request is sent over that unix domain socket, whatever host its url names
+    """
+
+    def __init__(self, pool_maxsize: int, idle_timeout: float = 30, tcp_keepalive_secs: int = 0,
+                 pool_block: bool = False, unix_socket: Optional[str] = None) -> None:
+        self.pool_stats: PoolStats = PoolStats()
+        self.idle_timeout: float = idle_timeout
+        self.tcp_keepalive_secs: int = tcp_keepalive_secs
+        self.unix_socket: Optional[str] = unix_socket
+        super().__init__(pool_connections=10, pool_maxsize=pool_maxsize, pool_block=pool_block)
+
+    def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs) -> NoReturn:
+        if self.tcp_keepalive_secs > 0:
+            pool_kwargs["socket_options"] = HTTPConnection.default_socket_options + \
+                                            _keepalive_socket_options(self.tcp_keepalive_secs)
+        super().init_poolmanager(connections, maxsize, block, **pool_kwargs)
+        tracked = {"pool_stats": self.pool_stats, "idle_timeout": self.idle_timeout}
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": partial(TrackedHTTPConnectionPool, **tracked),
+            "https": partial(TrackedHTTPSConnectionPool, **tracked),
+        }
+        if self.unix_socket is not None:
+            self.poolmanager.pool_classes_by_scheme["http"] = partial(
+                TrackedUnixHTTPConnectionPool, unix_socket=self.unix_socket, **tracked)
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        state.update(pool_stats=PoolStats(), idle_timeout=self.idle_timeout,
+                     tcp_keepalive_secs=self.tcp_keepalive_secs, unix_socket=self.unix_socket)
+        return state
+
+    def _pools(self) -> List[_TrackedPoolMixin]:
+        pools = self.poolmanager.pools
+        return [pool for pool in (pools.get(key) for key in pools.keys()) if isinstance(pool, _TrackedPoolMixin)]
+
+    def evict_idle(self) -> int:
+        return sum(pool.evict_idle() for pool in self._pools())
+
+    def prewarm(self, request: PreparedRequest, connections: int, verify: Union[bool, str] = True) -> int:
+        """
+        opens connections to the host of request and leaves them idle in the pool the request would use.
+        all of them are checked out before any is returned, so that each is a connection of its own.
+        returns how many were opened
+        """
+        if hasattr(self, "get_connection_with_tls_context"):
+            pool = self.get_connection_with_tls_context(request, verify)
+        else:
+            # requests < 2.32.2
+            pool = self.get_connection(request.url)
+        conns = [pool._get_conn() for _ in range(connections)]
+        opened = 0
+        try:
+            for conn in conns:
+                if conn.sock is None:
+                    conn.connect()
+                    opened += 1
+        finally:
+            for conn in conns:
+                pool._put_conn(conn)
+        return opened
+
+    def stats(self) -> Dict[str, int]:
+        stats = self.pool_stats.to_dict()
+        stats.update(pools=len(self.poolmanager.pools), pool_maxsize=self._pool_maxsize,
+                     idle=sum(pool.idle_connections() for pool in self._pools()))
+        return stats
+
+
+def _keepalive_socket_options(secs: int) -> List[Tuple[int, int, int]]:
+    options = [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+    if hasattr(socket, "TCP_KEEPIDLE"):
+        options += [(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, secs), (socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, secs)]
+    elif hasattr(socket, "TCP_KEEPALIVE"):
+        # macOS
+        options.append((socket.IPPROTO_TCP, socket.TCP_KEEPALIVE, secs))
+    return options
+
+
+def create_pooled_http_client(pool_maxsize: int, idle_timeout: float = 30, tcp_keepalive_secs: int = 0,
+                              pool_block: bool = False,
+                              unix_socket: Optional[str] = None) -> Tuple[HttpClient, PooledHTTPAdapter]:
+    client = create_http_client()
+    adapter = PooledHTTPAdapter(pool_maxsize, idle_timeout, tcp_keepalive_secs, pool_block, unix_socket)
+    client.mount("http://", adapter)
+    client.mount("https://", adapter)
+    return client, adapter
+
@@ -0,0 +1,202 @@
+# coding=utf-8
+# author=torchcc
+import json
+import random
+import threading
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, NoReturn, Optional, Sequence
+
+from util import log
+
+# the phases of a request, in the order they happen
+PHASES = ("socket_idle", "body_upload", "target_connect", "target_ttfb", "response_stream")
+
+_active = threading.local()
+
+
+def activate(trace: Optional["RequestTrace"]) -> NoReturn:
+    """makes trace the one the target connections opened on this thread are charged to, None to stop"""
+    _active.trace = trace
+
+
+def active_trace() -> Optional["RequestTrace"]:
+    return getattr(_active, "trace", None)
+
+
+class RequestTrace(object):
+    """
+    the timeline of one request through a router socket: the monotonic times it passed each point, from the socket
+    connecting to the end of the response, plus the secs spent opening target connections
+    """
+    __slots__ = ("router", "sock_id", "method", "url", "started_at", "marks", "connect_secs", "status",
+                 "resp_bytes", "from_cache", "outcome")
+
+    def __init__(self, router: str, sock_id: str, method: str, url: str, connected_at: float) -> None:
+        self.router: str = router
+        self.sock_id: str = sock_id
+        self.method: str = method
+        self.url: str = url
+        self.started_at: float = time.time()
+        now = time.monotonic()
+        # connected, received, body_received, target_called, resp_begin, resp_end, ended
+        self.marks: Dict[str, float] = {"connected": connected_at or now, "received": now}
+        self.connect_secs: float = 0.0
+        self.status: Optional[int] = None
+        self.resp_bytes: int = 0
+        self.from_cache: bool = False
+        self.outcome: Optional[str] = None
+
+    def mark(self, point: str) -> NoReturn:
+        """the request passed point now. a point is kept the first time it is passed"""
+        self.marks.setdefault(point, time.monotonic())
+
+    def add_connect(self, secs: float) -> NoReturn:
+        self.connect_secs += secs
+
+    def _between(self, start: str, end: str) -> Optional[float]:
+        if start not in self.marks or end not in self.marks:
+            return None
+        return max(0.0, self.marks[end] - self.marks[start])
+
+    @property
+    def total_secs(self) -> float:
+        return self._between("received", "ended") or 0.0
+
+    def phases(self) -> Dict[str, Optional[float]]:
+        """secs spent in each of PHASES, None for the phases the request never went through"""
+        called = "target_called" in self.marks
+        ttfb = self._between("target_called", "resp_begin")
+        return {
+            # how long the socket waited for this request after connecting to the router
+            "socket_idle": self._between("connected", "received"),
+            "body_upload": self._between("received", "body_received"),
+            "target_connect": self.connect_secs if called else None,
+            "target_ttfb": None if ttfb is None else max(0.0, ttfb - self.connect_secs),
+            "response_stream": self._between("resp_begin", "resp_end"),
+        }
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "started_at": self.started_at,
+            "router": self.router,
+            "sock_id": self.sock_id,
+            "method": self.method,
+            "url": self.url,
+            "outcome": self.outcome,
+            "status": self.status,
+            "resp_bytes": self.resp_bytes,
+            "from_cache": self.from_cache,
+            "total_secs": self.total_secs,
+            "phases": self.phases(),
+        }
+
+
+class TraceExporter(object):
+    """
+    where finished traces go. export() is called by the thread that finished the request, with the dict of
+    RequestTrace.to_dict(), and must not keep it waiting. close() is called once when the connector shuts down,
+    traces exported after that may be dropped
+    """
+
+    def export(self, trace: Dict[str, Any]) -> NoReturn:
+        raise NotImplementedError
+
+    def close(self) -> NoReturn:
+        """writes out what is still buffered and releases what the exporter holds"""
+        pass
+
+
+class RingBufferExporter(TraceExporter):
+    """keeps the last size traces in memory"""
+
+    def __init__(self, size: int = 1000) -> None:
+        self._traces: Deque[Dict[str, Any]] = deque(maxlen=size)
+
+    def export(self, trace: Dict[str, Any]) -> NoReturn:
+        self._traces.append(trace)
+
+    def traces(self) -> List[Dict[str, Any]]:
+        """the traces kept, oldest first"""
+        return list(self._traces)
+
+
+class JsonLinesExporter(TraceExporter):
+    """appends every trace to a file as one line of json"""
+
+    def __init__(self, path: str) -> None:
+        self.path: str = path
+        # one write per line, so that the lines of several worker processes appending to it do not interleave
+        self._file = open(path, "a", encoding="utf-8", buffering=1)
+        self._lock = threading.Lock()
+
+    def export(self, trace: Dict[str, Any]) -> NoReturn:
+        line = json.dumps(trace, separators=(",", ":")) + "\n"
+        with self._lock:
+            if not self._file.closed:
+                self._file.write(line)
+
+    def close(self) -> NoReturn:
+        with self._lock:
+            self._file.close()
+
+
+class RequestTracer(object):
+    """
+    traces the phases of every request. the traces of requests that took slow_threshold_secs or longer, and
+    sample_rate of the others, are handed to the exporters
+    """
+
+    def __init__(self, exporters: Sequence[TraceExporter], slow_threshold_secs: float = 1.0,
+                 sample_rate: float = 0.0) -> None:
+        """
+        :param exporters: where the traces kept go
+        :param slow_threshold_secs: requests taking that long or longer are always exported, 0 exports every request
+        :param sample_rate: the share of the other requests exported too, 0 (default) exports only slow ones
+        """
+        self.exporters: List[TraceExporter] = list(exporters)
+        self.slow_threshold_secs: float = slow_threshold_secs
+        self.sample_rate: float = sample_rate
+        self._lock = threading.Lock()
+        self._traced: int = 0
+        self._slow: int = 0
+        self._exported: int = 0
+
+    def start(self, router: str, sock_id: str, method: str, url: str, connected_at: float) -> RequestTrace:
+        return RequestTrace(router, sock_id, method, url, connected_at)
+
+    def finish(self, trace: RequestTrace, outcome: str) -> NoReturn:
+        trace.outcome = outcome
+        trace.mark("ended")
+        slow = trace.total_secs >= self.slow_threshold_secs
+        export = slow or (self.sample_rate > 0 and random.random() < self.sample_rate)
+        with self._lock:
+            self._traced += 1
+            self._slow += 1 if slow else 0
+            self._exported += 1 if export else 0
+        if not export:
+            return
+        exported = dict(trace.to_dict(), slow=slow)
+        for exporter in self.exporters:
+            try:
+                exporter.export(exported)
+            except Exception as e:
+                log.warning(f"can not export the trace of {trace.url} to {type(exporter).__name__}, err: {e}")
+
+    def close(self) -> NoReturn:
+        """closes every exporter"""
+        for exporter in self.exporters:
+            try:
+                exporter.close()
+            except Exception as e:
+                log.warning(f"can not close trace exporter {type(exporter).__name__}, err: {e}")
+
+    def recent(self) -> List[Dict[str, Any]]:
+        """the traces kept by the ring buffer exporters, oldest first"""
+        return [t for exporter in self.exporters if isinstance(exporter, RingBufferExporter)
+                for t in exporter.traces()]
+
+    def stats(self) -> Dict[str, int]:
+        """requests traced, how many of them were slow, and traces exported"""
+        with self._lock:
+            return {"traced": self._traced, "slow": self._slow, "exported": self._exported}
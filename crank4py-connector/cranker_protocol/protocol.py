@@ -1,8 +1,8 @@
 # coding=utf-8
 # author=torchcc
+import struct
 from abc import ABCMeta, abstractmethod
-from copy import deepcopy
-from typing import NoReturn, List, Optional
+from typing import NoReturn, List, Optional, Iterable, Tuple
 
 __all__ = [
     "HeadersBuilder",
@@ -11,10 +11,16 @@ __all__ = [
     "ProtocolRequest",
     "ProtocolResponse",
     "CrankerProtocolVersion10",
+    "CrankerProtocolVersion30",
+    "StreamMessage",
 ]
 
 SupportingHttpVersion = "HTTP/1.1"
 CrankerProtocolVersion10 = "1.0"
+CrankerProtocolVersion30 = "3.0"
+# offered as websocket subprotocols, most preferred first
+CrankerSubprotocol10 = "cranker_1.0"
+CrankerSubprotocol30 = "cranker_3.0"
 
 RequestBodyPendingMarker = "_1"
 RequestHasNoBodyMarker = "_2"
@@ -28,19 +34,24 @@ class IProtocolMsg(metaclass=ABCMeta):
 
 
 class HeadersBuilder(object):
+    """collects header lines and joins them once, when the message is built"""
 
     def __init__(self):
-        self._headers: str = ""
+        self._lines: List[str] = []
 
     def append_header(self, header: str, value: str) -> NoReturn:
-        self._headers += header + ":" + value + "\n"
+        self._lines.append(header + ":" + value)
 
-    def append_headers(self, headers: List[str]) -> NoReturn:
-        for h in headers:
-            self._headers += h + "\n"
+    def append_headers(self, headers: Iterable[str]) -> NoReturn:
+        self._lines.extend(headers)
+
+    def append_header_items(self, items: Iterable[Tuple[str, str]]) -> NoReturn:
+        self._lines.extend([header + ":" + value for header, value in items])
 
     def __str__(self) -> str:
-        return self._headers
+        if not self._lines:
+            return ""
+        return "\n".join(self._lines) + "\n"
 
     __repr__ = __str__
 
@@ -74,11 +85,8 @@ class HeadersBuilder(object):
 class ProtocolRequest(IProtocolMsg):
 
     def to_protocol_msg(self):
-        if self._req_line is not None and self.headers is not None:
-            headers_str = ""
-            for hl in self.headers:
-                headers_str += hl + "\n"
-            return self._req_line + "\n" + headers_str + self._end_marker
+        if self._req_line:
+            return "\n".join([self._req_line, *self.headers, self._end_marker])
         else:
             return self._end_marker
 
@@ -90,16 +98,18 @@ class ProtocolRequest(IProtocolMsg):
         self._end_marker: str = ""
         self._req_line: str = ""
 
-        if msg == RequestBodyEndedMarker:
+        # request line, header lines and end marker, each found by a single scan of the message
+        req_line, has_lines, rest = msg.partition("\n")
+        if not has_lines:
+            # a bare end marker, e.g. RequestBodyEndedMarker after the body
             self._end_marker = msg
         else:
-            msg_arr = msg.split("\n")
-            self._req_line = req = msg_arr[0]
-            bits = req.split(" ")
-            self.method = bits[0]
-            self.dest = bits[1]
-            self.headers = deepcopy(msg_arr[1:-1])
-            self._end_marker = msg_arr[-1]
+            self._req_line = req_line
+            self.method, _, target = req_line.partition(" ")
+            self.dest = target.partition(" ")[0]
+            headers, has_headers, self._end_marker = rest.rpartition("\n")
+            if has_headers:
+                self.headers = headers.split("\n")
 
     def req_body_pending(self) -> bool:
         return self._end_marker == RequestBodyPendingMarker
@@ -149,7 +159,7 @@ class ProtocolRequestBuilder(object):
 
     def build(self) -> str:
         if self._req_line is not None and self._headers is not None:
-            return self._req_line + "\n" + str(self._headers) + "\n" + self._end_marker
+            return "".join([self._req_line, "\n", str(self._headers), "\n", self._end_marker])
 
 
 """ 
@@ -201,7 +211,19 @@ class ProtocolResponseBuilder(object):
         return self
 
     def build(self) -> str:
-        return SupportingHttpVersion + " " + str(self._status) + " " + self._reason + "\n" + self._method + " " + self._src_url + "\n" + str(self._headers)
+        return "".join([SupportingHttpVersion, " ", str(self._status), " ", self._reason, "\n",
+                        self._method, " ", self._src_url, "\n", str(self._headers)])
+
+    def to_protocol_msg(self) -> str:
+        """
+        the message sent to the router, built directly.
+        same as ProtocolResponse(self.build()).to_protocol_msg(), minus the parsing, and keeping all words of the reason
+        """
+        return self.build() + "\n"
+
+    def build_v3(self) -> str:
+        """the HEADER text of the response on a multiplexed socket: status line and headers, no request line"""
+        return "".join([SupportingHttpVersion, " ", str(self._status), " ", self._reason, "\n", str(self._headers)])
 
 
 # response from connector to router
@@ -214,18 +236,13 @@ class ProtocolResponse(IProtocolMsg):
         self.src_url: str = ""
         self.method: str = ""
 
-        msg_arr = msg.split("\n")
-        bits = msg_arr[0].split(" ")
-        self.status = int(bits[1])
-        if len(bits) >= 3:
-            self._reason = bits[2]
-
-        origin_req: str = msg_arr[1]
-        req_bits: List[str] = origin_req.split(" ")
-        self.method = req_bits[0]
-        if len(req_bits) >= 2:
-            self.src_url = req_bits[1]
-        self.headers = deepcopy(msg_arr[2:])
+        status_line, _, rest = msg.partition("\n")
+        origin_req, has_headers, headers = rest.partition("\n")
+        status, _, self._reason = status_line.partition(" ")[2].partition(" ")
+        self.status = int(status)
+        self.method, _, src_url = origin_req.partition(" ")
+        self.src_url = src_url.partition(" ")[0]
+        self.headers = headers.split("\n") if has_headers else []
 
     def to_protocol_msg(self):
         builder = HeadersBuilder()
@@ -248,3 +265,79 @@ class ProtocolResponse(IProtocolMsg):
 
     __repr__ = __str__
 
+
+"""
+ CRANKER PROTOCOL_ VERSION_3_0
+ <p>
+ many requests, each one a stream, share one websocket. every message is binary and starts with:
+  1 byte message type, 1 byte flags, 4 bytes stream id (big endian)
+ <p>
+ ==== HEADER ====
+  the request line and headers of a request, or the status line and headers of a response, as text.
+  END_HEADER marks the last HEADER message of a stream
+ ==== DATA ====
+  a piece of body. an empty DATA message flagged END_STREAM ends a response
+ ==== RST_STREAM ====
+  4 bytes error code, then a utf-8 message. the stream is given up on by either side
+ ==== WINDOW_UPDATE ====
+  4 bytes, the number of body bytes of the stream the sender has taken in, so that the other side may send more
+ <p>
+ END_STREAM on a request HEADER or DATA message means no more request body is coming.
+"""
+
+
+class StreamMessage(object):
+    DATA = 0
+    HEADER = 1
+    RST_STREAM = 3
+    WINDOW_UPDATE = 8
+
+    END_STREAM = 1
+    END_HEADER = 4
+
+    PREFIX = struct.Struct("!BBi")
+
+    def __init__(self, msg_type: int, flags: int, stream_id: int, payload: bytes) -> None:
+        self.msg_type: int = msg_type
+        self.flags: int = flags
+        self.stream_id: int = stream_id
+        self.payload: bytes = payload
+
+    @classmethod
+    def parse(cls, msg: bytes) -> "StreamMessage":
+        msg_type, flags, stream_id = cls.PREFIX.unpack_from(msg)
+        return cls(msg_type, flags, stream_id, msg[cls.PREFIX.size:])
+
+    @classmethod
+    def prefix(cls, msg_type: int, flags: int, stream_id: int) -> bytes:
+        return cls.PREFIX.pack(msg_type, flags, stream_id)
+
+    @classmethod
+    def header(cls, stream_id: int, text: str, end_stream: bool = False) -> bytes:
+        flags = cls.END_HEADER | (cls.END_STREAM if end_stream else 0)
+        return cls.prefix(cls.HEADER, flags, stream_id) + text.encode("utf-8")
+
+    @classmethod
+    def data(cls, stream_id: int, payload: bytes = b"", end_stream: bool = False) -> bytes:
+        return cls.prefix(cls.DATA, cls.END_STREAM if end_stream else 0, stream_id) + payload
+
+    @classmethod
+    def window_update(cls, stream_id: int, size: int) -> bytes:
+        return cls.prefix(cls.WINDOW_UPDATE, 0, stream_id) + struct.pack("!i", size)
+
+    @classmethod
+    def rst_stream(cls, stream_id: int, code: int, reason: str = "") -> bytes:
+        return cls.prefix(cls.RST_STREAM, 0, stream_id) + struct.pack("!i", code) + reason.encode("utf-8")
+
+    def has(self, flag: int) -> bool:
+        return bool(self.flags & flag)
+
+    def int_payload(self) -> int:
+        """the window size of a WINDOW_UPDATE, the error code of a RST_STREAM"""
+        return struct.unpack_from("!i", self.payload)[0]
+
+    def __str__(self) -> str:
+        return "StreamMessage{type=" + str(self.msg_type) + ", flags=" + str(self.flags) + \
+               ", stream=" + str(self.stream_id) + ", bytes=" + str(len(self.payload)) + "}"
+
+    __repr__ = __str__
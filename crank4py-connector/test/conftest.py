@@ -0,0 +1,7 @@
+# coding=utf-8
+# author=torchcc
+try:
+    import flask  # noqa: F401
+except ImportError:
+    # the flask example needs flask, which the connector does not depend on
+    collect_ignore = ["test_connector_with_flask.py"]
@@ -0,0 +1,69 @@
+# coding=utf-8
+# author=torchcc
+import threading
+from typing import List
+
+from crank4py_connector.app_target import create_app_http_client
+
+
+def _chunks(*parts: bytes):
+    """a request body of unknown length, sent chunked like a body streamed from the router"""
+    yield from parts
+
+
+def test_a_wsgi_app_reads_the_streamed_body_and_answers_with_its_status_and_headers():
+    received: List[bytes] = []
+
+    def app(environ, start_response):
+        received.append(environ["wsgi.input"].read())
+        write = start_response("201 Created", [("Content-Type", "text/plain"), ("X-Received", str(len(received[0])))])
+        # what an app writes comes before what it returns
+        write(b"got ")
+        return [environ["PATH_INFO"].encode(), b"?", environ["QUERY_STRING"].encode()]
+
+    client = create_app_http_client(app)
+    try:
+        resp = client.post("http://target/service-a/upload?x=1", data=_chunks(b"ab", b"cd", b"ef"), stream=True)
+        assert resp.status_code == 201 and resp.reason == "Created"
+        assert resp.headers["X-Received"] == "6" and resp.headers["content-type"] == "text/plain"
+        assert b"".join(resp.iter_content(2)) == b"got /service-a/upload?x=1"
+    finally:
+        client.close()
+    assert received == [b"abcdef"]
+
+
+def test_an_asgi_app_gets_its_lifespan_and_streams_both_bodies():
+    events: List[str] = []
+
+    async def app(scope, receive, send):
+        if scope["type"] == "lifespan":
+            while True:
+                message = await receive()
+                events.append(message["type"])
+                if message["type"] == "lifespan.startup":
+                    await send({"type": "lifespan.startup.complete"})
+                else:
+                    await send({"type": "lifespan.shutdown.complete"})
+                    return
+        body = b""
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if not message.get("more_body"):
+                break
+        events.append(f"{scope['method']} {scope['path']} {body.decode()}")
+        await send({"type": "http.response.start", "status": 202, "headers": [(b"x-received", b"%d" % len(body))]})
+        for chunk in (b"one ", b"two ", b"three"):
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+
+    client = create_app_http_client(app, asgi=True)
+    try:
+        resp = client.put("http://target/service-a/things", data=_chunks(b"x" * 10, b"y" * 5), stream=True)
+        assert resp.status_code == 202 and resp.reason == "Accepted" and resp.headers["X-Received"] == "15"
+        assert resp.content == b"one two three"
+        assert events == ["lifespan.startup", "PUT /service-a/things " + "x" * 10 + "y" * 5]
+    finally:
+        client.close()
+    assert events[-1] == "lifespan.shutdown"
+    assert not any(t.name == "crank4py-asgi-loop" for t in threading.enumerate())
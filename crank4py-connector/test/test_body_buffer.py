@@ -0,0 +1,232 @@
+# coding=utf-8
+# author=torchcc
+"""
+buffered request bodies: when they spill to a temp file, that the file and the memory budget are given back, and
+the Content-Length the target gets for them. the target is a transport adapter recording what it is sent
+"""
+import io
+import threading
+from typing import List, Optional
+
+from requests import PreparedRequest, Response
+from requests.adapters import BaseAdapter
+from requests.exceptions import ConnectionError
+
+from crank4py_connector.intermediate_request import BodyMemoryBudget, BodyBuffer, IntermediateRequest
+from util import create_http_client
+
+_URL = "http://target.example.com/upload"
+
+
+class RecordingAdapter(BaseAdapter):
+    def __init__(self, failure: Optional[Exception] = None) -> None:
+        super().__init__()
+        self.failure: Optional[Exception] = failure
+        self.requests: List[PreparedRequest] = []
+        self.bodies: List[bytes] = []
+
+    def send(self, request: PreparedRequest, **kwargs) -> Response:
+        self.requests.append(request)
+        if self.failure is not None:
+            raise self.failure
+        body = request.body
+        if body is None or isinstance(body, bytes):
+            self.bodies.append(body or b"")
+        elif hasattr(body, "read"):
+            self.bodies.append(body.read())
+        else:
+            self.bodies.append(b"".join(body))
+        resp = Response()
+        resp.status_code = 200
+        resp.raw = io.BytesIO(b"")
+        resp.request = request
+        return resp
+
+    def close(self) -> None:
+        pass
+
+
+def request_with(adapter: RecordingAdapter, budget: BodyMemoryBudget) -> IntermediateRequest:
+    client = create_http_client()
+    client.mount("http://", adapter)
+    req = IntermediateRequest("POST", _URL, client, budget)
+    req.update_header("Content-Type", "application/octet-stream")
+    return req
+
+
+def test_kept_in_memory_up_to_the_spill_threshold(tmp_path):
+    budget = BodyMemoryBudget(spill_threshold=10, spill_dir=str(tmp_path))
+    buffer = budget.new_buffer()
+    buffer.write(b"01234")
+    buffer.write(b"56789")
+    assert not buffer.spilled
+    assert budget.stats() == {"bytes": 10, "spilled": 0}
+    assert buffer.open().read() == b"0123456789"
+    buffer.close()
+    assert budget.stats() == {"bytes": 0, "spilled": 0}
+
+
+def test_spills_beyond_the_spill_threshold(tmp_path):
+    budget = BodyMemoryBudget(spill_threshold=10, spill_dir=str(tmp_path))
+    buffer = budget.new_buffer()
+    buffer.write(b"01234")
+    buffer.write(b"56789")
+    buffer.write(b"a")
+    assert buffer.spilled and buffer.size == 11
+    # the frames kept so far moved to the file with the rest, their memory is given back
+    assert budget.stats() == {"bytes": 0, "spilled": 1}
+    buffer.write(b"bcd")
+    assert buffer.open().read() == b"0123456789abcd"
+    buffer.close()
+
+
+def test_spills_once_the_budget_is_used_up(tmp_path):
+    budget = BodyMemoryBudget(max_bytes=8, spill_dir=str(tmp_path))
+    first, second = budget.new_buffer(), budget.new_buffer()
+    first.write(b"012345")
+    second.write(b"01")
+    assert not first.spilled and not second.spilled
+    assert budget.stats()["bytes"] == 8
+    second.write(b"2")
+    assert second.spilled and not first.spilled
+    assert budget.stats() == {"bytes": 6, "spilled": 1}
+    first.close()
+    second.close()
+    assert budget.stats() == {"bytes": 0, "spilled": 1}
+
+
+def test_discard_closes_the_temp_file_unless_handed_off(tmp_path):
+    budget = BodyMemoryBudget(spill_threshold=4, spill_dir=str(tmp_path))
+    buffer = budget.new_buffer()
+    buffer.write(b"0123456789")
+    body = buffer.open()
+    # the target is reading it, whoever handed it off closes it
+    buffer.discard()
+    assert not body.closed
+    assert body.read() == b"0123456789"
+    buffer.close()
+    assert body.closed
+    # nothing more is written once closed
+    buffer.write(b"x")
+    assert buffer.size == 10
+
+    buffer = budget.new_buffer()
+    buffer.write(b"0123456789")
+    buffer.discard()
+    assert budget.stats() == {"bytes": 0, "spilled": 2}
+    buffer.close()
+
+
+def test_write_after_discard_does_not_charge_the_budget(tmp_path):
+    budget = BodyMemoryBudget(max_bytes=1024, spill_threshold=8, spill_dir=str(tmp_path))
+    buffer = budget.new_buffer()
+    buffer.write(b"0123")
+    buffer.discard()
+    # a frame still on its way from the router after the request was aborted
+    buffer.write(b"4567")
+    buffer.write(b"x" * 100)
+    assert buffer.size == 4 and not buffer.spilled
+    assert budget.stats() == {"bytes": 0, "spilled": 0}
+
+
+def test_a_discard_while_a_frame_is_written_gives_back_what_the_frame_reserved(tmp_path):
+    entered, discarded = threading.Event(), threading.Event()
+
+    class SlowBudget(BodyMemoryBudget):
+        def reserve(self, size: int) -> bool:
+            # the router thread is half way through write() when the request is aborted
+            entered.set()
+            discarded.wait(0.5)
+            return super().reserve(size)
+
+    budget = SlowBudget(spill_dir=str(tmp_path))
+    buffer = budget.new_buffer()
+    writer = threading.Thread(target=buffer.write, args=(b"x" * 64,))
+    writer.start()
+    assert entered.wait(5)
+    buffer.discard()
+    discarded.set()
+    writer.join()
+    assert budget.stats()["bytes"] == 0
+
+
+def test_aborted_request_gives_back_its_buffer(tmp_path):
+    budget = BodyMemoryBudget(max_bytes=1024, spill_dir=str(tmp_path))
+    req = request_with(RecordingAdapter(), budget)
+    req.add_body_part(b"x" * 100)
+    assert budget.stats()["bytes"] == 100
+    req.abort(IOError("router went away"))
+    assert budget.stats()["bytes"] == 0
+    results = []
+    req.fire_req_from_connector_to_target_service(results.append)
+    assert isinstance(results[0].failure, IOError) and not results[0].is_succeeded
+
+
+def test_failed_target_call_closes_the_temp_file(tmp_path):
+    budget = BodyMemoryBudget(spill_threshold=4, spill_dir=str(tmp_path))
+    adapter = RecordingAdapter(ConnectionError("connection refused"))
+    req = request_with(adapter, budget)
+    req.add_body_part(b"0123456789")
+    results = []
+    req.fire_req_from_connector_to_target_service(results.append)
+    assert isinstance(results[0].failure, ConnectionError)
+    assert adapter.requests[0].body.closed
+    assert budget.stats() == {"bytes": 0, "spilled": 1}
+
+
+def test_content_length_of_a_body_in_memory():
+    adapter = RecordingAdapter()
+    req = request_with(adapter, BodyMemoryBudget())
+    for part in (b"0123", b"4567", b"89"):
+        req.add_body_part(part)
+    req._send(req._body())
+    sent = adapter.requests[0]
+    assert sent.headers["Content-Length"] == "10"
+    assert "Transfer-Encoding" not in sent.headers
+    assert sent.headers["Content-Type"] == "application/octet-stream"
+    assert adapter.bodies == [b"0123456789"]
+
+
+def test_content_length_of_a_spilled_body(tmp_path):
+    adapter = RecordingAdapter()
+    req = request_with(adapter, BodyMemoryBudget(spill_threshold=4, spill_dir=str(tmp_path)))
+    for part in (b"0123", b"4567", b"89"):
+        req.add_body_part(part)
+    assert req.content.spilled
+    req._send(req._body())
+    sent = adapter.requests[0]
+    assert sent.headers["Content-Length"] == "10"
+    assert "Transfer-Encoding" not in sent.headers
+    assert adapter.bodies == [b"0123456789"]
+    req.content.close()
+
+
+def test_content_length_of_an_empty_body():
+    adapter = RecordingAdapter()
+    req = request_with(adapter, BodyMemoryBudget())
+    req._send(req._body())
+    assert adapter.requests[0].headers["Content-Length"] == "0"
+    assert adapter.bodies == [b""]
+
+
+def test_streamed_body_is_sent_chunked_unless_its_length_is_known():
+    for headers, expected in (({}, None), ({"Content-Length": "10"}, "10")):
+        adapter = RecordingAdapter()
+        req = request_with(adapter, BodyMemoryBudget())
+        for header, value in headers.items():
+            req.update_header(header, value)
+        req.stream_body(1024)
+        req.add_body_part(b"0123456789")
+        req.end_body()
+        req._send(req._body())
+        sent = adapter.requests[0]
+        assert sent.headers.get("Content-Length") == expected
+        assert sent.headers.get("Transfer-Encoding") == (None if expected else "chunked")
+        assert adapter.bodies == [b"0123456789"]
+
+
+def test_buffer_without_a_budget_never_spills():
+    buffer = BodyBuffer()
+    buffer.write(b"x" * (1 << 20))
+    assert not buffer.spilled
+    buffer.close()
@@ -0,0 +1,169 @@
+# coding=utf-8
+# author=torchcc
+"""
+the router circuit breaker and the reconnect backoff of a socket, on a clock and random numbers of the test's own
+"""
+import random
+from typing import List, NoReturn, Tuple
+
+from yarl import URL
+
+from crank4py_connector.conn_info_n_ws_client_farm import ConnInfo, RouterCircuitBreaker
+
+_ROUTER = URL("wss://localhost:9070")
+
+
+class Clock(object):
+    def __init__(self) -> None:
+        self.now: float = 1000
+
+    def __call__(self) -> float:
+        return self.now
+
+    def advance(self, secs: float) -> NoReturn:
+        self.now += secs
+
+
+class Extremes(object):
+    """a random number generator always picking the low or the high end of the range, recording the ranges"""
+
+    def __init__(self, high: bool = True) -> None:
+        self.high: bool = high
+        self.ranges: List[Tuple[float, float]] = []
+
+    def uniform(self, a: float, b: float) -> float:
+        self.ranges.append((a, b))
+        return b if self.high else a
+
+
+def breaker(clock: Clock, rng=None, on_close=None) -> RouterCircuitBreaker:
+    return RouterCircuitBreaker(failure_threshold=3, open_secs=5, max_open_secs=60, on_close=on_close,
+                                clock=clock, rng=rng or Extremes())
+
+
+def test_opens_after_failure_threshold_connects_in_a_row():
+    b = breaker(Clock())
+    prober, other = ConnInfo(_ROUTER, 0, b), ConnInfo(_ROUTER, 1, b)
+    assert b.on_connect_failed(other) == 0
+    assert b.on_connect_failed(other) == 0
+    assert b.state == RouterCircuitBreaker.CLOSED and b.is_closed
+    assert b.on_connect_failed(prober) == 5
+    assert b.state == RouterCircuitBreaker.OPEN and not b.is_closed
+    # only the socket that opened the circuit probes the router, the others are dropped
+    assert b.on_connect_failed(other) is None
+    assert not b.may_reconnect(other)
+    assert b.may_reconnect(prober)
+
+
+def test_a_connect_in_between_resets_the_failure_count():
+    b = breaker(Clock())
+    info = ConnInfo(_ROUTER, 0, b)
+    b.on_connect_failed(info)
+    b.on_connect_failed(info)
+    b.on_connected()
+    assert b.on_connect_failed(info) == 0
+    assert b.on_connect_failed(info) == 0
+    assert b.state == RouterCircuitBreaker.CLOSED
+
+
+def test_half_open_once_the_open_time_is_over():
+    clock = Clock()
+    b = breaker(clock)
+    prober = ConnInfo(_ROUTER, 0, b)
+    for _ in range(3):
+        b.on_connect_failed(prober)
+    clock.advance(4.99)
+    assert b.state == RouterCircuitBreaker.OPEN
+    clock.advance(0.01)
+    assert b.state == RouterCircuitBreaker.HALF_OPEN
+
+
+def test_failed_probe_reopens_for_longer_up_to_max_open_secs():
+    clock = Clock()
+    b = breaker(clock)
+    prober = ConnInfo(_ROUTER, 0, b)
+    for _ in range(3):
+        b.on_connect_failed(prober)
+    opened = []
+    for _ in range(4):
+        clock.advance(60)
+        assert b.state == RouterCircuitBreaker.HALF_OPEN
+        opened.append(b.on_connect_failed(prober))
+        assert b.state == RouterCircuitBreaker.OPEN
+    assert opened == [15, 45, 60, 60]
+    clock.advance(59.99)
+    assert b.state == RouterCircuitBreaker.OPEN
+    clock.advance(0.01)
+    assert b.state == RouterCircuitBreaker.HALF_OPEN
+
+
+def test_successful_probe_closes_the_circuit():
+    clock, closed = Clock(), []
+    rng = Extremes()
+    b = breaker(clock, rng, on_close=lambda: closed.append(True))
+    prober, other = ConnInfo(_ROUTER, 0, b), ConnInfo(_ROUTER, 1, b)
+    for _ in range(4):
+        b.on_connect_failed(prober)
+    clock.advance(15)
+    b.on_connected()
+    assert b.state == RouterCircuitBreaker.CLOSED and closed == [True]
+    assert b.may_reconnect(other)
+    # closing again is not a transition
+    b.on_connected()
+    assert closed == [True]
+    # the open time starts over the next time the circuit opens
+    for _ in range(3):
+        b.on_connect_failed(other)
+    assert rng.ranges[-1] == (5, 5)
+    assert b.on_connect_failed(prober) is None
+
+
+def test_open_secs_jitter_bounds():
+    for seed in range(20):
+        clock = Clock()
+        b = breaker(clock, random.Random(seed))
+        prober = ConnInfo(_ROUTER, 0, b)
+        for _ in range(2):
+            b.on_connect_failed(prober)
+        prev = 0
+        for _ in range(30):
+            secs = b.on_connect_failed(prober)
+            assert 5 <= secs <= min(60, max(5, prev * 3))
+            prev = secs
+            clock.advance(secs)
+            assert b.state == RouterCircuitBreaker.HALF_OPEN
+
+
+def test_retry_jitter_extremes():
+    assert [ConnInfo(_ROUTER, 0, rng=Extremes(high=False)).retry_after_millis() for _ in range(3)] == [500] * 3
+    info = ConnInfo(_ROUTER, 0, rng=Extremes())
+    assert [info.retry_after_millis() for _ in range(5)] == [1500, 4500, 10000, 10000, 10000]
+    info.on_connected_successfully()
+    assert info.retry_after_millis() == 1500
+
+
+def test_retry_jitter_bounds():
+    for seed in range(20):
+        info = ConnInfo(_ROUTER, 0, rng=random.Random(seed))
+        prev = 500
+        for _ in range(50):
+            delay = info.retry_after_millis()
+            # each delay is drawn between the base and 3 times the previous one, which was truncated to millis
+            assert 500 <= delay <= min(10000, (prev + 1) * 3)
+            prev = delay
+
+
+def test_reconnect_delay_waits_out_the_open_circuit():
+    b = breaker(Clock())
+    prober = ConnInfo(_ROUTER, 0, b, rng=Extremes(high=False))
+    other = ConnInfo(_ROUTER, 1, b, rng=Extremes(high=False))
+    assert prober.reconnect_after_millis(connect_failed=True) == 500
+    assert prober.reconnect_after_millis(connect_failed=True) == 500
+    assert prober.reconnect_after_millis(connect_failed=True) == 5000
+    # sockets of the router that lost their connection are not replaced while the circuit is open
+    assert other.reconnect_after_millis(connect_failed=False) is None
+    assert other.reconnect_after_millis(connect_failed=True) is None
+    assert prober.reconnect_after_millis(connect_failed=False) == 500
+    prober.on_connected_successfully()
+    assert b.is_closed
+    assert other.reconnect_after_millis(connect_failed=False) == 500
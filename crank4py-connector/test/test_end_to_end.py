@@ -0,0 +1,287 @@
+# coding=utf-8
+# author=torchcc
+"""
+requests proxied through a real connector, between the benchmark's stand-in router and target service
+"""
+import asyncio
+import json
+import socket
+import threading
+import time
+from typing import Callable, List, NoReturn, Optional, Tuple
+
+import pytest
+from yarl import URL
+
+from benchmark.fake_router import FakeRouter, RouterResponse
+from benchmark.target_server import TargetServer
+from crank4py_connector import Config, create_and_start_connector
+from crank4py_connector.tracing import JsonLinesExporter
+
+
+class Proxy(object):
+    """a router, a target and a connector between them, configured by configure(config)"""
+
+    def __init__(self, configure: Callable[[Config], None] = lambda c: None, window: int = 2) -> None:
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, name="test-router", daemon=True).start()
+        self.router: FakeRouter = self._run(FakeRouter().start())
+        self.target: TargetServer = TargetServer().start()
+        config = Config(self.target.uri, "service-a", [self.router.uri], component_name="test")
+        config.set_logging("WARNING")
+        config.set_sliding_window_size(window)
+        configure(config)
+        self.connector = create_and_start_connector(config)
+        deadline = time.monotonic() + 10
+        while self.router.idle_count < window and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def _run(self, coro, timeout: float = 60):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(timeout)
+
+    def request(self, method: str, dest: str, **kwargs) -> RouterResponse:
+        return self._run(self.router.request(method, dest, **kwargs))
+
+    def requests(self, count: int, method: str, dest: str, **kwargs) -> List[Tuple[float, RouterResponse]]:
+        """sends count requests at once, the latency and response of each"""
+
+        async def timed() -> Tuple[float, RouterResponse]:
+            started = time.monotonic()
+            resp = await self.router.request(method, dest, **kwargs)
+            return time.monotonic() - started, resp
+
+        async def all_of_them():
+            return await asyncio.gather(*(timed() for _ in range(count)))
+
+        return self._run(all_of_them())
+
+    def close(self) -> NoReturn:
+        self.connector.shutdown()
+        self.connector.wait_deregistered(5)
+        self._run(self.router.close())
+        self.target.shutdown()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def __enter__(self) -> "Proxy":
+        return self
+
+    def __exit__(self, *exc_info) -> Optional[bool]:
+        self.close()
+        return None
+
+
+def test_requests_are_not_held_up_by_the_closing_handshake():
+    # the socket of a finished request is closed from a target worker, while its read loop waits in select
+    with Proxy() as proxy:
+        started = time.monotonic()
+        results = proxy.requests(40, "GET", "/service-a/load?size=1024")
+        took = time.monotonic() - started
+    assert [resp.status for _, resp in results] == [200] * 40
+    assert all(resp.body_size == 1024 and resp.close_code == 1000 for _, resp in results)
+    assert took < 3, f"40 requests took {took:.2f}s"
+    assert max(latency for latency, _ in results) < 3
+
+
+def test_streamed_bodies_above_the_limit_are_not_held_up():
+    # the target is called as soon as the headers arrive, its socket is closed once the body is streamed to it
+    body = bytes(range(256)) * 1024
+    with Proxy(lambda c: c.set_req_body_stream_limit(64 * 1024)) as proxy:
+        started = time.monotonic()
+        results = proxy.requests(20, "POST", "/service-a/upload?size=2",
+                                 headers={"Content-Length": str(len(body))}, body=body)
+        took = time.monotonic() - started
+    assert [resp.status for _, resp in results] == [200] * 20
+    assert all(resp.close_code == 1000 for _, resp in results)
+    assert took < 3, f"20 uploads took {took:.2f}s"
+
+
+def test_concurrent_requests_are_not_capped_by_the_window():
+    # every request in flight keeps its socket, and the read loop of it, until the response is sent
+    with Proxy(lambda c: c.set_worker_budget(target_workers=32)) as proxy:
+        started = time.monotonic()
+        results = proxy.requests(20, "GET", "/service-a/load?size=2&delay=1")
+        took = time.monotonic() - started
+    assert [resp.status for _, resp in results] == [200] * 20
+    assert took < 2.5, f"20 concurrent 1s requests took {took:.2f}s"
+
+
+def test_cached_responses_are_served_and_revalidated():
+    with Proxy(lambda c: c.set_response_cache(1 << 20)) as proxy:
+        dest = "/service-a/cached?size=16&etag=v1&max_age=1"
+        first, second = proxy.request("GET", dest), proxy.request("GET", dest)
+        time.sleep(1.1)
+        # stale by now, the target is asked whether it changed
+        third = proxy.request("GET", dest)
+        metrics = proxy.connector.metrics.to_prometheus_text()
+        statuses = proxy.target.statuses
+    assert [resp.status for resp in (first, second, third)] == [200] * 3
+    assert [resp.body_size for resp in (first, second, third)] == [16] * 3
+    assert statuses == [200, 304]
+    for event, count in (("hits", 1), ("misses", 1), ("revalidated", 1), ("stored", 1), ("evicted", 0)):
+        assert f'crank4py_response_cache_total{{event="{event}"}} {count}\n' in metrics
+
+
+def test_a_connector_without_heartbeat_starts_and_serves_requests():
+    # a ping interval of 0 never pings
+    with Proxy(lambda c: c.set_heartbeat(0)) as proxy:
+        resp = proxy.request("GET", "/service-a/load?size=16")
+        heartbeat_sockets = proxy.connector.stats()["heartbeat_sockets"]
+    assert resp.status == 200 and resp.body_size == 16
+    assert heartbeat_sockets == 0
+
+
+@pytest.mark.parametrize("engine", ["thread", "asyncio"])
+def test_a_slow_upload_outlasting_the_ping_timeout_is_not_aborted(engine):
+    # the reader waits on the target while the body stream is full, the pongs queue up behind the body.
+    # the body is well over what the socket buffers between router, connector and target take in
+    body = bytes(range(256)) * 64 * 1024
+
+    def configure(c: Config) -> NoReturn:
+        c.set_engine(engine)
+        c.set_req_body_stream_limit(64 * 1024)
+        c.set_heartbeat(ping_interval_secs=0.3, ping_timeout_secs=0.2)
+
+    with Proxy(configure) as proxy:
+        started = time.monotonic()
+        resp = proxy.request("POST", "/service-a/upload?size=2&read_delay=0.1",
+                             headers={"Content-Length": str(len(body))}, body=body)
+        took = time.monotonic() - started
+    assert took > 1
+    assert resp.status == 200 and resp.close_code == 1000
+
+
+@pytest.mark.parametrize("engine", ["thread", "asyncio"])
+def test_no_scheduler_threads_are_left_after_shutdown(engine):
+    with Proxy(lambda c: c.set_engine(engine)) as proxy:
+        assert proxy.request("GET", "/service-a/load?size=16").status == 200
+    if engine == "asyncio":
+        assert proxy.connector._loop.is_closed()
+    lanes = ("crank4py-ws-io", "crank4py-target", "crank4py-reconnect", "crank4py-read-ahead", "crank4py-timer",
+             "crank4py-aio-loop")
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline:
+        left = [t.name for t in threading.enumerate() if t.name.startswith(lanes)]
+        if not left:
+            break
+        time.sleep(0.05)
+    assert left == []
+
+
+def test_drain_waits_for_the_requests_in_flight_up_to_its_timeout():
+    with Proxy() as proxy:
+        fast = asyncio.run_coroutine_threadsafe(proxy.router.request("GET", "/service-a/load?size=16&delay=0.5"),
+                                                proxy.loop)
+        slow = asyncio.run_coroutine_threadsafe(proxy.router.request("GET", "/service-a/load?size=16&delay=10"),
+                                                proxy.loop)
+        deadline = time.monotonic() + 5
+        # both requests in flight, and their sockets replaced
+        while (proxy.connector.metrics.in_flight.value < 2 or proxy.connector.stats()["idle_sockets"] < 2) and \
+                time.monotonic() < deadline:
+            time.sleep(0.01)
+        started = time.monotonic()
+        result = proxy.connector.drain(2)
+        took = time.monotonic() - started
+        assert proxy.connector.wait_deregistered(5)
+        deregistered = proxy.router.deregistered
+        fast_resp, slow_resp = fast.result(5), slow.result(5)
+    assert result == {"idle_closed": 2, "completed": 1, "cut_off": 1}
+    assert 2 <= took < 3
+    assert deregistered == 1
+    assert fast_resp.status == 200 and fast_resp.body_size == 16 and fast_resp.close_code == 1000
+    # going away
+    assert slow_resp.close_code == 1001
+
+
+def test_the_connector_gets_ready_once_a_router_comes_up():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="test-router", daemon=True).start()
+    target = TargetServer().start()
+    config = Config(target.uri, "service-a", [f"ws://127.0.0.1:{port}"], component_name="test")
+    config.set_logging("WARNING")
+    config.set_sliding_window_size(2)
+    connector = create_and_start_connector(config)
+    router = None
+    try:
+        assert not connector.wait_until_ready(timeout=0.5)
+        router = asyncio.run_coroutine_threadsafe(FakeRouter(port=port).start(), loop).result(5)
+        assert connector.wait_until_ready(min_sockets=2, timeout=10)
+        assert connector.startup_stats()["first_socket"] > 0.5
+    finally:
+        connector.shutdown()
+        connector.wait_deregistered(5)
+        if router is not None:
+            asyncio.run_coroutine_threadsafe(router.close(), loop).result(5)
+        target.shutdown()
+        loop.call_soon_threadsafe(loop.stop)
+
+
+def test_the_target_connections_are_prewarmed_before_the_connector_is_ready():
+    with Proxy(lambda c: c.set_target_prewarm(3)) as proxy:
+        assert proxy.connector.wait_until_ready(timeout=5)
+        prewarmed = proxy.connector.startup_stats()["target_prewarmed"]
+        pool = proxy.connector.target_pool_stats()
+    assert prewarmed == 3
+    # open and idle in the pool, for the first requests to pick up
+    assert pool["idle"] == 3 and pool["misses"] == 3
+
+
+def test_the_target_lane_grows_with_the_routers_and_the_window():
+    with Proxy(window=40) as proxy:
+        # up to twice the window of idle sockets, over a single router
+        assert proxy.connector.scheduler.target.max_workers == 80
+        # every target worker can keep its connection to the target
+        assert proxy.connector.target_pool_stats()["pool_maxsize"] == 80
+
+
+def test_the_target_pool_follows_the_target_workers():
+    with Proxy(lambda c: c.set_worker_budget(target_workers=48)) as proxy:
+        assert proxy.connector.target_pool_stats()["pool_maxsize"] == 48
+    with Proxy(lambda c: c.set_target_pool(pool_maxsize=7)) as proxy:
+        assert proxy.connector.target_pool_stats()["pool_maxsize"] == 7
+
+
+def test_the_asyncio_engine_serves_requests():
+    with Proxy(lambda c: c.set_engine("asyncio")) as proxy:
+        results = proxy.requests(10, "GET", "/service-a/load?size=1024")
+        connects = proxy.connector.metrics.connects.labels(str(URL(proxy.router.uri).origin())).value
+    assert [resp.status for _, resp in results] == [200] * 10
+    assert all(resp.body_size == 1024 for _, resp in results)
+    assert connects >= 10
+
+
+def test_an_asgi_app_target_is_shut_down_with_the_connector():
+    events: List[str] = []
+
+    async def app(scope, receive, send):
+        if scope["type"] == "lifespan":
+            while True:
+                message = await receive()
+                events.append(message["type"])
+                await send({"type": message["type"] + ".complete"})
+                if message["type"] == "lifespan.shutdown":
+                    return
+        await send({"type": "http.response.start", "status": 200, "headers": [(b"content-length", b"2")]})
+        await send({"type": "http.response.body", "body": b"hi"})
+
+    with Proxy(lambda c: c.set_target_app(app, "asgi")) as proxy:
+        resp = proxy.request("GET", "/service-a/hi", keep_body=True)
+    assert resp.status == 200 and resp.body == b"hi"
+    assert events == ["lifespan.startup", "lifespan.shutdown"]
+
+
+def test_traces_are_written_out_and_the_file_closed_on_shutdown(tmp_path):
+    path = str(tmp_path / "traces.jsonl")
+    with Proxy(lambda c: c.set_request_tracing(slow_threshold_secs=0, jsonl_path=path)) as proxy:
+        assert proxy.request("GET", "/service-a/load?size=16").status == 200
+        # the trace is exported once the socket is done with the request, maybe after the router got the response
+        deadline = time.monotonic() + 5
+        while proxy.connector.tracer.stats()["exported"] < 1 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        exporter = next(e for e in proxy.connector.tracer.exporters if isinstance(e, JsonLinesExporter))
+    assert exporter._file.closed
+    with open(path, encoding="utf-8") as f:
+        traces = [json.loads(line) for line in f]
+    assert [trace["status"] for trace in traces] == [200]
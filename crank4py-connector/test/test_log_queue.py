@@ -0,0 +1,150 @@
+# coding=utf-8
+# author=torchcc
+"""
+the log thread: no record lost when its queue is resized, flushing waits for what was queued, and it is only
+started once logging is configured
+"""
+import logging
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import List, NoReturn, Tuple
+
+from util import _LogQueue
+
+
+class Recorder(logging.Handler):
+    def __init__(self, delay: float = 0) -> None:
+        super().__init__()
+        self.delay: float = delay
+        self.gate = threading.Event()
+        self.gate.set()
+        self.messages: List[str] = []
+
+    def emit(self, record: logging.LogRecord) -> NoReturn:
+        self.gate.wait()
+        if self.delay:
+            time.sleep(self.delay)
+        self.messages.append(record.getMessage())
+
+
+def queued_logger(name: str, handler: Recorder, size: int) -> Tuple[logging.Logger, _LogQueue]:
+    logger = logging.Logger(name, logging.DEBUG)
+    logger.addHandler(handler)
+    log_queue = _LogQueue(logger, size)
+    log_queue.start()
+    return logger, log_queue
+
+
+def test_resize_keeps_the_records_queued_and_in_flight():
+    handler = Recorder()
+    logger, log_queue = queued_logger("test-resize", handler, 100000)
+    count = 20000
+
+    def write():
+        for i in range(count):
+            logger.info("record %d", i)
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    for size in (50000, 100000, 60000, 80000, 100000):
+        log_queue.resize(size)
+    writer.join()
+    assert log_queue.flush(5)
+    log_queue.stop()
+    assert log_queue.handler.dropped == 0
+    assert handler.messages == [f"record {i}" for i in range(count)]
+
+
+def test_resize_to_a_smaller_queue_than_the_records_waiting():
+    handler = Recorder()
+    handler.gate.clear()
+    logger, log_queue = queued_logger("test-shrink", handler, 100)
+    for i in range(50):
+        logger.info("record %d", i)
+    threading.Timer(0.2, handler.gate.set).start()
+    # the old listener writes out the records it holds, the new queue only gets the new ones
+    log_queue.resize(10)
+    assert log_queue.size == 10
+    logger.info("after")
+    assert log_queue.flush(5)
+    log_queue.stop()
+    assert handler.messages == [f"record {i}" for i in range(50)] + ["after"]
+
+
+def test_flush_waits_for_the_records_queued_before_it():
+    handler = Recorder(delay=0.002)
+    logger, log_queue = queued_logger("test-flush", handler, 1000)
+    for i in range(100):
+        logger.info("record %d", i)
+    assert log_queue.flush(5)
+    assert handler.messages == [f"record {i}" for i in range(100)]
+    log_queue.stop()
+
+
+def test_flush_gives_up_after_timeout():
+    handler = Recorder()
+    handler.gate.clear()
+    logger, log_queue = queued_logger("test-flush-timeout", handler, 1000)
+    logger.info("stuck")
+    started = time.monotonic()
+    assert not log_queue.flush(0.2)
+    assert time.monotonic() - started < 1
+    handler.gate.set()
+    assert log_queue.flush(5)
+    log_queue.stop()
+    assert handler.messages == ["stuck"]
+
+
+def test_flush_without_a_log_thread():
+    logger = logging.Logger("test-not-started", logging.DEBUG)
+    logger.addHandler(Recorder())
+    assert _LogQueue(logger, 10).flush(0.1)
+
+
+def test_log_thread_is_started_by_configure_logging():
+    script = """
+import threading
+import util
+before = threading.active_count()
+assert util._log_queue is None and util.dropped_log_records() == 0 and util.flush_logs()
+assert not any(isinstance(h, util._DroppingQueueHandler) for h in util.log.handlers)
+util.configure_logging("INFO", queue_size=100)
+assert threading.active_count() == before + 1
+assert util._log_queue.size == 100
+assert any(isinstance(h, util._DroppingQueueHandler) for h in util.log.handlers)
+util.log.info("logged by the log thread")
+assert util.flush_logs()
+print("ok")
+"""
+    done = subprocess.run([sys.executable, "-c", script], cwd=str(Path(__file__).parent.parent),
+                          capture_output=True, text=True, timeout=30)
+    assert done.returncode == 0, done.stderr
+    assert done.stdout == "ok\n"
+    assert "logged by the log thread" in done.stderr
+
+
+def test_records_are_formatted_on_the_log_thread():
+    formatted_on = []
+
+    class Arg(object):
+        def __str__(self) -> str:
+            formatted_on.append(threading.current_thread())
+            return "arg"
+
+    handler = Recorder()
+    # the log thread waits in emit until the logging thread checked that nothing was formatted yet
+    handler.gate.clear()
+    logger, log_queue = queued_logger("test-format", handler, 10)
+    try:
+        raise ValueError("boom")
+    except ValueError:
+        logger.exception("failed with %s", Arg())
+    assert formatted_on == []
+    handler.gate.set()
+    assert log_queue.flush(5)
+    log_queue.stop()
+    assert handler.messages == ["failed with arg"]
+    assert formatted_on and threading.current_thread() not in formatted_on
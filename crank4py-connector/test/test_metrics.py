@@ -0,0 +1,71 @@
+# coding=utf-8
+# author=torchcc
+import requests
+
+from crank4py_connector.metrics import ConnectorMetrics, MetricsServer, merge_prometheus_texts
+
+
+def _families(text: str):
+    """the family of every sample line, in order, by the TYPE line it comes after"""
+    family, families = None, []
+    for line in text.splitlines():
+        if line.startswith("# TYPE "):
+            family = line.split(" ")[2]
+        elif not line.startswith("#"):
+            families.append(family)
+    return families
+
+
+def test_every_family_stays_one_group_when_the_workers_have_different_series():
+    first, second = ConnectorMetrics(), ConnectorMetrics()
+    first.websocket_closes.labels("1000").inc(2)
+    second.websocket_closes.labels("1000").inc(3)
+    second.websocket_closes.labels("1006").inc()
+    second.request_phase.labels("target_ttfb").observe(0.2)
+    merged = merge_prometheus_texts([first.registry.to_prometheus_text(), second.registry.to_prometheus_text()])
+    lines = merged.splitlines()
+    assert 'crank4py_websocket_closes_total{code="1000"} 5' in lines
+    assert 'crank4py_websocket_closes_total{code="1006"} 1' in lines
+    families = _families(merged)
+    # a family's samples come right after its own header, and every header shows up once
+    assert all(family is not None and sample.startswith(family) for family, sample in
+               zip(families, (line for line in lines if not line.startswith("#"))))
+    assert len([line for line in lines if line.startswith("# TYPE crank4py_websocket_closes_total ")]) == 1
+    closes = [i for i, line in enumerate(lines) if line.startswith("crank4py_websocket_closes_total")]
+    assert closes == list(range(closes[0], closes[0] + 2))
+    assert lines.index("# TYPE crank4py_websocket_closes_total counter") == closes[0] - 1
+
+
+def test_counters_and_histograms_are_added_up_and_gauges_kept_per_worker():
+    first, second = ConnectorMetrics(), ConnectorMetrics()
+    for metrics, share in ((first, 0.5), (second, 1.5)):
+        metrics.router_share.labels("ws://router").set(share)
+        metrics.idle_sockets.labels("ws://router").set(2)
+        metrics.websocket_closes.labels("1000").inc()
+        metrics.request_phase.labels("target_ttfb").observe(0.2)
+    lines = merge_prometheus_texts([first.registry.to_prometheus_text(), second.registry.to_prometheus_text()],
+                                   ["a", "b"]).splitlines()
+    assert 'crank4py_router_window_share{worker="a",router="ws://router"} 0.5' in lines
+    assert 'crank4py_router_window_share{worker="b",router="ws://router"} 1.5' in lines
+    assert 'crank4py_idle_sockets{worker="b",router="ws://router"} 2' in lines
+    assert 'crank4py_websocket_closes_total{code="1000"} 2' in lines
+    assert 'crank4py_request_phase_seconds_count{phase="target_ttfb"} 2' in lines
+    assert 'crank4py_request_phase_seconds_bucket{phase="target_ttfb",le="+Inf"} 2' in lines
+    # a gauge without labels gets the worker label alone, by the index of its text by default
+    gauge = "# TYPE up gauge\nup 1\n"
+    assert merge_prometheus_texts([gauge, gauge]).splitlines()[1:] == ['up{worker="0"} 1', 'up{worker="1"} 1']
+
+
+def test_the_metrics_are_served_over_http():
+    metrics = ConnectorMetrics()
+    metrics.websocket_closes.labels("1000").inc()
+    server = MetricsServer(metrics.registry, 0, "127.0.0.1").start()
+    try:
+        resp = requests.get(f"http://127.0.0.1:{server.server_address[1]}/metrics", timeout=5)
+        missing = requests.get(f"http://127.0.0.1:{server.server_address[1]}/other", timeout=5)
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert resp.status_code == 200 and resp.headers["Content-Type"].startswith("text/plain; version=0.0.4")
+    assert 'crank4py_websocket_closes_total{code="1000"} 1' in resp.text.splitlines()
+    assert missing.status_code == 404
@@ -0,0 +1,286 @@
+# coding=utf-8
+# author=torchcc
+"""
+the multiplexed protocol: its messages, and the streams of a session in front of the benchmark's target service.
+the session's socket is a ConnectorSocket that is never connected, the messages it sends are recorded instead
+"""
+import struct
+import threading
+import time
+from typing import List, NoReturn, Optional
+
+import pytest
+from yarl import URL
+
+from benchmark.target_server import TargetServer
+from crank4py_connector.conn_info_n_ws_client_farm import ConnInfo, WebsocketClientFarm
+from crank4py_connector.connector_socket import ConnectorSocket
+from crank4py_connector.multiplexed import Multiplexing, RST_PROXY_FAILURE
+from crank4py_connector.scheduler import Scheduler
+from cranker_protocol.protocol import StreamMessage
+
+_ROUTER = URL("ws://router.example.com:9070/register/")
+
+
+def test_message_prefix_is_type_flags_and_stream_id():
+    assert StreamMessage.prefix(StreamMessage.DATA, StreamMessage.END_STREAM, 7) == b"\x00\x01\x00\x00\x00\x07"
+    assert StreamMessage.header(258, "GET / HTTP/1.1\n")[:6] == b"\x01\x04\x00\x00\x01\x02"
+    assert StreamMessage.header(1, "GET / HTTP/1.1\n", end_stream=True)[:2] == b"\x01\x05"
+
+
+@pytest.mark.parametrize("message, msg_type, flags, stream_id, payload", [
+    (StreamMessage.header(3, "GET /a HTTP/1.1\nHost:x\n"), StreamMessage.HEADER, StreamMessage.END_HEADER, 3,
+     b"GET /a HTTP/1.1\nHost:x\n"),
+    (StreamMessage.data(5, b"body"), StreamMessage.DATA, 0, 5, b"body"),
+    (StreamMessage.data(5, end_stream=True), StreamMessage.DATA, StreamMessage.END_STREAM, 5, b""),
+    (StreamMessage.window_update(9, 65536), StreamMessage.WINDOW_UPDATE, 0, 9, struct.pack("!i", 65536)),
+    (StreamMessage.rst_stream(11, 1011, "Proxy failure"), StreamMessage.RST_STREAM, 0, 11,
+     struct.pack("!i", 1011) + b"Proxy failure"),
+    (StreamMessage.data(2 ** 31 - 1, b"x"), StreamMessage.DATA, 0, 2 ** 31 - 1, b"x"),
+])
+def test_messages_parse_back(message, msg_type, flags, stream_id, payload):
+    msg = StreamMessage.parse(message)
+    assert (msg.msg_type, msg.flags, msg.stream_id, msg.payload) == (msg_type, flags, stream_id, payload)
+
+
+def test_message_flags_and_int_payload():
+    msg = StreamMessage.parse(StreamMessage.header(1, "GET / HTTP/1.1\n", end_stream=True))
+    assert msg.has(StreamMessage.END_HEADER) and msg.has(StreamMessage.END_STREAM)
+    assert not StreamMessage.parse(StreamMessage.data(1, b"x")).has(StreamMessage.END_STREAM)
+    assert StreamMessage.parse(StreamMessage.window_update(1, 12345)).int_payload() == 12345
+    assert StreamMessage.parse(StreamMessage.rst_stream(1, 1013, "busy")).int_payload() == 1013
+
+
+def test_a_message_shorter_than_its_prefix_does_not_parse():
+    with pytest.raises(struct.error):
+        StreamMessage.parse(b"\x00\x01\x00")
+
+
+def test_protocol_negotiation():
+    assert Multiplexing.upgrade_headers() == {"Sec-WebSocket-Protocol": "cranker_3.0, cranker_1.0"}
+    assert Multiplexing.accepted_by({"sec-websocket-protocol": "cranker_3.0"})
+    assert Multiplexing.accepted_by({"crankerprotocol": "3.0"})
+    assert not Multiplexing.accepted_by({"sec-websocket-protocol": "cranker_1.0"})
+    assert not Multiplexing.accepted_by({})
+
+
+def _unmask(frame: bytes) -> bytes:
+    """the payload of a masked websocket frame written by the connector"""
+    length, offset = frame[1] & 0x7f, 2
+    if length == 0x7e:
+        length, offset = struct.unpack_from("!H", frame, 2)[0], 4
+    elif length == 0x7f:
+        length, offset = struct.unpack_from("!Q", frame, 2)[0], 10
+    mask = frame[offset:offset + 4]
+    payload = frame[offset + 4:offset + 4 + length]
+    return bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+
+
+class Session(object):
+    """a multiplexed session on a socket that records the messages sent to the router"""
+
+    def __init__(self, target: TargetServer, stream_window_bytes: int = 1024 * 1024, target_workers: int = 4,
+                 req_body_stream_limit: int = 0, stream_window_timeout: float = 60) -> None:
+        self.scheduler = Scheduler(target_workers=target_workers, max_queue_size=1)
+        self.farm = WebsocketClientFarm(2)
+        self.sock = ConnectorSocket(_ROUTER, URL(target.uri), ConnInfo(_ROUTER, 0), self.farm, "test", self.scheduler,
+                                    req_body_stream_limit=req_body_stream_limit)
+        self.sock.send = self._record
+        self.sock.send_raw_frame = lambda frame: self._record(_unmask(bytes(frame)))
+        self.multiplexing = Multiplexing(stream_window_bytes, stream_window_timeout)
+        self.session = self.multiplexing.new_session(self.sock)
+        self.sent: List[StreamMessage] = []
+        self._cond = threading.Condition()
+
+    def _record(self, data: bytes, opcode: Optional[int] = None) -> NoReturn:
+        with self._cond:
+            self.sent.append(StreamMessage.parse(bytes(data)))
+            self._cond.notify_all()
+
+    def receive(self, message: bytes) -> NoReturn:
+        self.session.on_message(message)
+
+    def wait_for(self, predicate, timeout: float = 5) -> List[StreamMessage]:
+        with self._cond:
+            assert self._cond.wait_for(lambda: predicate(self.sent), timeout), self.sent
+            return list(self.sent)
+
+    def wait_ended(self, stream_id: int) -> List[StreamMessage]:
+        """the messages of the stream, once it ended"""
+        self.wait_for(lambda sent: any(m.stream_id == stream_id and (
+            m.has(StreamMessage.END_STREAM) or m.msg_type == StreamMessage.RST_STREAM) for m in sent))
+        return self.of(stream_id)
+
+    def of(self, stream_id: int, msg_type: Optional[int] = None) -> List[StreamMessage]:
+        with self._cond:
+            return [m for m in self.sent if m.stream_id == stream_id and (msg_type is None or m.msg_type == msg_type)]
+
+    def close(self) -> NoReturn:
+        self.scheduler.shutdown()
+
+
+@pytest.fixture(scope="module")
+def target():
+    server = TargetServer().start()
+    yield server
+    server.shutdown()
+
+
+def _body_bytes(messages: List[StreamMessage]) -> int:
+    return sum(len(m.payload) for m in messages if m.msg_type == StreamMessage.DATA)
+
+
+def test_concurrent_streams_get_responses_of_their_own(target):
+    s = Session(target)
+    try:
+        s.receive(StreamMessage.header(1, "GET /service-a/load?size=100000&delay=0.1 HTTP/1.1\nHost:a\n", True))
+        s.receive(StreamMessage.header(3, "GET /service-a/load?size=10 HTTP/1.1\nHost:a\n", True))
+        first, second = s.wait_ended(1), s.wait_ended(3)
+        for messages, size in ((first, 100000), (second, 10)):
+            assert messages[0].msg_type == StreamMessage.HEADER
+            assert messages[0].payload.decode().startswith("HTTP/1.1 200 OK\n")
+            assert f"Content-Length:{size}\n" in messages[0].payload.decode()
+            assert _body_bytes(messages) == size
+            assert messages[-1].msg_type == StreamMessage.DATA and messages[-1].has(StreamMessage.END_STREAM)
+        # the short response was not held up by the one started before it
+        assert s.sent.index(second[-1]) < s.sent.index(first[-1])
+        assert s.multiplexing.stats() == {
+            "sockets": 1, "streams": 0, "served": 2, "reset": 0, "refused": 0, "timed_out": 0}
+        assert s.farm.in_flight_requests() == 0
+    finally:
+        s.close()
+
+
+def test_a_stream_waits_for_the_router_to_acknowledge_its_window(target):
+    window = 32 * 1024
+    s = Session(target, stream_window_bytes=window)
+    try:
+        s.receive(StreamMessage.header(1, "GET /service-a/load?size=200000 HTTP/1.1\n", True))
+        s.wait_for(lambda sent: _body_bytes(sent) >= window)
+        time.sleep(0.2)
+        held = _body_bytes(s.of(1))
+        # a message goes out while less than the window is unacknowledged, so one more may overshoot it
+        assert window <= held < window + 16 * 1024 + 1
+        s.receive(StreamMessage.window_update(1, held))
+        s.wait_for(lambda sent: _body_bytes(sent) > held)
+        acked = held
+        while not any(m.has(StreamMessage.END_STREAM) for m in s.of(1)):
+            sent = _body_bytes(s.of(1))
+            if sent > acked:
+                s.receive(StreamMessage.window_update(1, sent - acked))
+                acked = sent
+            time.sleep(0.01)
+        assert _body_bytes(s.of(1)) == 200000
+    finally:
+        s.close()
+
+
+def test_a_stream_whose_window_is_never_acknowledged_is_reset(target):
+    s = Session(target, stream_window_bytes=16 * 1024, stream_window_timeout=0.3)
+    try:
+        s.receive(StreamMessage.header(1, "GET /service-a/load?size=200000 HTTP/1.1\n", True))
+        messages = s.wait_ended(1)
+        assert messages[-1].msg_type == StreamMessage.RST_STREAM and messages[-1].int_payload() == RST_PROXY_FAILURE
+        assert _body_bytes(messages) < 200000
+        s.wait_for(lambda sent: s.multiplexing.stats()["streams"] == 0)
+        assert s.multiplexing.stats()["timed_out"] == 1 and s.multiplexing.stats()["served"] == 0
+        assert s.farm.in_flight_requests() == 0
+        # the worker is free again
+        s.receive(StreamMessage.header(3, "GET /service-a/load?size=5 HTTP/1.1\n", True))
+        assert _body_bytes(s.wait_ended(3)) == 5
+        assert len(s.of(1, StreamMessage.RST_STREAM)) == 1
+    finally:
+        s.close()
+
+
+def test_buffered_request_body_is_acknowledged_as_it_arrives(target):
+    s = Session(target)
+    try:
+        s.receive(StreamMessage.header(5, "POST /service-a/upload?size=3 HTTP/1.1\nContent-Length:30000\n"))
+        s.receive(StreamMessage.data(5, b"a" * 10000))
+        s.receive(StreamMessage.data(5, b"b" * 20000))
+        assert [m.int_payload() for m in s.of(5, StreamMessage.WINDOW_UPDATE)] == [10000, 20000]
+        s.receive(StreamMessage.data(5, end_stream=True))
+        messages = s.wait_ended(5)
+        assert messages[-1].has(StreamMessage.END_STREAM) and _body_bytes(messages) == 3
+    finally:
+        s.close()
+
+
+def test_streamed_request_body_is_acknowledged_as_the_target_takes_it(target):
+    s = Session(target, req_body_stream_limit=64 * 1024)
+    try:
+        s.receive(StreamMessage.header(7, "POST /service-a/upload?size=3 HTTP/1.1\nContent-Length:30000\n"))
+        s.receive(StreamMessage.data(7, b"a" * 10000))
+        s.receive(StreamMessage.data(7, b"b" * 20000, end_stream=True))
+        messages = s.wait_ended(7)
+        assert messages[-1].has(StreamMessage.END_STREAM) and _body_bytes(messages) == 3
+        assert sum(m.int_payload() for m in s.of(7, StreamMessage.WINDOW_UPDATE)) == 30000
+    finally:
+        s.close()
+
+
+def test_a_stream_reset_by_the_router_is_aborted(target):
+    s = Session(target, stream_window_bytes=16 * 1024)
+    try:
+        s.receive(StreamMessage.header(9, "GET /service-a/load?size=1000000 HTTP/1.1\n", True))
+        s.wait_for(lambda sent: _body_bytes(sent) > 0)
+        s.receive(StreamMessage.rst_stream(9, 1001, "client gone"))
+        s.wait_for(lambda sent: s.multiplexing.stats()["streams"] == 0)
+        time.sleep(0.1)
+        assert not any(m.has(StreamMessage.END_STREAM) for m in s.of(9))
+        assert s.multiplexing.stats()["reset"] == 1 and s.multiplexing.stats()["served"] == 0
+        # messages of the ended stream are ignored, its id may be used again
+        s.receive(StreamMessage.window_update(9, 16 * 1024))
+        before = _body_bytes(s.of(9))
+        s.receive(StreamMessage.header(9, "GET /service-a/load?size=5 HTTP/1.1\n", True))
+        assert _body_bytes(s.wait_ended(9)) == before + 5
+    finally:
+        s.close()
+
+
+def test_a_failed_target_request_resets_the_stream(target):
+    s = Session(target)
+    s.sock.target_uri = URL("http://127.0.0.1:1")
+    try:
+        s.receive(StreamMessage.header(11, "GET /service-a/load HTTP/1.1\n", True))
+        messages = s.wait_ended(11)
+        assert messages[-1].msg_type == StreamMessage.RST_STREAM and messages[-1].int_payload() == RST_PROXY_FAILURE
+    finally:
+        s.close()
+
+
+def test_streams_are_refused_while_the_target_lane_is_full(target):
+    s = Session(target, target_workers=1)
+    try:
+        for stream_id in (1, 3, 5):
+            s.receive(StreamMessage.header(stream_id, "GET /service-a/load?delay=0.3 HTTP/1.1\n", True))
+        refused = s.wait_ended(5)
+        assert refused[-1].msg_type == StreamMessage.RST_STREAM and refused[-1].int_payload() == 1013
+        s.wait_ended(1), s.wait_ended(3)
+        assert s.multiplexing.stats()["refused"] == 1 and s.multiplexing.stats()["served"] == 2
+    finally:
+        s.close()
+
+
+def test_a_closing_session_waits_for_its_streams(target):
+    s = Session(target)
+    closed = []
+    s.sock.close = lambda **kwargs: closed.append(kwargs)
+    try:
+        s.receive(StreamMessage.header(1, "GET /service-a/load?delay=0.3 HTTP/1.1\n", True))
+        s.wait_for(lambda sent: s.multiplexing.stats()["streams"] == 1)
+        s.session.close_when_idle(b"Sliding window shrunk")
+        assert closed == []
+        s.wait_ended(1)
+        deadline = time.monotonic() + 5
+        while not closed and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert closed == [{"status": 1000, "reason": b"Sliding window shrunk", "timeout": 0}]
+        # no new streams once closed
+        s.session.abort_all("Socket to Router closed")
+        s.receive(StreamMessage.header(3, "GET /service-a/load HTTP/1.1\n", True))
+        time.sleep(0.1)
+        assert s.of(3) == [] and s.multiplexing.stats()["sockets"] == 0
+    finally:
+        s.close()
@@ -0,0 +1,121 @@
+# coding=utf-8
+# author=torchcc
+"""
+the cranker protocol 1.0 codec: request parsing, and the request and response messages built by the builders
+"""
+from cranker_protocol.protocol import HeadersBuilder, ProtocolRequest, ProtocolRequestBuilder, ProtocolResponse, \
+    ProtocolResponseBuilder, RequestBodyEndedMarker, RequestBodyPendingMarker, RequestHasNoBodyMarker
+
+
+def headers_of(*lines: str) -> HeadersBuilder:
+    headers = HeadersBuilder()
+    headers.append_headers(lines)
+    return headers
+
+
+def request_msg(end_marker: str, *lines: str) -> str:
+    builder = ProtocolRequestBuilder.new_builder().with_req_line("GET /a/b?c=d HTTP/1.1") \
+        .with_req_headers(headers_of(*lines))
+    return {
+        RequestBodyPendingMarker: builder.with_req_body_pending,
+        RequestHasNoBodyMarker: builder.with_req_has_no_body,
+        RequestBodyEndedMarker: builder.with_req_body_ended,
+    }[end_marker]().build()
+
+
+def response_builder(status: int, reason: str, *lines: str) -> ProtocolResponseBuilder:
+    return ProtocolResponseBuilder.new_builder().with_method("GET").with_src_url("/a/b?c=d") \
+        .with_resp_status(status).with_resp_reason(reason).with_resp_headers(headers_of(*lines))
+
+
+def test_headers_builder_joins_lines_with_a_trailing_newline():
+    headers = HeadersBuilder()
+    assert str(headers) == ""
+    headers.append_header("Host", "localhost")
+    headers.append_headers(["Accept:*/*"])
+    headers.append_header_items([("X-A", "1"), ("X-B", "")])
+    assert str(headers) == "Host:localhost\nAccept:*/*\nX-A:1\nX-B:\n"
+
+
+def test_request_builder_writes_the_blank_line_before_the_end_marker():
+    msg = request_msg(RequestHasNoBodyMarker, "Host:localhost", "Accept:*/*")
+    assert msg == "GET /a/b?c=d HTTP/1.1\nHost:localhost\nAccept:*/*\n\n_2"
+
+
+def test_request_round_trips():
+    for marker in (RequestBodyPendingMarker, RequestHasNoBodyMarker, RequestBodyEndedMarker):
+        msg = request_msg(marker, "Host:localhost", "Cookie:a=1; b=2", "X-Empty:")
+        req = ProtocolRequest(msg)
+        assert req.method == "GET"
+        assert req.dest == "/a/b?c=d"
+        # the blank line closing the headers is kept as an empty header line, so the message is rebuilt as it came
+        assert req.headers == ["Host:localhost", "Cookie:a=1; b=2", "X-Empty:", ""]
+        assert req.to_protocol_msg() == msg
+        assert ProtocolRequest(req.to_protocol_msg()).headers == req.headers
+
+
+def test_request_end_markers():
+    pending = ProtocolRequest(request_msg(RequestBodyPendingMarker, "Host:localhost"))
+    assert pending.req_body_pending() and not pending.req_has_no_body() and not pending.req_body_ended()
+    no_body = ProtocolRequest(request_msg(RequestHasNoBodyMarker, "Host:localhost"))
+    assert no_body.req_has_no_body() and not no_body.req_body_pending() and not no_body.req_body_ended()
+    ended = ProtocolRequest(request_msg(RequestBodyEndedMarker, "Host:localhost"))
+    assert ended.req_body_ended() and not ended.req_body_pending() and not ended.req_has_no_body()
+
+
+def test_bare_end_markers():
+    # sent on their own after the body, with no request line
+    for marker, ended in ((RequestBodyEndedMarker, True), (RequestBodyPendingMarker, False)):
+        req = ProtocolRequest(marker)
+        assert req.req_body_ended() is ended
+        assert req.method == "" and req.dest == "" and req.headers == []
+        assert req.to_protocol_msg() == marker
+
+
+def test_request_without_headers():
+    req = ProtocolRequest("DELETE /a HTTP/1.1\n_2")
+    assert (req.method, req.dest, req.headers) == ("DELETE", "/a", [])
+    assert req.req_has_no_body()
+    assert req.to_protocol_msg() == "DELETE /a HTTP/1.1\n_2"
+
+
+def test_malformed_request_lines_and_headers():
+    # no http version, and no target at all
+    assert ProtocolRequest("GET /a\n\n_2").dest == "/a"
+    req = ProtocolRequest("GET\n\n_2")
+    assert (req.method, req.dest) == ("GET", "")
+    # header lines without ':' and an unknown end marker are kept as they came, it is up to the reader to skip them
+    req = ProtocolRequest("GET /a HTTP/1.1\nHost:localhost\nno colon here\n\n_9")
+    assert req.headers == ["Host:localhost", "no colon here", ""]
+    assert not (req.req_body_pending() or req.req_has_no_body() or req.req_body_ended())
+    # a value may hold colons of its own
+    assert ProtocolRequest("GET /a HTTP/1.1\nReferer:http://b:8080/\n\n_2").headers[0] == "Referer:http://b:8080/"
+
+
+def test_request_to_string():
+    assert str(ProtocolRequest(request_msg(RequestHasNoBodyMarker))) == "ProtocolRequest{GET /a/b?c=d}"
+
+
+def test_response_builder():
+    builder = response_builder(404, "Not Found", "Content-Type:text/plain", "Content-Length:9")
+    assert builder.build() == "HTTP/1.1 404 Not Found\nGET /a/b?c=d\nContent-Type:text/plain\nContent-Length:9\n"
+    assert builder.to_protocol_msg() == builder.build() + "\n"
+    assert builder.build_v3() == "HTTP/1.1 404 Not Found\nContent-Type:text/plain\nContent-Length:9\n"
+
+
+def test_response_builder_without_headers():
+    builder = response_builder(204, "No Content")
+    assert builder.to_protocol_msg() == "HTTP/1.1 204 No Content\nGET /a/b?c=d\n\n"
+    assert builder.build_v3() == "HTTP/1.1 204 No Content\n"
+
+
+def test_response_round_trips():
+    for status, reason, lines in ((200, "OK", ("Content-Length:2",)),
+                                  (404, "Not Found", ("Content-Type:text/plain", "X-Empty:")),
+                                  (204, "No Content", ())):
+        builder = response_builder(status, reason, *lines)
+        resp = ProtocolResponse(builder.build())
+        assert (resp.status, resp.method, resp.src_url) == (status, "GET", "/a/b?c=d")
+        assert resp.headers == [*lines, ""]
+        # the direct serializer writes what parsing the head and building it again did, whole reason included
+        assert builder.to_protocol_msg() == resp.to_protocol_msg()
@@ -0,0 +1,199 @@
+# coding=utf-8
+# author=torchcc
+"""
+the response cache on a clock of the test's own: freshness, vary, revalidation, eviction and the counts it keeps
+"""
+from typing import NoReturn
+
+from requests import Response
+from requests.structures import CaseInsensitiveDict
+
+from crank4py_connector.response_cache import ResponseCache
+
+_URL = "http://target.example.com/a?b=c"
+
+
+class Clock(object):
+    def __init__(self) -> None:
+        self.now: float = 1000
+
+    def __call__(self) -> float:
+        return self.now
+
+    def advance(self, secs: float) -> NoReturn:
+        self.now += secs
+
+
+def response(status: int = 200, body: bytes = b"0123456789", **headers: str) -> Response:
+    resp = Response()
+    resp.status_code = status
+    resp.reason = "OK" if status == 200 else "Not Modified"
+    resp.headers = CaseInsensitiveDict({name.replace("_", "-"): value for name, value in headers.items()})
+    if status != 304:
+        resp.headers["Content-Length"] = str(len(body))
+    return resp
+
+
+def req_headers(**headers: str) -> CaseInsensitiveDict:
+    return CaseInsensitiveDict({name.replace("_", "-"): value for name, value in headers.items()})
+
+
+def store(cache: ResponseCache, resp: Response, url: str = _URL, headers: CaseInsensitiveDict = None, body=None):
+    headers = headers if headers is not None else req_headers()
+    assert cache.storable_size(resp) is not None
+    return cache.put("GET", url, headers, resp, body if body is not None else b"0123456789")
+
+
+def test_cacheable_requests():
+    assert ResponseCache.is_cacheable_request("GET", req_headers(Accept="*/*"))
+    assert not ResponseCache.is_cacheable_request("POST", req_headers())
+    assert not ResponseCache.is_cacheable_request("GET", req_headers(Authorization="Bearer x"))
+    assert not ResponseCache.is_cacheable_request("GET", req_headers(Range="bytes=0-1"))
+    assert not ResponseCache.is_cacheable_request("GET", req_headers(If_None_Match='"a"'))
+    assert not ResponseCache.is_cacheable_request("GET", req_headers(Cache_Control="no-store"))
+
+
+def test_storable_responses():
+    cache = ResponseCache(1600)
+    assert cache.storable_size(response(Cache_Control="max-age=60")) == 10
+    assert cache.storable_size(response(ETag='"a"')) == 10
+    assert cache.storable_size(response(Last_Modified="Wed, 21 Oct 2015 07:28:00 GMT")) == 10
+    # nothing to tell how long it stays fresh, nor to revalidate it with
+    assert cache.storable_size(response()) is None
+    assert cache.storable_size(response(Cache_Control="no-store, max-age=60")) is None
+    assert cache.storable_size(response(Cache_Control="private, max-age=60")) is None
+    assert cache.storable_size(response(Cache_Control="max-age=60", Set_Cookie="a=b")) is None
+    assert cache.storable_size(response(Cache_Control="max-age=60", Vary="*")) is None
+    assert cache.storable_size(response(500, Cache_Control="max-age=60")) is None
+    # bigger than max_entry_bytes, max_bytes / 16 by default
+    assert cache.storable_size(response(body=b"x" * 101, Cache_Control="max-age=60")) is None
+
+
+def test_fresh_for_max_age():
+    clock = Clock()
+    cache = ResponseCache(1 << 20, clock=clock)
+    store(cache, response(Cache_Control="max-age=60"))
+    clock.advance(59.9)
+    entry, fresh = cache.get("GET", _URL, req_headers())
+    assert fresh and entry.to_response().content == b"0123456789"
+    assert entry.to_response().headers["Age"] == "59"
+    clock.advance(0.1)
+    entry, fresh = cache.get("GET", _URL, req_headers())
+    assert entry is not None and not fresh
+
+
+def test_freshness_sources():
+    clock = Clock()
+    cache = ResponseCache(1 << 20, clock=clock)
+    # s-maxage is meant for shared caches and wins over max-age
+    assert store(cache, response(Cache_Control="max-age=10, s-maxage=30")).fresh_until == clock.now + 30
+    # the age the response had already reached upstream is counted
+    assert store(cache, response(Cache_Control="max-age=30", Age="20")).fresh_until == clock.now + 10
+    expires = response(Date="Wed, 21 Oct 2015 07:28:00 GMT", Expires="Wed, 21 Oct 2015 07:29:00 GMT")
+    assert store(cache, expires).fresh_until == clock.now + 60
+    # stored to be revalidated, never fresh
+    entry = store(cache, response(Cache_Control="no-cache, max-age=60", ETag='"a"'))
+    assert not entry.is_fresh()
+
+
+def test_request_asking_for_revalidation():
+    cache = ResponseCache(1 << 20, clock=Clock())
+    store(cache, response(Cache_Control="max-age=60"))
+    for headers in (req_headers(Cache_Control="no-cache"), req_headers(Cache_Control="max-age=0"),
+                    req_headers(Pragma="no-cache")):
+        entry, fresh = cache.get("GET", _URL, headers)
+        assert entry is not None and not fresh
+    assert cache.get("GET", _URL, req_headers(Cache_Control="max-age=5"))[1]
+
+
+def test_vary_keys_variants_on_the_named_request_headers():
+    cache = ResponseCache(1 << 20, clock=Clock())
+    gzip, br = req_headers(Accept_Encoding="gzip"), req_headers(Accept_Encoding="br")
+    store(cache, response(Cache_Control="max-age=60", Vary="accept-encoding"), headers=gzip, body=b"gzip-body!")
+    assert cache.get("GET", _URL, gzip)[0].body == b"gzip-body!"
+    assert cache.get("GET", _URL, br) == (None, False)
+    assert cache.get("GET", _URL, req_headers()) == (None, False)
+    store(cache, response(Cache_Control="max-age=60", Vary="Accept-Encoding"), headers=br, body=b"brotli-bod")
+    assert cache.get("GET", _URL, gzip)[0].body == b"gzip-body!"
+    assert cache.get("GET", _URL, br)[0].body == b"brotli-bod"
+    # other urls are keyed on their own
+    assert cache.get("GET", _URL + "&d=e", gzip) == (None, False)
+    assert cache.stats()["entries"] == 2
+
+
+def test_vary_change_drops_the_variants_stored_so_far():
+    cache = ResponseCache(1 << 20, clock=Clock())
+    gzip = req_headers(Accept_Encoding="gzip", Accept_Language="en")
+    store(cache, response(Cache_Control="max-age=60", Vary="Accept-Encoding"), headers=gzip)
+    store(cache, response(Cache_Control="max-age=60", Vary="Accept-Encoding"),
+          headers=req_headers(Accept_Encoding="br", Accept_Language="en"))
+    store(cache, response(Cache_Control="max-age=60", Vary="Accept-Language"), headers=gzip)
+    assert cache.stats()["entries"] == 1
+    assert cache.get("GET", _URL, req_headers(Accept_Encoding="br", Accept_Language="en"))[1]
+    assert cache.get("GET", _URL, req_headers(Accept_Language="fr")) == (None, False)
+
+
+def test_revalidation_with_a_304():
+    clock = Clock()
+    cache = ResponseCache(1 << 20, clock=clock)
+    store(cache, response(Cache_Control="max-age=10", ETag='"v1"', Content_Type="text/plain",
+                          Last_Modified="Wed, 21 Oct 2015 07:28:00 GMT"))
+    clock.advance(10)
+    entry, fresh = cache.get("GET", _URL, req_headers())
+    assert not fresh
+    assert entry.conditional_headers() == {"If-None-Match": '"v1"',
+                                           "If-Modified-Since": "Wed, 21 Oct 2015 07:28:00 GMT"}
+    size = cache.stats()["bytes"]
+    # the 304 updates the headers it carries, the stored body and its length stay
+    refreshed = cache.revalidated(entry, response(304, Cache_Control="max-age=30", X_Version="2",
+                                                  Content_Length="0", Connection="keep-alive"))
+    resp = refreshed.to_response()
+    assert resp.status_code == 200 and resp.content == b"0123456789"
+    assert resp.headers["Cache-Control"] == "max-age=30"
+    assert resp.headers["Content-Length"] == "10"
+    assert resp.headers["Content-Type"] == "text/plain"
+    assert resp.headers["X-Version"] == "2"
+    assert "Connection" not in resp.headers
+    assert cache.get("GET", _URL, req_headers()) == (refreshed, True)
+    clock.advance(30)
+    assert cache.get("GET", _URL, req_headers()) == (refreshed, False)
+    stats = cache.stats()
+    assert stats["entries"] == 1 and stats["bytes"] == size + len("X-Version") + len("2")
+
+
+def test_evicts_least_recently_used_beyond_max_bytes():
+    size = store(ResponseCache(1 << 20), response(Cache_Control="max-age=60")).size
+    cache = ResponseCache(size * 3, max_entry_bytes=100, clock=Clock())
+    for i in range(3):
+        store(cache, response(Cache_Control="max-age=60"), url=_URL + str(i))
+    assert cache.stats()["evicted"] == 0
+    # the first one was used since, the second one goes
+    assert cache.get("GET", _URL + "0", req_headers())[1]
+    store(cache, response(Cache_Control="max-age=60"), url=_URL + "3")
+    assert cache.get("GET", _URL + "1", req_headers()) == (None, False)
+    assert all(cache.get("GET", _URL + str(i), req_headers())[1] for i in (0, 2, 3))
+    stats = cache.stats()
+    assert (stats["entries"], stats["bytes"], stats["evicted"]) == (3, size * 3, 1)
+    # storing a url again replaces its entry in place
+    store(cache, response(Cache_Control="max-age=60"), url=_URL + "2")
+    assert (cache.stats()["entries"], cache.stats()["bytes"], cache.stats()["evicted"]) == (3, size * 3, 1)
+
+
+def test_stats_counts():
+    clock = Clock()
+    cache = ResponseCache(1 << 20, clock=clock)
+    assert cache.get("GET", _URL, req_headers()) == (None, False)
+    entry = store(cache, response(Cache_Control="max-age=10", ETag='"v1"'))
+    cache.get("GET", _URL, req_headers())
+    cache.get("GET", _URL, req_headers())
+    clock.advance(10)
+    # a stale lookup is counted once the target answered, revalidated on a 304, a miss otherwise
+    stale, fresh = cache.get("GET", _URL, req_headers())
+    assert not fresh
+    cache.revalidated(stale, response(304, Cache_Control="max-age=10"))
+    cache.count("misses")
+    stats = cache.stats()
+    assert {event: stats[event] for event in ("hits", "misses", "revalidated", "stored", "evicted")} == \
+        {"hits": 2, "misses": 2, "revalidated": 1, "stored": 1, "evicted": 0}
+    assert stats["hit_rate_percent"] == 60
+    assert stats["bytes"] == entry.size
@@ -0,0 +1,108 @@
+# coding=utf-8
+# author=torchcc
+import io
+import struct
+from typing import List
+
+import pytest
+from requests import Response
+from urllib3 import HTTPResponse
+from websocket import ABNF
+
+from crank4py_connector import response_pump
+from crank4py_connector.response_pump import ResponsePump, ResponseReadAhead
+from crank4py_connector.scheduler import Lane
+
+
+class _RawBody(io.RawIOBase):
+    """a raw stream returning at most read_size bytes per read"""
+
+    def __init__(self, body: bytes, read_size: int) -> None:
+        super().__init__()
+        self._body = io.BytesIO(body)
+        self._read_size = read_size
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        data = self._body.read(min(len(b), self._read_size))
+        b[:len(data)] = data
+        return len(data)
+
+
+class _Router(object):
+    def __init__(self) -> None:
+        self.frames: List[bytes] = []
+
+    def send_raw_frame(self, frame) -> None:
+        self.frames.append(bytes(frame))
+
+    def payloads(self) -> List[bytes]:
+        """unmasks the binary frames received"""
+        payloads = []
+        for frame in self.frames:
+            assert frame[0] == 0x80 | ABNF.OPCODE_BINARY and frame[1] & 0x80
+            length, offset = frame[1] & 0x7f, 2
+            if length == 0x7e:
+                length, offset = struct.unpack("!H", frame[2:4])[0], 4
+            elif length == 0x7f:
+                length, offset = struct.unpack("!Q", frame[2:10])[0], 10
+            key, payload = frame[offset:offset + 4], frame[offset + 4:]
+            assert len(payload) == length
+            payloads.append(ABNF.mask(key, payload))
+        return payloads
+
+
+def _response(fp) -> Response:
+    resp = Response()
+    resp.status_code = 200
+    resp.raw = HTTPResponse(body=fp, preload_content=False, decode_content=False)
+    return resp
+
+
+@pytest.mark.parametrize("with_numpy", [True, False])
+@pytest.mark.parametrize("prefix", [b"", b"\x01\x00\x00\x00\x07"])
+def test_every_chunk_is_framed_and_masked(monkeypatch, with_numpy, prefix):
+    if with_numpy and response_pump.numpy is None:
+        pytest.skip("numpy is not installed")
+    if not with_numpy:
+        monkeypatch.setattr(response_pump, "numpy", None)
+    body = bytes(range(256)) * 1000
+    router = _Router()
+    # short reads are sent right away, sizes cover 7 bit, 16 bit and 64 bit lengths
+    sent = ResponsePump(70000, len(prefix)).pump(_response(_RawBody(body, 65537)), router, prefix)
+    assert sent == len(body)
+    payloads = router.payloads()
+    assert all(payload.startswith(prefix) for payload in payloads)
+    assert b"".join(payload[len(prefix):] for payload in payloads) == body
+    router = _Router()
+    ResponsePump(100, len(prefix)).pump(_response(_RawBody(b"abc" * 33, 100)), router, prefix)
+    assert router.payloads() == [prefix + b"abc" * 33]
+
+
+def test_the_raw_connection_is_read_directly():
+    resp = _response(_RawBody(b"body", 2))
+    assert ResponsePump._raw_reader(resp) is resp.raw._fp
+
+
+def test_other_bodies_are_read_through_the_public_api():
+    # a buffered stream is not read straight into the pump's buffer
+    resp = _response(io.BytesIO(b"x" * 5000))
+    reader = ResponsePump._raw_reader(resp)
+    assert reader is not resp.raw._fp
+    router = _Router()
+    assert ResponsePump(1024).pump(resp, router) == 5000
+    assert b"".join(router.payloads()) == b"x" * 5000
+
+
+def test_read_ahead_sends_the_body_in_order():
+    lane = Lane("read-ahead", 1, 0)
+    read_ahead = ResponseReadAhead(4096, lane)
+    body = bytes(range(256)) * 100
+    router = _Router()
+    assert read_ahead.pump(_response(_RawBody(body, 1000)), router, 1024) == len(body)
+    assert b"".join(router.payloads()) == body
+    # the reader may hand the slots back after the last write
+    lane.shutdown(wait=True)
+    assert read_ahead.stats()["pumped"] == 1
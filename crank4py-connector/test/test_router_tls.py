@@ -0,0 +1,40 @@
+# coding=utf-8
+# author=torchcc
+import os
+import socket
+import ssl
+import threading
+
+from crank4py_connector.router_tls import create_router_tls_context
+
+_CERTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "certs")
+
+
+def test_reconnects_resume_the_tls_session_of_the_last_socket():
+    server_ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    server_ctx.load_cert_chain(os.path.join(_CERTS, "router.pem"), os.path.join(_CERTS, "router-key.pem"))
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen()
+    port = listener.getsockname()[1]
+
+    def serve(connects: int):
+        for _ in range(connects):
+            conn, _ = listener.accept()
+            with server_ctx.wrap_socket(conn, server_side=True) as tls:
+                tls.recv(64)
+                tls.sendall(b"HTTP/1.1 101 Switching Protocols\r\n\r\n")
+
+    threading.Thread(target=serve, args=(3,), daemon=True).start()
+    ctx = create_router_tls_context(verify=True, ca_file=os.path.join(_CERTS, "router.pem"))
+    try:
+        for _ in range(3):
+            with ctx.wrap_socket(socket.create_connection(("127.0.0.1", port), 5), server_hostname="localhost") as tls:
+                tls.sendall(b"GET /register/ HTTP/1.1\r\n\r\n")
+                # the session ticket of TLS 1.3 arrives with the first read after the handshake
+                assert tls.recv(64).startswith(b"HTTP/1.1 101")
+                ctx.on_connected(tls)
+    finally:
+        listener.close()
+    stats = ctx.stats()
+    assert stats["full_handshakes"] == 1 and stats["resumed_handshakes"] == 2
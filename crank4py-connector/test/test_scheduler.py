@@ -0,0 +1,95 @@
+# coding=utf-8
+# author=torchcc
+import threading
+import time
+
+from crank4py_connector import scheduler as scheduler_module
+from crank4py_connector.scheduler import Lane, LaneFullError, Scheduler, ThreadLane
+
+
+def test_pending_delayed_tasks_are_dropped_on_shutdown():
+    scheduler = Scheduler()
+    ran = []
+    scheduler.call_later(0.1, lambda: ran.append(1))
+    scheduler.shutdown()
+    scheduler.call_later(0, lambda: ran.append(2))
+    time.sleep(0.3)
+    assert ran == []
+    assert scheduler.stats()["reconnect"]["timers"] == 0
+
+
+def test_a_delayed_task_due_while_shutting_down_is_dropped_without_an_error(monkeypatch):
+    scheduler = Scheduler()
+    errors = []
+    monkeypatch.setattr(scheduler_module.log, "error", lambda msg, *args, **kwargs: errors.append(msg))
+    submit = scheduler.reconnect.submit
+    submitted = threading.Event()
+
+    def shut_down_first(task):
+        # the scheduler is shut down right after the timer thread took the task off the heap
+        scheduler.shutdown()
+        try:
+            return submit(task)
+        finally:
+            submitted.set()
+
+    scheduler.reconnect.submit = shut_down_first
+    scheduler.call_later(0, lambda: None)
+    assert submitted.wait(5)
+    time.sleep(0.05)
+    assert errors == []
+
+
+def test_delayed_tasks_run_in_order_of_their_due_time():
+    scheduler = Scheduler(reconnect_workers=1)
+    ran = []
+    done = threading.Event()
+    scheduler.call_later(0.1, lambda: (ran.append("late"), done.set()))
+    scheduler.call_later(0.02, lambda: ran.append("early"))
+    assert done.wait(5)
+    assert ran == ["early", "late"]
+    scheduler.shutdown()
+
+
+def test_a_full_lane_rejects_tasks():
+    lane = Lane("test", 1, 1)
+    release = threading.Event()
+    lane.submit(release.wait)
+    lane.submit(release.wait)
+    try:
+        lane.submit(release.wait)
+        assert False, "the third task was accepted"
+    except LaneFullError:
+        pass
+    assert lane.try_submit(release.wait) is None
+    release.set()
+    lane.shutdown()
+    assert lane.stats()["rejected"] == 1 and lane.stats()["completed"] == 2
+
+
+def test_thread_lane_runs_every_task_on_its_own_thread():
+    lane = ThreadLane("test")
+    release = threading.Event()
+    futures = [lane.submit(release.wait, 5) for _ in range(50)]
+    time.sleep(0.1)
+    assert lane.stats()["active"] == 50
+    release.set()
+    assert all(f.result(5) for f in futures)
+    assert lane.stats()["completed"] == 50
+    lane.shutdown()
+    try:
+        lane.submit(lambda: None)
+        assert False, "a task was started after shutdown"
+    except RuntimeError:
+        pass
+
+
+def test_thread_lane_caps_the_tasks_running_at_once():
+    lane = ThreadLane("test", 2)
+    release = threading.Event()
+    lane.submit(release.wait)
+    lane.submit(release.wait)
+    assert lane.try_submit(release.wait) is None
+    release.set()
+    time.sleep(0.1)
+    assert lane.submit(lambda: 1).result(5) == 1
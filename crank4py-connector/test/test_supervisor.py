@@ -0,0 +1,108 @@
+# coding=utf-8
+# author=torchcc
+import asyncio
+import os
+import signal
+import threading
+import time
+from typing import Callable
+
+import pytest
+
+from benchmark.fake_router import FakeRouter
+from benchmark.target_server import TargetServer
+from crank4py_connector import Config, create_and_start_connector
+from crank4py_connector.supervisor import ConnectorSupervisor, _sum_stats
+
+
+def _wait_until(predicate: Callable[[], bool], timeout: float = 10) -> bool:
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.02)
+    return True
+
+
+class Deployment(object):
+    """a router, a target and a supervisor running two connector processes between them"""
+
+    def __init__(self, window: int = 4) -> None:
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, name="test-router", daemon=True).start()
+        self.router: FakeRouter = self.run(FakeRouter().start())
+        self.target: TargetServer = TargetServer().start()
+        config = Config(self.target.uri, "service-a", [self.router.uri], component_name="test")
+        config.set_logging("WARNING")
+        config.set_sliding_window_size(window)
+        config.set_processes(2)
+        self.supervisor: ConnectorSupervisor = create_and_start_connector(config)
+        assert _wait_until(lambda: self.router.registered >= window)
+
+    def run(self, coro, timeout: float = 30):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(timeout)
+
+    def close(self) -> None:
+        self.supervisor.shutdown()
+        self.run(self.router.close())
+        self.target.shutdown()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+@pytest.fixture()
+def deployment():
+    d = Deployment()
+    yield d
+    d.close()
+
+
+def test_worker_stats_are_added_up_and_ratios_computed_again():
+    first = {"idle_sockets": 2, "response_cache": {"hits": 3, "misses": 1, "revalidated": 0, "hit_rate_percent": 75}}
+    second = {"idle_sockets": 1, "response_cache": {"hits": 0, "misses": 4, "revalidated": 0, "hit_rate_percent": 0}}
+    total = _sum_stats([first, second])
+    assert total["idle_sockets"] == 3
+    assert total["response_cache"] == {"hits": 3, "misses": 5, "revalidated": 0, "hit_rate_percent": 38}
+    assert _sum_stats([second])["response_cache"]["hit_rate_percent"] == 0
+
+
+def test_the_workers_serve_requests_and_their_stats_are_added_up(deployment):
+    resp = deployment.run(deployment.router.request("GET", "/service-a/load?size=16"))
+    assert resp.status == 200 and resp.body_size == 16
+    # every worker gets half of the sliding window. the target worker finishes just after the response went out
+    assert _wait_until(lambda: deployment.supervisor.stats()["idle_sockets"] == 4 and
+                       deployment.supervisor.stats()["scheduler"]["target"]["completed"] == 1)
+    stats = deployment.supervisor.stats()
+    assert stats["processes"] == 2 and stats["sliding_window_size"] == 4
+    metrics = deployment.supervisor.to_prometheus_text().splitlines()
+    assert sum(line.startswith('crank4py_idle_sockets{worker="0",') for line in metrics) == 1
+    assert sum(line.startswith('crank4py_idle_sockets{worker="1",') for line in metrics) == 1
+
+
+def test_a_killed_worker_is_restarted_after_a_growing_delay(deployment):
+    supervisor = deployment.supervisor
+    supervisor._restart_delay_secs = 0.5
+    restart_delays = []
+    for _ in range(2):
+        killed = supervisor._workers[0].process
+        os.kill(killed.pid, signal.SIGKILL)
+        killed_at = time.monotonic()
+        assert _wait_until(lambda: supervisor._workers[0].process is not killed)
+        restart_delays.append(time.monotonic() - killed_at)
+        assert supervisor._workers[0].process.is_alive()
+    # a worker exiting soon after it started waits twice as long before the next restart
+    assert 0.5 <= restart_delays[0] < 1 <= restart_delays[1] < 2
+    assert supervisor._workers[1].process.is_alive()
+    # the restarted worker registers with the router again
+    assert supervisor.wait_until_ready(min_sockets=4, timeout=10)
+
+
+def test_drain_and_shutdown_stop_every_worker(deployment):
+    processes = [w.process for w in deployment.supervisor._workers]
+    result = deployment.supervisor.drain(2)
+    assert result == {"idle_closed": 4, "completed": 0, "cut_off": 0}
+    assert not any(p.is_alive() for p in processes)
+    assert deployment.router.deregistered == 2
+    # shutting down a supervisor whose workers are gone already returns right away
+    started = time.monotonic()
+    deployment.supervisor.shutdown()
+    assert time.monotonic() - started < 1
@@ -0,0 +1,43 @@
+# coding=utf-8
+# author=torchcc
+import socketserver
+import threading
+from http.server import BaseHTTPRequestHandler
+
+from crank4py_connector.target_pool import create_pooled_http_client
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        body = f"{self.path} {self.headers['Host']}".encode()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class _UnixTarget(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def test_requests_are_sent_over_the_unix_socket_whatever_host_they_name(tmp_path):
+    path = str(tmp_path / "target.sock")
+    server = _UnixTarget(path, _Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    client, adapter = create_pooled_http_client(2, unix_socket=path)
+    try:
+        first = client.get("http://service-a.local/service-a/hi?x=1", timeout=5)
+        second = client.get("http://service-a.local/service-a/again", timeout=5)
+    finally:
+        client.close()
+        server.shutdown()
+        server.server_close()
+    assert first.status_code == 200 and first.text == "/service-a/hi?x=1 service-a.local"
+    assert second.text == "/service-a/again service-a.local"
+    # the second request reused the connection of the first
+    assert adapter.pool_stats.to_dict()["misses"] == 1 and adapter.pool_stats.to_dict()["hits"] == 1
@@ -0,0 +1,110 @@
+# coding=utf-8
+# author=torchcc
+from types import SimpleNamespace
+from typing import List
+
+import pytest
+
+from crank4py_connector import conn_info_n_ws_client_farm
+from crank4py_connector.conn_info_n_ws_client_farm import RouterHealthWeighting, SlidingWindowAutoscale, \
+    WebsocketClientFarm
+
+_ROUTER = "ws://router-1:9070"
+_OTHER_ROUTER = "ws://router-2:9070"
+
+
+class Clock(object):
+
+    def __init__(self) -> None:
+        self.now: float = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def advance(self, secs: float) -> None:
+        self.now += secs
+
+
+@pytest.fixture()
+def clock(monkeypatch):
+    c = Clock()
+    monkeypatch.setattr(conn_info_n_ws_client_farm, "time", SimpleNamespace(monotonic=c.monotonic))
+    return c
+
+
+def _fill(farm: WebsocketClientFarm, idle: List[object], uri: str = _ROUTER) -> None:
+    """what the connector does every rescale interval: opens the missing idle sockets, closes the surplus"""
+    missing = farm.rescale(uri)
+    for _ in range(missing):
+        sock = object()
+        idle.append(sock)
+        farm.add_ws(uri, sock)
+    for _ in range(-missing):
+        farm.remove_ws(uri, idle.pop())
+
+
+def test_an_autoscaled_window_grows_to_its_max_under_load_and_shrinks_to_its_min_when_idle(clock):
+    farm = WebsocketClientFarm(2, SlidingWindowAutoscale(min_size=2, max_size=10, scale_down_delay_secs=5))
+    idle: List[object] = []
+    _fill(farm, idle)
+    sizes = [farm.window_size(_ROUTER)]
+    # 20 requests a second, each one holding its socket for a second
+    in_flight: List[object] = []
+    for tick in range(200):
+        clock.advance(0.05)
+        if idle:
+            sock = idle.pop(0)
+            farm.consume_ws(_ROUTER, sock)
+            in_flight.append(sock)
+        if len(in_flight) > 20:
+            farm.release_ws(in_flight.pop(0))
+        if tick % 20 == 0:
+            _fill(farm, idle)
+        sizes.append(farm.window_size(_ROUTER))
+    assert farm.window_size(_ROUTER) == 10
+    for sock in in_flight:
+        farm.release_ws(sock)
+    # no requests at all from now on
+    for _ in range(60):
+        clock.advance(1)
+        _fill(farm, idle)
+        sizes.append(farm.window_size(_ROUTER))
+    assert farm.window_size(_ROUTER) == 2 and len(idle) == 2
+    assert all(2 <= size <= 10 for size in sizes)
+    # it shrinks one socket at a time
+    shrinking = sizes[sizes.index(10, 200):]
+    assert all(a - b in (0, 1) for a, b in zip(shrinking, shrinking[1:]))
+
+
+def test_running_out_of_idle_sockets_grows_the_window_right_away(clock):
+    farm = WebsocketClientFarm(2, SlidingWindowAutoscale(min_size=2, max_size=5))
+    idle: List[object] = []
+    _fill(farm, idle)
+    for expected in (3, 4, 5, 5):
+        while idle:
+            farm.consume_ws(_ROUTER, idle.pop())
+        # growing by half of the window, at least one socket, up to max_size
+        assert farm.window_size(_ROUTER) == expected
+        _fill(farm, idle)
+
+
+def test_the_window_shares_move_to_the_healthy_router_within_their_bounds(clock):
+    farm = WebsocketClientFarm(4, weighting=RouterHealthWeighting(min_share=0.25, max_share=2.0))
+    for uri in (_ROUTER, _OTHER_ROUTER):
+        assert farm.window_size(uri) == 4
+    for i in range(20):
+        clock.advance(0.1)
+        farm.on_request_done(_ROUTER, 0.05)
+        # slower, and one request in five aborted, not enough to be drained
+        farm.on_request_done(_OTHER_ROUTER, 0.5 if i % 5 else None)
+        health = farm.router_health()
+        assert all(h["share"] >= 0.25 for h in health.values())
+    assert health[_ROUTER]["share"] > 1 > health[_OTHER_ROUTER]["share"]
+    assert health[_OTHER_ROUTER]["error_rate"] < 0.5
+    assert farm.window_size(_ROUTER) > 4 > farm.window_size(_OTHER_ROUTER) >= 1
+    # however much slower a router is, it keeps min_share of the window and the other gets at most max_share
+    for _ in range(20):
+        farm.on_request_done(_OTHER_ROUTER, 60)
+    health = farm.router_health()
+    assert health[_OTHER_ROUTER]["share"] == 0.25 and health[_ROUTER]["share"] <= 2.0
+    assert farm.window_size(_OTHER_ROUTER) == 1
@@ -1,8 +1,16 @@
 # coding=utf-8
 # author=torchcc
 
+import atexit
 import logging
+import os
+import queue
+import random
 import ssl
+import threading
+from logging.handlers import QueueHandler, QueueListener
+from typing import List, NoReturn, Optional, Type, Union
+
 from requests import Session
 
 HttpClient = Session
@@ -79,11 +87,166 @@ def __create_logger():
     return logger
 
 
-log = __create_logger()
+class _DroppingQueueHandler(QueueHandler):
+    """hands records to the listener thread without ever waiting for it, records are dropped while the queue is full"""
+
+    def __init__(self, q: queue.Queue) -> None:
+        super().__init__(q)
+        self.dropped: int = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # the queue stays in this process, the record is handed over as it is and formatted by the listener's
+        # handlers, so the message and traceback are not formatted on the thread logging them
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> NoReturn:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
 
 
-def get_trust_all_ssl_ctx() -> ssl.SSLContext:
-    ctx = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+class _LogListener(QueueListener):
+    """a queue listener that can be waited for to write out what was queued before a given point"""
+
+    def handle(self, record) -> NoReturn:
+        if isinstance(record, threading.Event):
+            # a flush marker, every record queued before it is written out
+            record.set()
+        else:
+            super().handle(record)
+
+    def enqueue_sentinel(self) -> NoReturn:
+        # wait for room rather than fail while the queue is full, the listener is still emptying it
+        self.queue.put(self._sentinel)
+
+
+class _LogQueue(object):
+    """moves the handlers of a logger to a background thread, behind a bounded queue"""
+
+    def __init__(self, logger: logging.Logger, size: int) -> None:
+        self.size: int = size
+        self._handlers: List[logging.Handler] = list(logger.handlers)
+        for handler in self._handlers:
+            logger.removeHandler(handler)
+        self.handler = _DroppingQueueHandler(queue.Queue(size))
+        logger.addHandler(self.handler)
+        self._listener: Optional[QueueListener] = None
+        self._lock = threading.Lock()
+
+    def start(self) -> NoReturn:
+        with self._lock:
+            self._start()
+
+    def _start(self) -> NoReturn:
+        self._listener = _LogListener(self.handler.queue, *self._handlers, respect_handler_level=True)
+        self._listener.start()
+
+    def stop(self) -> NoReturn:
+        """writes out the records still queued"""
+        with self._lock:
+            if self._listener is not None:
+                self._listener.stop()
+                self._listener = None
+
+    def resize(self, size: int) -> NoReturn:
+        with self._lock:
+            if self._listener is not None:
+                # writes out what was queued so far, records logged meanwhile line up behind its sentinel
+                self._listener.stop()
+            # the handler's lock keeps loggers out until those records are moved over, so they stay in order
+            self.handler.acquire()
+            try:
+                old, self.handler.queue = self.handler.queue, queue.Queue(size)
+                while True:
+                    try:
+                        record = old.get_nowait()
+                    except queue.Empty:
+                        break
+                    self.handler.enqueue(record)
+            finally:
+                self.handler.release()
+            self.size = size
+            self._start()
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """waits for the records queued so far to be written out, False if that took longer than timeout"""
+        with self._lock:
+            if self._listener is None:
+                return True
+            written = threading.Event()
+            try:
+                self.handler.queue.put(written, timeout=timeout)
+            except queue.Full:
+                return False
+        return written.wait(timeout)
+
+    def after_fork(self) -> NoReturn:
+        # the listener thread does not survive a fork, the child needs one of its own. the records queued are the
+        # parent's, and the locks may have been held by threads that are gone
+        self._lock = threading.Lock()
+        self.handler.queue = queue.Queue(self.size)
+        self._listener = None
+        self.start()
+
+
+class LogSampler(object):
+    """lets about rate of the calls through, for log lines written for every request"""
+
+    def __init__(self, rate: float = 1.0) -> None:
+        self.rate: float = rate
+
+    def __call__(self) -> bool:
+        return self.rate >= 1 or (self.rate > 0 and random.random() < self.rate)
+
+
+log = __create_logger()
+# created by configure_logging(), until then records are written by the thread logging them
+_log_queue: Optional[_LogQueue] = None
+_log_queue_lock = threading.Lock()
+# access-style lines, one per proxied request
+sample_access_log = LogSampler()
+
+
+def configure_logging(level: Union[int, str, None] = None, access_log_sample_rate: Optional[float] = None,
+                      queue_size: Optional[int] = None) -> NoReturn:
+    """
+    :param level: the level of the crank4py-connector logger, DEBUG by default
+    :param access_log_sample_rate: the share of requests whose access line, "going to send ... to ...", is logged
+    :param queue_size: records waiting for the log thread before new ones are dropped, 10000 by default.
+    the log thread is started by the first call
+    """
+    global _log_queue
+    if level is not None:
+        log.setLevel(level)
+    if access_log_sample_rate is not None:
+        sample_access_log.rate = access_log_sample_rate
+    with _log_queue_lock:
+        if _log_queue is None:
+            _log_queue = _LogQueue(log, queue_size or 10000)
+            _log_queue.start()
+            atexit.register(_log_queue.stop)
+            if hasattr(os, "register_at_fork"):
+                os.register_at_fork(after_in_child=_log_queue.after_fork)
+        elif queue_size is not None and queue_size != _log_queue.size:
+            _log_queue.resize(queue_size)
+
+
+def flush_logs(timeout: Optional[float] = 5) -> bool:
+    """
+    writes out the records still queued for the log thread, e.g. before leaving a process with os._exit()
+    :return: False if the log thread did not get to them within timeout secs
+    """
+    return _log_queue.flush(timeout) if _log_queue is not None else True
+
+
+def dropped_log_records() -> int:
+    """records dropped because the log thread fell behind"""
+    return _log_queue.handler.dropped if _log_queue is not None else 0
+
+
+def get_trust_all_ssl_ctx(context_cls: Type[ssl.SSLContext] = ssl.SSLContext) -> ssl.SSLContext:
+    ctx = context_cls(ssl.PROTOCOL_SSLv23)
     ctx.verify_mode = ssl.CERT_NONE
     ctx.check_hostname = False
     return ctx